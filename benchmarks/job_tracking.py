@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+""" Compare waiting for many jobs through a ``jobs.JobTracker`` with one thread per job.
+
+Submits ``--jobs`` jobs that each sleep for ``--duration`` seconds to a
+``jobs.LocalEngine`` (so no CCC server or docker is needed), and waits for them either
+through one ``JobTracker`` or with one thread per job, polling the job's status the way
+``pyccc.engines.CloudComputeCannon.wait`` does (every second, two status requests per
+poll). Reports the wall time, the number of threads and the number of status requests.
+The tracker's wall time is bounded below by ``jobs / max_poll_rate`` (every job is polled
+at least once) and by how many jobs it lets be in flight at once.
+
+    USAGE: python benchmarks/job_tracking.py [--jobs 300] [--duration 1.0]
+               [--max-poll-rate 50] [--max-in-flight 256] [--json]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import threading
+import time
+
+import pyccc
+from pyccc import status
+
+from chemworkflows.jobs import (DEFAULT_MAX_IN_FLIGHT, MAX_POLL_RATE, JobTracker,
+                                LocalEngine)
+
+
+class CountingEngine(LocalEngine):
+    """ Counts status requests
+    """
+    def __init__(self, tempdir=None):
+        super(CountingEngine, self).__init__(tempdir)
+        self.status_requests = 0
+        self._lock = threading.Lock()
+
+    def get_status(self, job):
+        with self._lock:
+            self.status_requests += 1
+        return super(CountingEngine, self).get_status(job)
+
+
+def make_jobs(engine, njobs, duration):
+    return [pyccc.Job(engine, image='local', command='sleep %s' % duration,
+                      name='job%d' % i, submit=False)
+            for i in xrange(njobs)]
+
+
+def run_tracker(njobs, duration, max_poll_rate, max_in_flight):
+    engine = CountingEngine()
+    jobs = make_jobs(engine, njobs, duration)
+    start = time.time()
+    tracker = JobTracker(max_in_flight=max_in_flight, max_poll_rate=max_poll_rate)
+    handles = [tracker.submit(job) for job in jobs]
+    results = tracker.wait_all(handles)
+    elapsed = time.time() - start
+    threads = threading.active_count()
+    tracker.shutdown()
+    for job in jobs:
+        engine.cleanup(job)
+    engine.shutdown()
+    failures = [r for r in results if isinstance(r, Exception)]
+    assert not failures, repr(failures[0])
+    return {'elapsed_s': elapsed, 'threads': threads,
+            'status_requests': engine.status_requests,
+            'max_polls_per_job': max(handle.polls for handle in handles)}
+
+
+def poll_wait(job):
+    """ The polling loop of ``pyccc.engines.CloudComputeCannon.wait``
+    """
+    while job.status not in status.DONE_STATES:
+        time.sleep(1)
+        job.status
+    job.stdout
+
+
+def run_threads(njobs, duration):
+    engine = CountingEngine()
+    jobs = make_jobs(engine, njobs, duration)
+    start = time.time()
+    threads = []
+    for job in jobs:
+        job.submit()
+        thread = threading.Thread(target=poll_wait, args=(job,))
+        thread.start()
+        threads.append(thread)
+    nthreads = threading.active_count()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    for job in jobs:
+        engine.cleanup(job)
+    engine.shutdown()
+    return {'elapsed_s': elapsed, 'threads': nthreads,
+            'status_requests': engine.status_requests}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=300)
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help='How long each job runs (seconds)')
+    parser.add_argument('--max-poll-rate', type=float, default=MAX_POLL_RATE,
+                        help="The tracker's cap on status requests per second")
+    parser.add_argument('--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help='How many jobs the tracker lets run at once')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    results = {'jobs': args.jobs, 'duration_s': args.duration,
+               'max_poll_rate': args.max_poll_rate, 'max_in_flight': args.max_in_flight,
+               'tracker': run_tracker(args.jobs, args.duration,
+                                      args.max_poll_rate, args.max_in_flight),
+               'thread_per_job': run_threads(args.jobs, args.duration)}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name in ('tracker', 'thread_per_job'):
+        result = results[name]
+        print('%-15s %4d jobs of %.1f s: %.2f s wall time, %4d threads, '
+              '%5d status requests (%.1f per job)'
+              % (name, args.jobs, args.duration, result['elapsed_s'], result['threads'],
+                 result['status_requests'], result['status_requests'] / float(args.jobs)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+""" Benchmark ligand detection (``common.ligand_residue_groups``) on large synthetic systems.
+
+Builds protein-like assemblies of 10k to 1M atoms - chains of 10-atom residues bonded
+head-to-tail, plus free and covalently bound ligands - and times the connected-components
+ligand finder against the per-residue ``bonded_residues`` walk that it replaced. Both must
+find the same ligands.
+
+This uses lightweight stand-ins for moldesign's Molecule, Residue and Atom classes, so
+moldesign doesn't need to be installed.
+
+    USAGE: python benchmarks/ligands.py [--sizes 10000 100000 1000000] [--json]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import time
+
+from chemworkflows.common import ligand_residue_groups
+
+ATOMS_PER_RESIDUE = 10
+RESIDUES_PER_BLOCK = 200
+
+
+class Atom(object):
+    __slots__ = ('index', 'residue')
+
+    def __init__(self, index, residue):
+        self.index = index
+        self.residue = residue
+
+
+class Residue(object):
+    def __init__(self, index, restype):
+        self.index = index
+        self.type = restype
+        self.atoms = []
+        self.mol = None
+
+    @property
+    def bonded_residues(self):  # same approach as moldesign's implementation
+        found = set()
+        for atom in self.atoms:
+            for nbr in self.mol.bond_graph[atom]:
+                if nbr.residue is not self:
+                    found.add(nbr.residue)
+        return found
+
+
+class Molecule(object):
+    """ Blocks of residues, each laid out as:
+    a free ligand, a ligand bonded to one other residue, that residue, a ligand bonded to
+    a protein chain, then the chain itself (10-atom residues bonded head-to-tail)
+    """
+    def __init__(self, natoms):
+        self.atoms = []
+        self.residues = []
+        self.bond_graph = {}
+
+        for ires in xrange(natoms // ATOMS_PER_RESIDUE):
+            position = ires % RESIDUES_PER_BLOCK
+            if position in (0, 1, 3):
+                residue = self._add_residue('unknown')
+            elif position == 2:
+                residue = self._add_residue('other')
+            else:
+                residue = self._add_residue('protein')
+
+            if position in (2, 4) or position > 4:  # bond to the previous residue
+                self._bond(self.residues[-2].atoms[-1], residue.atoms[0])
+
+        self.num_atoms = len(self.atoms)
+        self.num_residues = len(self.residues)
+
+    def _add_residue(self, restype):
+        residue = Residue(len(self.residues), restype)
+        residue.mol = self
+        self.residues.append(residue)
+        for i in xrange(ATOMS_PER_RESIDUE):
+            atom = Atom(len(self.atoms), residue)
+            self.atoms.append(atom)
+            residue.atoms.append(atom)
+            self.bond_graph[atom] = {}
+            if i > 0:
+                self._bond(residue.atoms[i - 1], atom)
+        return residue
+
+    def _bond(self, a1, a2):
+        self.bond_graph[a1][a2] = 1
+        self.bond_graph[a2][a1] = 1
+
+
+def residue_walk(mol, candidates):
+    """ The per-residue algorithm previously used in ``get_ligands``
+    """
+    groups = []
+    for ligand in (mol.residues[i] for i in candidates):
+        bound_residues = list(ligand.bonded_residues)
+        if len(bound_residues) == 0:
+            groups.append([ligand.index])
+        elif len(bound_residues) == 1:
+            nbr = bound_residues[0]
+            if len(list(nbr.bonded_residues)) == 1:
+                groups.append([ligand.index, nbr.index])
+    return groups
+
+
+def timeit(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='*', default=[10000, 100000, 1000000])
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    ligand_residue_groups(Molecule(1000), [0])  # warm up (imports scipy)
+
+    results = []
+    for natoms in args.sizes:
+        mol = Molecule(natoms)
+        candidates = [r.index for r in mol.residues if r.type == 'unknown']
+        t_components, found = timeit(ligand_residue_groups, mol, candidates)
+        t_walk, expected = timeit(residue_walk, mol, candidates)
+        assert sorted(found) == sorted(expected), 'Ligand finders disagree'
+
+        results.append({'atoms': mol.num_atoms,
+                        'residues': mol.num_residues,
+                        'ligands': len(found),
+                        'components_s': t_components,
+                        'residue_walk_s': t_walk})
+        if not args.json:
+            print('%8d atoms, %4d ligands:  components %.3f s,  residue walk %.3f s'
+                  % (mol.num_atoms, len(found), t_components, t_walk))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+""" Compare the compact molecule format (``chemworkflows.molformat``) with dill pickles.
+
+Builds molecules from ``inputs/3aid.pdb``, replicated to reach each requested size, then
+round-trips each one through both formats, checks that the compact file holds the same
+data, and reports file sizes and dump/load times.
+
+This uses lightweight stand-ins for moldesign's Molecule, Residue, Chain, Atom and Bond
+classes, with the same attributes, so moldesign doesn't need to be installed; "load" for
+the compact format means mapping the file and reading every array.
+
+    USAGE: python benchmarks/molformat.py [--copies 1 10 40] [--json]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+import dill
+import numpy as np
+
+from chemworkflows.molformat import MoleculeFile, write_molecule
+
+PDBFILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       'inputs', '3aid.pdb')
+ELEMENTS = {'H': 1, 'C': 6, 'N': 7, 'O': 8, 'S': 16, 'P': 15}
+MASSES = {1: 1.008, 6: 12.011, 7: 14.007, 8: 15.999, 15: 30.974, 16: 32.06}
+
+
+class Chain(object):
+    def __init__(self, name):
+        self.name = name
+        self.residues = []
+
+
+class Residue(object):
+    def __init__(self, pdbname, pdbindex, chain):
+        self.pdbname = pdbname
+        self.pdbindex = pdbindex
+        self.chain = chain
+        self.atoms = []
+
+
+class Atom(object):
+    def __init__(self, name, atnum, residue, pdbindex):
+        self.name = self.pdbname = name
+        self.atnum = atnum
+        self.residue = residue
+        self.pdbindex = pdbindex
+        self.mass = MASSES.get(atnum, 12.011)
+        self.formal_charge = 0
+        self.metadata = {}
+        self.bonds = []
+
+
+class Bond(object):
+    def __init__(self, a1, a2, order=1):
+        self.a1 = a1
+        self.a2 = a2
+        self.order = order
+
+
+class Molecule(object):
+    def __init__(self, atoms, bonds, positions, name):
+        self.atoms = atoms
+        self.bonds = bonds
+        self.positions = positions
+        self.name = name
+        self.charge = 0
+        self.num_atoms = len(atoms)
+        self.metadata = {'missing_residues': {'A': {1: 'MET'}}}
+        self.properties = {}
+
+
+def read_pdb_records(path):
+    records = []
+    with open(path, 'r') as infile:
+        for line in infile:
+            if line.startswith(('ATOM  ', 'HETATM')):
+                records.append((line[12:16].strip(), line[17:20].strip(), line[21],
+                                int(line[22:26]), line[76:78].strip() or line[12:14].strip(),
+                                [float(line[30:38]), float(line[38:46]), float(line[46:54])]))
+    return records
+
+
+def build_molecule(records, copies):
+    """ ``copies`` copies of the PDB's atoms, each in its own set of chains, with each
+    residue's atoms bonded in sequence and consecutive residues bonded to each other
+    """
+    atoms, bonds, positions = [], [], []
+    for icopy in xrange(copies):
+        chains, residue = {}, None
+        for name, resname, chainid, resseq, element, xyz in records:
+            if chainid not in chains:
+                chains[chainid] = Chain('%s%d' % (chainid, icopy))
+            if residue is None or (residue.pdbindex, residue.chain) != (resseq, chains[chainid]):
+                previous = residue
+                residue = Residue(resname, resseq, chains[chainid])
+                chains[chainid].residues.append(residue)
+            atom = Atom(name, ELEMENTS.get(element[:1].upper(), 6), residue, len(atoms) + 1)
+            if residue.atoms:
+                bonds.append(Bond(residue.atoms[-1], atom))
+            elif previous is not None and previous.chain is residue.chain:
+                bonds.append(Bond(previous.atoms[-1], atom))
+            residue.atoms.append(atom)
+            atoms.append(atom)
+            positions.append([x + 100.0 * icopy for x in xyz])
+    return Molecule(atoms, bonds, np.array(positions), '3aid x%d' % copies)
+
+
+def check_round_trip(mol, molfile):
+    arrays = molfile.arrays
+    assert molfile.natoms == mol.num_atoms
+    assert np.allclose(arrays['positions'], mol.positions)
+    assert list(arrays['atomic_numbers']) == [a.atnum for a in mol.atoms]
+    assert list(arrays['atom_names']) == [a.name for a in mol.atoms]
+    assert list(arrays['atom_pdbindex']) == [a.pdbindex for a in mol.atoms]
+    assert np.allclose(arrays['masses'], [a.mass for a in mol.atoms])
+    assert len(arrays['bonds']) == len(mol.bonds)
+    resnames = arrays['residue_names'][arrays['residue_index']]
+    assert list(resnames) == [a.residue.pdbname for a in mol.atoms]
+    metadata, atom_metadata, properties = pickle.loads(molfile.attachment('_metadata.pickle'))
+    assert metadata == mol.metadata
+
+
+def timeit(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def load_compact(path):
+    with MoleculeFile(path) as molfile:
+        for array in molfile.arrays.itervalues():
+            array.tobytes()  # touch every page
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--copies', type=int, nargs='*', default=[1, 10, 40])
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    records = read_pdb_records(PDBFILE)
+    workdir = tempfile.mkdtemp()
+    results = []
+    try:
+        for copies in args.copies:
+            mol = build_molecule(records, copies)
+            compact = os.path.join(workdir, 'mol.cwmol')
+
+            t_write, _ = timeit(write_molecule, mol, compact)
+            with MoleculeFile(compact) as molfile:
+                check_round_trip(mol, molfile)
+            t_load, _ = timeit(load_compact, compact)
+
+            t_dump, pickled = timeit(dill.dumps, mol)
+            t_unpickle, _ = timeit(dill.loads, pickled)
+
+            result = {'atoms': mol.num_atoms,
+                      'compact_bytes': os.path.getsize(compact),
+                      'dill_bytes': len(pickled),
+                      'compact_write_s': t_write,
+                      'compact_load_s': t_load,
+                      'dill_dump_s': t_dump,
+                      'dill_load_s': t_unpickle}
+            results.append(result)
+            if not args.json:
+                print('%7d atoms:  compact %9d B, write %.3f s, load %.4f s   |   '
+                      'dill %9d B, dump %.3f s, load %.3f s'
+                      % (mol.num_atoms, result['compact_bytes'], t_write, t_load,
+                         len(pickled), t_dump, t_unpickle))
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+""" Compare the typed output writers (``chemworkflows.outputs``) with dill pickles.
+
+Writes arrays shaped like typical numeric outputs - a series of energies and a stack of
+coordinate frames - with ``outputs.write_output`` (which picks compressed ``.npz`` for
+them) and with dill, the old fallback, and reports file sizes and write/load times.
+Coordinates are a smooth random walk, like a minimization trajectory, so compression
+behaves realistically.
+
+    USAGE: python benchmarks/output_formats.py [--frames 10 100 1000] [--atoms 5000]
+                                               [--json]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import dill
+import numpy as np
+
+from chemworkflows import outputs
+
+
+def make_outputs(nframes, natoms):
+    rng = np.random.RandomState(0)
+    start = rng.uniform(-30.0, 30.0, size=(natoms, 3))
+    steps = rng.normal(scale=0.01, size=(nframes, natoms, 3)).cumsum(axis=0)
+    return {'energies': -1000.0 + rng.normal(size=nframes).cumsum(),
+            'frames': (start + steps).round(4)}
+
+
+def timeit(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def write_dill(value, path):
+    with open(path, 'wb') as outfile:
+        dill.dump(value, outfile)
+
+
+def load_dill(path):
+    with open(path, 'rb') as infile:
+        return dill.load(infile)
+
+
+def load_npz(path):
+    with np.load(path) as arrays:
+        return {name: arrays[name] for name in arrays.files}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, nargs='*', default=[10, 100, 1000])
+    parser.add_argument('--atoms', type=int, default=5000)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    results = []
+    try:
+        for nframes in args.frames:
+            for name, value in sorted(make_outputs(nframes, args.atoms).iteritems()):
+                t_write, written = timeit(outputs.write_output, name, value, workdir)
+                path = os.path.join(workdir, written['filename'])
+                t_load, loaded = timeit(load_npz, path)
+                assert np.array_equal(loaded['value'], value)
+
+                pickled = os.path.join(workdir, name + '.dill')
+                t_dump, _ = timeit(write_dill, value, pickled)
+                t_unpickle, _ = timeit(load_dill, pickled)
+
+                result = {'output': name,
+                          'frames': nframes,
+                          'format': written['format'],
+                          'bytes': written['bytes'],
+                          'dill_bytes': os.path.getsize(pickled),
+                          'write_s': t_write,
+                          'load_s': t_load,
+                          'dill_dump_s': t_dump,
+                          'dill_load_s': t_unpickle}
+                results.append(result)
+                if not args.json:
+                    print('%-8s %5d frames:  %s %11d B, write %.3f s, load %.3f s   |   '
+                          'dill %11d B, dump %.3f s, load %.3f s'
+                          % (name, nframes, written['format'], written['bytes'], t_write,
+                             t_load, result['dill_bytes'], t_dump, t_unpickle))
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
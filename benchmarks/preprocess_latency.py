@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+""" Compare preprocessing latency with and without the warm container pool.
+
+Runs ``chemworkflow APP INPUT --preprocess --localdocker`` repeatedly, once with a new
+container per task (``--no-container-pool``) and once with pooled worker containers, and
+reports the median wall time of each. The result cache is disabled, so every run actually
+executes the preprocessing tasks. Needs a local docker daemon and the app's images.
+
+Pooled runs start their own workers, so "pooled" includes the one-off cost of starting
+a worker per image; ``--repeat`` runs of the same process can't share workers.
+
+    USAGE: python benchmarks/preprocess_latency.py [--app minimization]
+                                                   [--input inputs/3aid_pdbkey.json]
+                                                   [--repeat 3] [--json]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_preprocessing(app, inputfile, repeat, pooled):
+    times = []
+    for i in xrange(repeat):
+        outdir = tempfile.mkdtemp()
+        command = [sys.executable, '-m', 'chemworkflows', app, inputfile, '--preprocess',
+                   '--localdocker', '--no-cache', '--outputdir', outdir]
+        if not pooled:
+            command.append('--no-container-pool')
+        try:
+            start = time.time()
+            subprocess.check_call(command, cwd=ROOT, stdout=open(os.devnull, 'w'))
+            times.append(time.time() - start)
+        finally:
+            shutil.rmtree(outdir, ignore_errors=True)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--app', default='minimization')
+    parser.add_argument('--input', default=os.path.join(ROOT, 'inputs', '3aid_pdbkey.json'))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    unpooled = time_preprocessing(args.app, args.input, args.repeat, pooled=False)
+    pooled = time_preprocessing(args.app, args.input, args.repeat, pooled=True)
+
+    if args.json:
+        print(json.dumps({'app': args.app,
+                          'new_container_per_task_s': unpooled,
+                          'container_pool_s': pooled}))
+    else:
+        print('%s preprocessing, median of %d runs:' % (args.app, args.repeat))
+        print('    new container per task: %.2f s' % unpooled)
+        print('    warm container pool:    %.2f s (%.1fx)' % (pooled, unpooled / pooled))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+""" Measure how much of a workflow's wall time is spent in chemworkflows and pyccc rather
+than in the tasks themselves.
+
+Builds synthetic workflows with the same shapes as the ``minimization``, ``vde`` and
+``simsetup`` apps, with the per-ligand (or per-molecule) branch repeated ``fanout`` times.
+Tasks do no work: they just return copies of a payload the size of ``inputs/3aid.pdb``
+(times ``scale``), so everything measured is overhead. Neither Docker nor a CCC server is
+needed: tasks run in this process, either directly through ``ParallelRuntimeRunner``, or
+through ``ParallelCCCRunner`` and an ``InProcessEngine``, which runs each pyccc job here in
+its own temporary directory - so pyccc's packaging of each job, the serialization of its
+inputs and the fetching and unpickling of its results are all included.
+
+For each shape, fan-out and payload scale this reports:
+    overhead_ms_per_task     scheduling overhead per task (no checkpoint)
+    engine_ms_per_task       the same, with every task run as a pyccc job
+    checkpointed_ms_per_task the same, while writing the workflow_state/ checkpoint
+    checkpoint_bytes         size of the workflow_state/ checkpoint directory
+    legacy_state_bytes       size of the pickled runner (the old workflow_state.dill)
+    restart_s                time to restore the checkpoint and fetch every output
+    write_outputs_mb_s       throughput of ``outputs.write_outputs``
+
+Results are saved as JSON, tagged with the git revision, so runs from different versions
+can be compared with ``--compare``.
+
+    USAGE: python benchmarks/runner_overhead.py [--fanouts 1 4 16] [--scales 1 4 16]
+                                                [--output FILE] [--compare OLD.json]
+"""
+from __future__ import print_function
+
+import argparse
+import contextlib
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import dill
+from pyccc import status, workflow
+from pyccc.engines import Subprocess
+
+from chemworkflows import checkpoint
+from chemworkflows.outputs import write_outputs
+from chemworkflows.runners import ParallelCCCRunner, ParallelRuntimeRunner
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAYLOAD = os.path.join(ROOT, 'inputs', '3aid.pdb')
+
+# Each shape is a list of (taskname, {input: (upstream task, field)}, {output: kind}).
+# "{i}" in a name marks the branch that is repeated ``fanout`` times. Outputs of kind
+# "mol" carry the payload; "small" outputs are a few bytes.
+SHAPES = {
+    'minimization': [
+        ('read_molecule', {'description': (None, 'molecule_json')}, {'mol': 'mol'}),
+        ('get_ligands', {'mol': ('read_molecule', 'mol')},
+         {'ligand_options': 'small', 'mv_ligand_strings': 'small'}),
+        ('validate', {'mol': ('read_molecule', 'mol'),
+                      'ligands': ('get_ligands', 'ligand_options')}, {'validation': 'small'}),
+        ('atomselection{i}', {'choices': ('get_ligands', 'ligand_options')},
+         {'atom_ids': 'small', 'ligandname': 'small'}),
+        ('protonate_ligand{i}', {'mol': ('read_molecule', 'mol'),
+                                 'ligand_atom_ids': ('atomselection{i}', 'atom_ids')},
+         {'ligand': 'mol', 'ligand_key': 'small'}),
+        ('prep_ligand{i}', {'ligand': ('protonate_ligand{i}', 'ligand')},
+         {'ligand_parameters': 'mol'}),
+        ('prep_forcefield{i}', {'mol': ('read_molecule', 'mol'),
+                                'ligand_params': ('prep_ligand{i}', 'ligand_parameters')},
+         {'molecule': 'mol', 'prmtop': 'mol', 'inpcrd': 'mol'}),
+        ('mm_minimization{i}', {'mol': ('prep_forcefield{i}', 'molecule')},
+         {'results': 'small', 'pdbstring': 'mol', 'minstep_frames': 'mol'}),
+    ],
+    'vde': [
+        ('read_molecule', {'description': (None, 'molecule_json')}, {'mol': 'mol'}),
+        ('validate', {'mol': ('read_molecule', 'mol')}, {'validation': 'small'}),
+        ('minimize_doublet{i}', {'mol': ('read_molecule', 'mol')},
+         {'mol': 'mol', 'pdbstring': 'mol'}),
+        ('single_point_singlet{i}', {'mol': ('minimize_doublet{i}', 'mol')}, {'mol': 'mol'}),
+        ('get_results{i}', {'doublet': ('minimize_doublet{i}', 'mol'),
+                            'singlet': ('single_point_singlet{i}', 'mol')},
+         {'results': 'small'}),
+    ],
+    'simsetup': [
+        ('read_molecule', {'description': (None, 'molecule_json')}, {'mol': 'mol'}),
+        ('get_ligands', {'mol': ('read_molecule', 'mol')}, {'ligand_options': 'small'}),
+        ('validate', {'mol': ('read_molecule', 'mol'),
+                      'ligands': ('get_ligands', 'ligand_options')}, {'validation': 'small'}),
+        ('atomselection{i}', {'choices': ('get_ligands', 'ligand_options')},
+         {'atom_ids': 'small', 'ligandname': 'small'}),
+        ('protonate_ligand{i}', {'mol': ('read_molecule', 'mol'),
+                                 'ligand_atom_ids': ('atomselection{i}', 'atom_ids')},
+         {'ligand': 'mol', 'ligand_key': 'small'}),
+        ('prep_ligand{i}', {'ligand': ('protonate_ligand{i}', 'ligand')},
+         {'ligand_parameters': 'mol'}),
+        ('prep_forcefield{i}', {'mol': ('read_molecule', 'mol'),
+                                'ligmol': ('protonate_ligand{i}', 'ligand'),
+                                'ligand_params': ('prep_ligand{i}', 'ligand_parameters')},
+         {'molecule': 'mol'}),
+        ('write_lammps_setup{i}', {'mol': ('prep_forcefield{i}', 'molecule')},
+         {'mol.pdb': 'mol', 'lammps.data': 'mol'}),
+    ],
+}
+
+# workflow outputs for each shape: (output name, task, field)
+OUTPUTS = {
+    'minimization': [('results{i}', 'mm_minimization{i}', 'results'),
+                     ('final_structure{i}.pdb', 'mm_minimization{i}', 'pdbstring'),
+                     ('prmtop{i}', 'prep_forcefield{i}', 'prmtop'),
+                     ('inpcrd{i}', 'prep_forcefield{i}', 'inpcrd')],
+    'vde': [('final_structure{i}.pdb', 'minimize_doublet{i}', 'pdbstring'),
+            ('results{i}', 'get_results{i}', 'results')],
+    'simsetup': [('mol{i}.pdb', 'write_lammps_setup{i}', 'mol.pdb'),
+                 ('lammps{i}.data', 'write_lammps_setup{i}', 'lammps.data')],
+}
+
+
+class InProcessEngine(Subprocess):
+    """ Runs each python job in this process, in a temporary directory under ``workdir``.
+
+    The job's input files (its packaged function and arguments) are written out and the
+    function is unpickled from them; its return value is pickled into the directory, where
+    pyccc fetches it from like from any local engine.
+    """
+    def __init__(self, workdir):
+        super(InProcessEngine, self).__init__()
+        self.workdir = workdir
+
+    def submit(self, job):
+        self._check_job(job)
+        job.workingdir = tempfile.mkdtemp(dir=self.workdir, prefix='job.')
+        for filename, fileobj in job.inputs.items():
+            fileobj.put(os.path.join(job.workingdir, filename))
+
+        with open(os.path.join(job.workingdir, 'function.pkl'), 'rb') as infile:
+            funcpkg = pickle.load(infile)
+        result = funcpkg.run(job.function_call.function)  # functions aren't pickled
+        with open(os.path.join(job.workingdir, '_function_return.pkl'), 'wb') as outfile:
+            pickle.dump(result, outfile, pickle.HIGHEST_PROTOCOL)
+
+        job.jobid = job.workingdir
+        job._started = True
+        return job.jobid
+
+    def get_status(self, job):
+        return status.FINISHED
+
+    def wait(self, job):
+        pass
+
+    def kill(self, job):
+        pass
+
+    def _get_final_stds(self, job):
+        return '', ''
+
+
+def make_task(name, outputs, payload):
+    def task(**inputs):
+        return {field: payload if kind == 'mol' else {'task': name, 'field': field}
+                for field, kind in outputs.iteritems()}
+    task.__name__ = name
+    return task
+
+
+def build_workflow(shape, fanout, payload):
+    """ Build a synthetic workflow with the given shape, repeating its branches ``fanout``
+    times
+    """
+    wf = workflow.Workflow('%s x%d' % (shape, fanout))
+    specs = {}
+
+    for template, inputs, outputs in SHAPES[shape]:
+        for i in (xrange(fanout) if '{i}' in template else [None]):
+            name = template.format(i=i)
+            connections = {}
+            for field, (upstream, upfield) in inputs.iteritems():
+                if upstream is None:
+                    connections[field] = wf.input(upfield)
+                else:
+                    connections[field] = specs[upstream.format(i=i)][upfield]
+            specs[name] = wf.task(make_task(name, outputs, payload), **connections)
+
+    wf.set_outputs(**{output.format(i=i): specs[task.format(i=i)][field]
+                      for output, task, field in OUTPUTS[shape]
+                      for i in xrange(fanout)})
+    return wf
+
+
+@contextlib.contextmanager
+def quiet():
+    """ Silence the runner's progress messages while timing it
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    with quiet():
+        result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+               for dirpath, dirnames, filenames in os.walk(path)
+               for filename in filenames)
+
+
+def fetch_all_outputs(runner):
+    return [runner.getoutput(field) for field in runner.outputfields]
+
+
+def measure(shape, fanout, payload, workdir):
+    """ Run one synthetic workflow and measure the runner's overhead
+    """
+    inputs = {'molecule_json': {'filename': '3aid.pdb', 'content': payload}}
+    wf = build_workflow(shape, fanout, payload)
+
+    runner = ParallelRuntimeRunner(wf, **inputs)
+    ntasks = len(runner.tasks)
+    run_s, _ = timed(runner.run)
+
+    jobdir = os.path.join(workdir, 'jobs')
+    os.mkdir(jobdir)
+    runner = ParallelCCCRunner(wf, engine=InProcessEngine(jobdir), **inputs)
+    engine_s, _ = timed(runner.run)
+    shutil.rmtree(jobdir)
+
+    runner = ParallelRuntimeRunner(wf, **inputs)
+    statedir = os.path.join(workdir, 'workflow_state')
+    runner.checkpoint = checkpoint.Checkpoint(statedir, shape, runner)
+    checkpointed_s, _ = timed(runner.run)
+
+    try:
+        legacy_state_bytes = len(dill.dumps(runner))
+    except Exception:  # runners that can't be pickled at all can't be restarted either
+        legacy_state_bytes = None
+
+    restart_s, _ = timed(lambda: fetch_all_outputs(
+        checkpoint.restore(statedir, wf, ParallelRuntimeRunner)))
+
+    outdir = os.path.join(workdir, 'outputs')
+    os.mkdir(outdir)
+    write_s, written = timed(write_outputs, runner, outdir)
+    written_bytes = sum(item['bytes'] for item in written)
+
+    return {'shape': shape,
+            'fanout': fanout,
+            'payload_bytes': len(payload),
+            'tasks': ntasks,
+            'overhead_ms_per_task': 1000.0 * run_s / ntasks,
+            'engine_ms_per_task': 1000.0 * engine_s / ntasks,
+            'checkpointed_ms_per_task': 1000.0 * checkpointed_s / ntasks,
+            'checkpoint_bytes': directory_size(statedir),
+            'legacy_state_bytes': legacy_state_bytes,
+            'restart_s': restart_s,
+            'write_outputs_s': write_s,
+            'write_outputs_bytes': written_bytes,
+            'write_outputs_mb_s': written_bytes / 1024.0**2 / write_s}
+
+
+def median_result(results):
+    """ Median of each timing across repeats (sizes are the same every time)
+    """
+    merged = dict(results[0])
+    for key in ('overhead_ms_per_task', 'engine_ms_per_task', 'checkpointed_ms_per_task',
+                'restart_s', 'write_outputs_s', 'write_outputs_mb_s'):
+        values = sorted(r[key] for r in results)
+        merged[key] = values[len(values) // 2]
+    return merged
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=ROOT, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    return result['shape'], result['fanout'], result['payload_bytes']
+
+
+def compare(results, oldpath):
+    """ Print the ratio of each metric to an earlier run (> 1 means slower or bigger)
+    """
+    with open(oldpath, 'r') as infile:
+        old = {result_key(r): r for r in json.load(infile)['results']}
+
+    print('\nCompared to %s:' % oldpath)
+    for result in results:
+        previous = old.get(result_key(result))
+        if previous is None:
+            continue
+        ratios = []
+        for key in ('overhead_ms_per_task', 'engine_ms_per_task', 'checkpointed_ms_per_task',
+                    'checkpoint_bytes', 'restart_s'):
+            if result.get(key) and previous.get(key):
+                ratios.append('%s x%.2f' % (key, result[key] / float(previous[key])))
+        if result['write_outputs_mb_s'] and previous.get('write_outputs_mb_s'):
+            ratios.append('write_outputs_mb_s x%.2f'
+                          % (result['write_outputs_mb_s'] / previous['write_outputs_mb_s']))
+        shape, fanout, payload_bytes = result_key(result)
+        print('  %-12s fanout %3d  payload %9d B:  %s'
+              % (shape, fanout, payload_bytes, ', '.join(ratios)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shapes', nargs='*', default=sorted(SHAPES), choices=sorted(SHAPES))
+    parser.add_argument('--fanouts', type=int, nargs='*', default=[1, 4, 16])
+    parser.add_argument('--scales', type=int, nargs='*', default=[1, 4, 16],
+                        help='Payload sizes, as multiples of inputs/3aid.pdb')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='runner_overhead.json',
+                        help='Where to save the results as JSON')
+    parser.add_argument('--compare', default=None,
+                        help='Results file from an earlier run to compare against')
+    args = parser.parse_args()
+
+    with open(PAYLOAD, 'r') as infile:
+        pdbstring = infile.read()
+
+    results = []
+    print('%-12s %6s %10s %5s %11s %11s %11s %12s %12s %9s %10s'
+          % ('shape', 'fanout', 'payload', 'tasks', 'ms/task', 'job ms/task', 'ckpt ms/task',
+             'ckpt bytes', 'dill bytes', 'restart', 'write MB/s'))
+    for shape in args.shapes:
+        for fanout in args.fanouts:
+            for scale in args.scales:
+                repeats = []
+                for i in xrange(args.repeat):
+                    workdir = tempfile.mkdtemp(prefix='chemworkflows-bench.')
+                    try:
+                        repeats.append(measure(shape, fanout, pdbstring * scale, workdir))
+                    finally:
+                        shutil.rmtree(workdir)
+                result = median_result(repeats)
+                results.append(result)
+                print('%-12s %6d %10d %5d %11.3f %11.3f %11.3f %12d %12s %8.3fs %10.1f'
+                      % (shape, fanout, result['payload_bytes'], result['tasks'],
+                         result['overhead_ms_per_task'], result['engine_ms_per_task'],
+                         result['checkpointed_ms_per_task'],
+                         result['checkpoint_bytes'], result['legacy_state_bytes'],
+                         result['restart_s'], result['write_outputs_mb_s']))
+
+    with open(args.output, 'w') as outfile:
+        json.dump({'revision': git_revision(),
+                   'python': sys.version.split()[0],
+                   'time': time.time(),
+                   'results': results}, outfile, indent=2)
+    print('\nResults written to %s' % args.output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
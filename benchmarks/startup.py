@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+""" Measure how long the ``chemworkflow`` CLI takes to start.
+
+Times ``chemworkflow --help`` (with interpreter startup subtracted) and exits with an error
+if the median exceeds the budget.
+
+    USAGE: python benchmarks/startup.py [--budget SECONDS] [--repeat N]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+HELP = ("import sys; sys.argv = ['chemworkflow', '--help']\n"
+        "from chemworkflows.__main__ import main\n"
+        "try:\n"
+        "    main()\n"
+        "except SystemExit:\n"
+        "    pass\n")
+
+
+def time_command(code, repeat):
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code], stdout=open('/dev/null', 'w'))
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', type=float, default=0.25,
+                        help='Maximum allowed startup time, in seconds')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    baseline = time_command('pass', args.repeat)
+    helptime = time_command(HELP, args.repeat) - baseline
+
+    if args.json:
+        print(json.dumps({'interpreter_s': baseline,
+                          'cli_help_s': helptime,
+                          'budget_s': args.budget}))
+    else:
+        print('Interpreter startup:    %.3f s' % baseline)
+        print('chemworkflow --help:    %.3f s (budget %.3f s)' % (helptime, args.budget))
+
+    if helptime > args.budget:
+        print('FAILED: CLI startup exceeds budget', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
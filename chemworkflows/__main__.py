@@ -1,29 +1,175 @@
 #!/usr/bin/env python
+from __future__ import print_function
 
 import argparse
+import sys
 
-from . import runapp
+# keep imports here light: heavy modules (pyccc, dill, the apps) are only imported
+# once we know what we're running
+from . import batch, cache, ligandlib, structures
 
 
 def main():
+    if sys.argv[1:2] == ['batch']:
+        return batch_main(sys.argv[2:])
+    elif sys.argv[1:2] == ['fetch-structures']:
+        return fetch_structures_main(sys.argv[2:])
+    elif sys.argv[1:2] == ['ligand-library']:
+        return ligand_library_main(sys.argv[2:])
+
     parser = argparse.ArgumentParser()
     parser.add_argument('appname')
     parser.add_argument('inputfile')
-    parser.add_argument('--outputdir', default=None)
-
-    parser.add_argument('--localdocker', action='store_true')
-    parser.add_argument('--here', action='store_true')
     parser.add_argument('--preprocess', action='store_true')
     parser.add_argument('--restart', action='store_true')
     parser.add_argument('--setoutput', nargs='*',
                         help=SETOUTPUTHELP)
     parser.add_argument('--dumptasks', action='store_true')
+    add_execution_args(parser)
 
     args = parser.parse_args()
 
+    from . import runapp
     runapp.main(args)
 
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(prog='chemworkflow batch',
+                                     description=BATCHHELP)
+    parser.add_argument('appname')
+    parser.add_argument('inputfile', help='JSONL file (one input per line) or directory')
+    parser.add_argument('--workers', type=int, default=batch.DEFAULT_WORKERS,
+                        help='Number of inputs to process at the same time')
+    add_execution_args(parser)
+
+    args = parser.parse_args(argv)
+
+    batch.main(args)
+
+
+def fetch_structures_main(argv):
+    parser = argparse.ArgumentParser(prog='chemworkflow fetch-structures',
+                                     description=FETCHHELP)
+    parser.add_argument('store', help='Structure store directory')
+    parser.add_argument('pdbids', nargs='*', help='PDB IDs to download')
+    parser.add_argument('--idfile', default=None,
+                        help='File listing PDB IDs (separated by whitespace or commas)')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Download structures even if they are already stored')
+
+    args = parser.parse_args(argv)
+
+    pdbids = list(args.pdbids)
+    if args.idfile:
+        pdbids.extend(structures.read_id_list(args.idfile))
+    store = structures.StructureStore(args.store)
+    failures = store.preload(pdbids, refresh=args.refresh)
+    if failures:
+        sys.exit('Failed to download %d structures: %s'
+                 % (len(failures), ', '.join(sorted(failures))))
+
+
+def ligand_library_main(argv):
+    parser = argparse.ArgumentParser(prog='chemworkflow ligand-library',
+                                     description=LIGANDLIBHELP)
+    parser.add_argument('action', choices=['export', 'import', 'list'])
+    parser.add_argument('library', help='Ligand library directory')
+    parser.add_argument('archives', nargs='*', help='.tar.gz archive(s) to export to or import')
+
+    args = parser.parse_args(argv)
+
+    library = ligandlib.LigandLibrary(args.library)
+    if args.action == 'list':
+        for key in library.keys():
+            print(key)
+    elif args.action == 'export':
+        if len(args.archives) != 1:
+            parser.error('export takes exactly one archive')
+        library.export(args.archives[0])
+    else:
+        for archive in args.archives:
+            library.import_archive(archive)
+
+
+def add_execution_args(parser):
+    parser.add_argument('--outputdir', default=None)
+    parser.add_argument('--workflow-input', action='append', default=None,
+                        metavar='NAME=JSONFILE',
+                        help="Set one of the workflow's inputs (e.g., minimization_protocol) "
+                             "to the contents of a JSON file (repeatable)")
+    parser.add_argument('--localdocker', action='store_true')
+    parser.add_argument('--no-container-pool', action='store_true',
+                        help='With --localdocker, start a new container for every task '
+                             'instead of reusing warm worker containers')
+    parser.add_argument('--pool-size', type=int, default=None,
+                        help='With --localdocker, maximum number of worker containers per '
+                             'image (default: 2)')
+    parser.add_argument('--pool-idle-timeout', type=float, default=None,
+                        help='With --localdocker, stop worker containers after this many '
+                             'idle seconds (default: 300)')
+    parser.add_argument('--here', action='store_true')
+    parser.add_argument('--hybrid', action='store_true',
+                        help='Run cheap tasks, and tasks that use the local image, in local '
+                             'processes; send only tasks that need other images to the engine')
+    parser.add_argument('--local-image', action='append', default=None, metavar='IMAGE',
+                        help="With --hybrid, also run this image's tasks locally (repeatable; "
+                             "the workflow's default image always runs locally)")
+    parser.add_argument('--local-processes', type=int, default=None,
+                        help='With --hybrid, number of local processes to run tasks in')
+    parser.add_argument('--ligand-library', default=None,
+                        help='Reuse (and save) ligand force field parameters in this directory')
+    parser.add_argument('--artifact-store', default=None,
+                        help='Keep checkpointed task outputs in this content-addressed store, '
+                             'which can be shared between runs (default: inside the '
+                             'checkpoint). With --localdocker, task inputs are also passed '
+                             'through it (default: a temporary directory)')
+    parser.add_argument('--structure-store', default=None,
+                        help='Read PDB IDs from this local structure store instead of the '
+                             'network (see "chemworkflow fetch-structures")')
+    parser.add_argument('--profile', action='store_true',
+                        help='Record per-task timings and data sizes in profile.json, '
+                             'with a timeline in profile.trace.json')
+    parser.add_argument('--max-parallel', type=int, default=None,
+                        help='Maximum number of tasks to run at the same time')
+    parser.add_argument('--cores', type=int, default=None,
+                        help='Number of cores to pack running tasks into (default: all of '
+                             "this machine's when tasks run locally)")
+    parser.add_argument('--memory', default=None,
+                        help="Memory to pack running tasks into, e.g. 64g (default: all of "
+                             "this machine's when tasks run locally)")
+    parser.add_argument('--no-resource-packing', action='store_true',
+                        help="Start tasks without waiting for the cores and memory they "
+                             "declare to be free")
+    parser.add_argument('--output-memory', default=None,
+                        help="Keep at most this much of finished tasks' outputs in memory, "
+                             "e.g. 2g, spilling the rest to disk (default: only spill outputs "
+                             "that no remaining task needs)")
+    parser.add_argument('--no-spill', action='store_true',
+                        help="Keep every task's outputs in memory until the workflow is done")
+    parser.add_argument('--speculate', type=int, default=0, metavar='N',
+                        help='While waiting for a ligand to be chosen, parameterize every '
+                             'candidate ligand in the background, if there are at most N')
+    parser.add_argument('--no-fusion', action='store_true',
+                        help='Run every task as its own job, instead of running chains of '
+                             'cheap tasks that share an image together')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Don't reuse or store results from previous runs")
+    parser.add_argument('--cache-dir', default=None,
+                        help='Task result cache location (default: %s)' % cache.DEFAULT_CACHE_DIR)
+    parser.add_argument('--cache-size', type=float, default=cache.DEFAULT_MAX_BYTES / 1024**3,
+                        help='Maximum size of the result cache, in GB')
+
 SETOUTPUTHELP = ("Set a node's outputs. Used to pass user input from an interactive task."
                  "The outputs must be described in a JSON file, which will be used as "
                  "the node's outputf fields.\n"
                  "   USAGE: --setoutput [taskname1]:[json file1], ...")
+
+BATCHHELP = ("Run an app over many inputs. Each input's outputs are written to its own "
+             "subdirectory of the output directory, and a summary of all of them is written "
+             "to summary.tsv")
+
+FETCHHELP = ("Download PDB entries into a local structure store, for use with "
+             "--structure-store")
+
+LIGANDLIBHELP = ("Manage a ligand parameter library: list its ligands, export it to an archive, "
+                 "or import archives into it")
@@ -6,7 +6,11 @@ ligands
 
 """
 from .. import common, interactive
-from ..common import missing_internal_residues
+from ..common import missing_internal_residues, ligand_residue_groups, ligand_options
+from ..fusion import lightweight
+from ..ligandlib import keyed_by_ligand
+from ..resources import requires
+from ..trajformat import append_frame, finish_trajectory, start_trajectory
 from ..utils import get_asset
 
 from pyccc import workflow
@@ -28,6 +32,22 @@ MDTIMAGE = 'docker.io/avirshup/mst:mdt_subprocess-%s' % _VERSION
 NWCHEMIMAGE = 'docker.io/avirshup/mst:mdt_nwchem-%s' % _VERSION
 MDTAMBERTOOLS = 'docker.io/avirshup/mst:mdt_ambertools-%s' % _VERSION
 
+LIGAND_PH = 7.4
+CHARGE_MODEL = 'am1-bcc'
+
+# The ``minimization_protocol`` input may override any of these:
+MINIMIZATION_PROTOCOL = {
+    'descent_steps': 1000,  # maximum number of gradient descent steps
+    'frame_interval': 250,  # write every Nth descent step as a frame
+    'force_tolerance': None,  # stop the descent once no gradient component exceeds this
+                              # (kcal/mol/angstrom; by default, moldesign's tolerance)
+    'energy_tolerance': None,  # stop the descent once a step changes the energy by less
+                               # than this (kcal/mol; by default, never)
+    'openmm_steps': 500,  # maximum number of steps of the final OpenMM minimization
+}
+
+INPUT_DEFAULTS = {'minimization_protocol': MINIMIZATION_PROTOCOL}
+
 minimization = workflow.Workflow('Refine ligand binding site',
                                  default_docker_image=MDTIMAGE,
                                  metadata=METADATA)
@@ -40,6 +60,7 @@ read_molecule = minimization.task(common.read_molecule,
 
 @minimization.task(mol=read_molecule['mol'],
                    __interactive__=True)
+@lightweight
 def get_ligands(mol):
     """ Return a dict of possible ligands in the molecule.
     dict is of the form {ligand_name: [atom_idx1, atom_idx2, ...], ...}
@@ -47,29 +68,10 @@ def get_ligands(mol):
 
     Ligands can span, at most, 2 different residues
     """
-    ligands = [residue for residue in mol.residues if residue.type == 'unknown']
-
-    found_ligands = {}
-    mv_ligand_strings = {}  # temp - selection strings for molecule viewer
-    for ligand in ligands:
-        bound_residues = list(ligand.bonded_residues)
-
-        if len(bound_residues) == 0:
-            found_ligands[ligand.name] = [atom.index for atom in ligand.atoms]
-            mv_ligand_strings[ligand.name] = ['1.%s.%s-%d'%(ligand.chain.name,
-                                                            ligand.chain.name,
-                                                            ligand.pdbindex)]
-        elif len(bound_residues) == 1:
-            nbr = bound_residues[0]
-            if len(list(nbr.bonded_residues)) != 1:
-                continue
-            else:
-                ligname = '%s - %s' % (ligand.name, nbr.name)
-                found_ligands[ligname] = [atom.idx for atom in ligand.atoms+nbr.atoms]
-                mv_ligand_strings[ligname] = ['1.%s.%s-%d'%(l.chain.name,
-                                                            l.chain.name,
-                                                            l.pdbindex)
-                                              for l in (ligand, nbr)]
+    candidates = [residue.index for residue in mol.residues if residue.type == 'unknown']
+
+    groups = ligand_residue_groups(mol, candidates)
+    found_ligands, mv_ligand_strings = ligand_options(mol, groups)
 
     return {'ligand_options': found_ligands,
             'mv_ligand_strings': mv_ligand_strings}
@@ -80,6 +82,7 @@ def get_ligands(mol):
                    ligands=get_ligands['ligand_options'],
                    mv_ligand_strings=get_ligands['mv_ligand_strings'],
                    __interactive__=True)
+@lightweight
 def validate(mol, ligands, mv_ligand_strings):
     missing = missing_internal_residues(mol)
     all_errors = []
@@ -107,23 +110,30 @@ atomselection = minimization.task(interactive.SelectAtomsFromOptions(),
                                   __interactive__=True)
 
 
-@minimization.task(mol=read_molecule['mol'],
-                   ligand_atom_ids=atomselection['atom_ids'],
-                   ligandname=atomselection['ligandname'],
+protonate_ligand = minimization.task(common.protonate_ligand,
+                                     mol=read_molecule['mol'],
+                                     ligand_atom_ids=atomselection['atom_ids'],
+                                     ligandname=atomselection['ligandname'],
+                                     ph=LIGAND_PH,
+                                     charges=CHARGE_MODEL)
+
+
+@minimization.task(ligand=protonate_ligand['ligand'],
+                   ligand_key=protonate_ligand['ligand_key'],
+                   charges=CHARGE_MODEL,
                    __image__=MDTAMBERTOOLS)
-def prep_ligand(mol, ligand_atom_ids, ligandname):
+@keyed_by_ligand('ligand_key')
+@requires(cores=1, memory='2g')  # antechamber is single-threaded
+def prep_ligand(ligand, ligand_key, charges):
     """
     Create force field parameters for the chosen ligand
     """
     import moldesign as mdt
 
-    print 'Parameterizing ligand "%s"' % ligandname
+    print 'Parameterizing ligand "%s" (%s)' % (ligand.name, ligand_key)
 
-    ligand = mdt.Molecule([mol.atoms[idx] for idx in ligand_atom_ids])
-    ligh = mdt.set_hybridization_and_ph(ligand, 7.4)
-    params = mdt.interfaces.ambertools.parameterize(ligh, charges='am1-bcc')
-    return {'ligand_parameters': params,
-            'ligand': ligh}
+    params = mdt.interfaces.ambertools.parameterize(ligand, charges=charges)
+    return {'ligand_parameters': params}
 
 
 @minimization.task(mol=read_molecule['mol'],
@@ -152,64 +162,156 @@ def prep_forcefield(mol, ligand_atom_ids, ligand_params):
             'inpcrd': withff.ff.amber_params.inpcrd}
 
 
-@minimization.task(mol=prep_forcefield['molecule'])
-def mm_minimization(mol):
+@minimization.task(mol=prep_forcefield['molecule'],
+                   protocol=minimization.input('minimization_protocol'))
+@requires(cores=4, memory='2g')
+def mm_minimization(mol, protocol):
+    """ Relax the complex with a native gradient descent (mostly to provide some intermediate
+    states for animation), then an OpenMM minimization.
+
+    Frames of the descent are written to the outputs as they're produced; see
+    ``MINIMIZATION_PROTOCOL`` for the ``protocol`` settings.
+    """
+    import os
+    import time
     import moldesign as mdt
+    import numpy as np
+    import pyccc
     from moldesign import units as u
 
-    mol.set_energy_model(mdt.models.OpenMMPotential, implicit_solvent='obc')
-
-    # start with a native gradient descent -
-    # mostly to provide some intermediate states for animation
-    traj = mdt.min.gradient_descent(mol, frame_interval=250, nsteps=1000)
-    traj2 = mol.minimize() # native openmm optimization
-    traj.new_frame() # Add final OpenMM state to the native steepest descent trajectory
-
-    results = {'initial_energy': traj.frames[0].potential_energy.to_json(),
-               'final_energy': mol.potential_energy.to_json(),
-               'rmsd': traj.rmsd()[-1].to_json()}
+    unknown = set(protocol or {}).difference(MINIMIZATION_PROTOCOL)
+    if unknown:
+        raise ValueError('Unknown minimization protocol settings: %s'
+                         % ', '.join(sorted(unknown)))
+    protocol = dict(MINIMIZATION_PROTOCOL, **(protocol or {}))
+    if protocol['frame_interval'] < 1:
+        raise ValueError('frame_interval must be at least 1')
 
-    minstep_file, minstep_filenames = _traj_to_tarred_pdbs(traj)
-
-    rmsd_json = traj.rmsd()[-1].to(u.angstrom).to_json()
+    mol.set_energy_model(mdt.models.OpenMMPotential, implicit_solvent='obc')
+    initial_positions = mol.positions.copy()
+    initial_energy = mol.calc_potential_energy()
+
+    trajpath = os.path.abspath('minsteps.ctraj')
+    archivepath = os.path.abspath('minsteps.tar.gz')
+    traj = start_trajectory(trajpath, mol)
+    frames = _start_frame_archive(archivepath)
+    append_frame(traj, mol, initial_energy)
+    _add_frame(frames, mol)
+
+    descent_kwargs = {'nsteps': protocol['descent_steps']}
+    if protocol['force_tolerance'] is not None:
+        descent_kwargs['force_tolerance'] = protocol['force_tolerance'] * u.kcalpermol / u.angstrom
+    if protocol['energy_tolerance'] is not None:
+        energy_tolerance = protocol['energy_tolerance'] * u.kcalpermol
+    else:
+        energy_tolerance = None
+
+    class Converged(Exception):
+        pass
+
+    class StreamingDescent(mdt.min.GradientDescent):
+        """ Writes every ``frame_interval``-th step straight to the outputs instead of
+        keeping a trajectory, and stops once the energy stops changing
+        """
+        previous_energy = None
+
+        def callback(self, *args):
+            self.current_step += 1
+            energy = self._last_energy
+            if self.current_step % protocol['frame_interval'] == 0:
+                print 'Step %d/%d, energy=%s' % (self.current_step, self.nsteps, energy)
+                append_frame(traj, self.mol, energy)
+                _add_frame(frames, self.mol)
+            if (energy_tolerance is not None and self.previous_energy is not None and
+                    abs(energy - self.previous_energy) < energy_tolerance):
+                raise Converged()
+            self.previous_energy = energy
+
+    stats = {'descent_steps': 0, 'descent_converged': False, 'openmm_steps': 0}
+    start = time.time()
+    if protocol['descent_steps'] > 0:
+        descent = StreamingDescent(mol, **descent_kwargs)
+        try:
+            descent.run()
+        except Converged:
+            stats['descent_converged'] = True
+        else:  # the descent returns early once the forces are below its tolerance
+            stats['descent_converged'] = descent.current_step < protocol['descent_steps']
+        stats['descent_steps'] = descent.current_step
+    stats['descent_seconds'] = time.time() - start
+    stats['seconds_per_descent_step'] = stats['descent_seconds'] / max(stats['descent_steps'], 1)
+
+    start = time.time()
+    if protocol['openmm_steps'] > 0:
+        mol.minimize(nsteps=protocol['openmm_steps'])  # native openmm optimization
+        stats['openmm_steps'] = protocol['openmm_steps']  # openmm doesn't report how many it took
+    stats['openmm_seconds'] = time.time() - start
+
+    final_energy = mol.calc_potential_energy()
+    append_frame(traj, mol, final_energy)  # the final state is always the last frame
+    _add_frame(frames, mol)
+    finish_trajectory(traj)
+    frames['tarfile'].close()
+    stats['frames'] = len(frames['names'])
+    stats['protocol'] = protocol
+
+    diff = (mol.positions - initial_positions).value_in(u.angstrom)
+    rmsd = np.sqrt((diff * diff).sum() / mol.num_atoms) * u.angstrom
+
+    results = {'initial_energy': initial_energy.to_json(),
+               'final_energy': final_energy.to_json(),
+               'rmsd': rmsd.defunits().to_json(),
+               'minimization': stats}
+
+    rmsd_json = rmsd.to_json()
     rmsd_json['name'] = 'RMSD'
 
-    stabilized_energy = traj.frames[0].potential_energy.to(u.kcalpermol).to_json()
+    stabilized_energy = initial_energy.to(u.kcalpermol).to_json()
     stabilized_energy['units'] = 'kcal/mol'
     stabilized_energy['name'] = 'Energy stabilization'
 
-    final_energy_json = mol.potential_energy.to(u.kcalpermol).to_json()
+    final_energy_json = final_energy.to(u.kcalpermol).to_json()
     final_energy_json['units'] = 'kcal/mol'
     final_energy_json['name'] = 'Final energy'
 
     results['output_values'] = [final_energy_json, stabilized_energy, rmsd_json]
 
-    return {'trajectory': traj,
-            'molecule': mol,
+    return {'molecule': mol,
             'pdbstring': mol.write(format='pdb'),
             'results': results,
-            'minstep_frames': minstep_filenames,
-            'minsteps.tar.gz': minstep_file}
+            'minstep_frames': frames['names'],
+            'minsteps.tar.gz': pyccc.LocalFile(archivepath),
+            'minsteps.ctraj': pyccc.LocalFile(trajpath)}
 
 minimization.set_outputs(**{'prmtop': prep_forcefield['prmtop'],
                             'inpcrd': prep_forcefield['inpcrd'],
                             'results': mm_minimization['results'],
                             'final_structure.pdb': mm_minimization['pdbstring'],
                             'minsteps.tar.gz': mm_minimization['minsteps.tar.gz'],
-                            'minstep_frames': mm_minimization['minstep_frames']
+                            'minstep_frames': mm_minimization['minstep_frames'],
+                            'minsteps.ctraj': mm_minimization['minsteps.ctraj']
                             })
 
 
-def _traj_to_tarred_pdbs(traj):
-    """ Quick hack to create a tarfile with frames from a trajectory
+def _start_frame_archive(filename):
+    """ Open a gzipped tarball to add PDB files of minimization frames to as they're produced
     """
-    import os, pyccc
+    import tarfile
 
-    minstep_filenames = []
-    for i, frame in enumerate(traj.frames):
-        fname = 'minstep.%d.pdb' % i
-        frame.write(fname)
-        minstep_filenames.append(fname)
+    return {'tarfile': tarfile.open(filename, 'w:gz'), 'names': []}
 
-    os.system('tar czvf minsteps.tar.gz %s' % ' '.join(minstep_filenames))
-    return pyccc.LocalFile('minsteps.tar.gz'), minstep_filenames
+
+def _add_frame(archive, mol):
+    """ Add the molecule's current structure to the frame archive as ``minstep.N.pdb``
+    """
+    import tarfile
+    import time
+    from StringIO import StringIO
+
+    name = 'minstep.%d.pdb' % len(archive['names'])
+    pdbstring = mol.write(format='pdb')
+    info = tarfile.TarInfo(name)
+    info.size = len(pdbstring)
+    info.mtime = time.time()
+    archive['tarfile'].addfile(info, StringIO(pdbstring))
+    archive['names'].append(name)
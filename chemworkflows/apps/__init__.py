@@ -0,0 +1,53 @@
+""" Workflow apps, looked up by name.
+
+Apps are registered as entry points in the ``chemworkflows.apps`` group, each naming a
+``pyccc.workflow.Workflow`` object. An app's module (and everything it imports) is only
+loaded when that app is selected.
+"""
+import importlib
+
+ENTRY_POINT_GROUP = 'chemworkflows.apps'
+
+# Apps that ship with this package. These are also registered as entry points in setup.py,
+# but are looked up here first so that running them doesn't require scanning installed
+# distributions (or installing the package at all)
+BUILTIN_APPS = {'minimize': 'chemworkflows.apps.MMminimize:minimization',
+                'vde': 'chemworkflows.apps.vde:vde',
+                'setuplammps': 'chemworkflows.apps.simsetup:simsetup'}
+
+
+def get_app(name):
+    """ Import and return the workflow for the named app
+    """
+    if name in BUILTIN_APPS:
+        modname, attr = BUILTIN_APPS[name].split(':')
+        return getattr(importlib.import_module(modname), attr)
+
+    for entrypoint in _entry_points():
+        if entrypoint.name == name:
+            return entrypoint.load()
+
+    raise ValueError('Unknown app "%s". Available apps: %s'
+                     % (name, ', '.join(sorted(app_names()))))
+
+
+def default_inputs(name):
+    """ Values for the named app's workflow inputs that don't have to be supplied, from the
+    ``INPUT_DEFAULTS`` dict in its module (if there is one)
+    """
+    if name in BUILTIN_APPS:
+        modname = BUILTIN_APPS[name].split(':')[0]
+    else:
+        modname, = [ep.module_name for ep in _entry_points() if ep.name == name]
+    return dict(getattr(importlib.import_module(modname), 'INPUT_DEFAULTS', {}))
+
+
+def app_names():
+    """ Names of all available apps (without importing them)
+    """
+    return set(BUILTIN_APPS).union(ep.name for ep in _entry_points())
+
+
+def _entry_points():
+    import pkg_resources
+    return pkg_resources.iter_entry_points(ENTRY_POINT_GROUP)
@@ -6,7 +6,10 @@ ligands
 
 """
 from .. import common, interactive
-from ..common import missing_internal_residues
+from ..common import missing_internal_residues, ligand_residue_groups, ligand_options
+from ..fusion import lightweight
+from ..ligandlib import keyed_by_ligand
+from ..resources import requires
 
 from pyccc import workflow
 
@@ -15,6 +18,9 @@ MDTIMAGE = 'docker.io/avirshup/mst:mdt_subprocess-%s' % _VERSION
 MDTAMBERTOOLS = 'docker.io/avirshup/mst:mdt_ambertools-%s' % _VERSION
 MDTLAMMPS = 'docker.io/avirshup/mst:mdt_lammps-%s' % _VERSION
 
+LIGAND_PH = 7.4
+CHARGE_MODEL = 'gasteiger'
+
 simsetup = workflow.Workflow('Set up a simulation',
                              default_docker_image=MDTIMAGE)
 
@@ -25,6 +31,7 @@ read_molecule = simsetup.task(common.read_molecule,
 
 @simsetup.task(mol=read_molecule['mol'],
                __interactive__=True)
+@lightweight
 def get_ligands(mol):
     """ Return a dict of possible ligands in the molecule.
     dict is of the form {ligand_name: [atom_idx1, atom_idx2, ...], ...}
@@ -33,31 +40,12 @@ def get_ligands(mol):
     Ligands can span, at most, 2 different residues
     """
     if mol.num_residues == 1:
-        ligands = [mol.residues[0]]
+        candidates = [0]
     else:
-        ligands = [residue for residue in mol.residues if residue.type == 'unknown']
-
-    found_ligands = {}
-    mv_ligand_strings = {}  # temp - selection strings for molecule viewer
-    for ligand in ligands:
-        bound_residues = list(ligand.bonded_residues)
-
-        if len(bound_residues) == 0:
-            found_ligands[ligand.name] = [atom.index for atom in ligand.atoms]
-            mv_ligand_strings[ligand.name] = ['1.%s.%s-%s'%(ligand.chain.name,
-                                                            ligand.chain.name,
-                                                            ligand.pdbindex)]
-        elif len(bound_residues) == 1:
-            nbr = bound_residues[0]
-            if len(list(nbr.bonded_residues)) != 1:
-                continue
-            else:
-                ligname = '%s - %s' % (ligand.name, nbr.name)
-                found_ligands[ligname] = [atom.idx for atom in ligand.atoms+nbr.atoms]
-                mv_ligand_strings[ligname] = ['1.%s.%s-%s'%(l.chain.name,
-                                                            l.chain.name,
-                                                            l.pdbindex)
-                                              for l in (ligand, nbr)]
+        candidates = [residue.index for residue in mol.residues if residue.type == 'unknown']
+
+    groups = ligand_residue_groups(mol, candidates)
+    found_ligands, mv_ligand_strings = ligand_options(mol, groups)
 
     return {'ligand_options': found_ligands,
             'mv_ligand_strings': mv_ligand_strings}
@@ -67,6 +55,7 @@ def get_ligands(mol):
 @simsetup.task(mol=read_molecule['mol'],
                ligands=get_ligands['ligand_options'],
                __interactive__=True)
+@lightweight
 def validate(mol, ligands):
     return {'success': True,
             'errors': ''}
@@ -78,27 +67,34 @@ atomselection = simsetup.task(interactive.SelectAtomsFromOptions(),
                               __interactive__=True)
 
 
-@simsetup.task(mol=read_molecule['mol'],
-               ligand_atom_ids=atomselection['atom_ids'],
-               ligandname=atomselection['ligandname'],
+protonate_ligand = simsetup.task(common.protonate_ligand,
+                                 mol=read_molecule['mol'],
+                                 ligand_atom_ids=atomselection['atom_ids'],
+                                 ligandname=atomselection['ligandname'],
+                                 ph=LIGAND_PH,
+                                 charges=CHARGE_MODEL)
+
+
+@simsetup.task(ligand=protonate_ligand['ligand'],
+               ligand_key=protonate_ligand['ligand_key'],
+               charges=CHARGE_MODEL,
                __image__=MDTAMBERTOOLS)
-def prep_ligand(mol, ligand_atom_ids, ligandname):
+@keyed_by_ligand('ligand_key')
+@requires(cores=1, memory='2g')  # antechamber is single-threaded
+def prep_ligand(ligand, ligand_key, charges):
     """
     Create force field parameters for the chosen ligand
     """
     import moldesign as mdt
 
-    print 'Parameterizing ligand "%s"' % ligandname
+    print 'Parameterizing ligand "%s" (%s)' % (ligand.name, ligand_key)
 
-    ligand = mdt.Molecule([mol.atoms[idx] for idx in ligand_atom_ids])
-    ligh = mdt.set_hybridization_and_ph(ligand, 7.4)
-    params = mdt.interfaces.ambertools.parameterize(ligh, charges='gasteiger')
-    return {'ligand_parameters': params,
-            'ligand': ligh}
+    params = mdt.interfaces.ambertools.parameterize(ligand, charges=charges)
+    return {'ligand_parameters': params}
 
 
 @simsetup.task(mol=read_molecule['mol'],
-               ligmol=prep_ligand['ligand'],
+               ligmol=protonate_ligand['ligand'],
                ligand_atom_ids=atomselection['atom_ids'],
                ligand_params=prep_ligand['ligand_parameters'],
                __image__=MDTAMBERTOOLS)
@@ -5,6 +5,8 @@ Calculate the vertical detachment energy of an open shell, anionic species.
 """
 
 from .. import common
+from ..fusion import lightweight
+from ..resources import requires
 from ..utils import get_asset
 
 from pyccc import workflow
@@ -38,6 +40,7 @@ read_molecule = vde.task(common.read_molecule,
 @vde.preprocessor
 @vde.task(mol=read_molecule['mol'],
           __interactive__=True)
+@lightweight
 def validate(mol):
     from moldesign import units as u
 
@@ -68,8 +71,14 @@ def validate(mol):
 @vde.task(__image__=NWCHEMIMAGE,
           mol=read_molecule['mol'],
           nsteps=50)
+@requires(cores=8, memory='4g')
 def minimize_doublet(mol, nsteps=None):
+    """ Minimize the anion, and keep the orbitals of its last SCF (NWChem's movecs file) to
+    start the singlet from
+    """
+    import os
     import moldesign as mdt
+    import pyccc
     mol.charge = -1 * mdt.units.q_e
     params = dict(theory='uks',
                   functional='b3lyp',
@@ -78,15 +87,48 @@ def minimize_doublet(mol, nsteps=None):
                   multiplicity=2)
     mol.set_energy_model(mdt.models.NWChemQM,
                          **params)
-    traj = mol.minimize(nsteps=nsteps)
+
+    # this is what mol.minimize does for NWChem, but it keeps the job to get its files from
+    make_job = getattr(mol.energy_model, '_make_minimization_job', None)
+    if make_job is None:
+        traj, job = mol.minimize(nsteps=nsteps), None
+    else:
+        job = mdt.compute.run_job(make_job(nsteps))
+        traj = job.result
+
+    movecs, iterations = None, None
+    if job is not None:
+        try:
+            outputs = job.get_output()
+            vectors = sorted(name for name in outputs if name.endswith('.movecs'))
+            if vectors:
+                outputs[vectors[-1]].put('doublet.movecs')
+                movecs = pyccc.LocalFile(os.path.abspath('doublet.movecs'))
+            else:
+                print 'The doublet job wrote no movecs file; the singlet will use the default guess'
+            counts = scf_iterations(nwchem_output(job))
+            iterations = counts[-1] if counts else None
+        except Exception as e:
+            print 'Failed to read the doublet job\'s orbitals or output:', e
+
     return {'traj': traj,
             'mol': mol,
+            'movecs': movecs,
+            'scf_iterations': iterations,
             'pdbstring':mol.write(format='pdb')}
 
 
 @vde.task(__image__=NWCHEMIMAGE,
-          mol=minimize_doublet['mol'])
-def single_point_singlet(mol):
+          mol=minimize_doublet['mol'],
+          doublet_movecs=minimize_doublet['movecs'])
+@requires(cores=8, memory='4g')
+def single_point_singlet(mol, doublet_movecs=None):
+    """ Singlet energy at the doublet geometry, starting from the doublet's orbitals
+
+    NWChem is run directly (moldesign's NWChem model has no way to pass in a starting
+    guess), with a ``vectors input`` directive. If that fails or doesn't converge, this
+    falls back to moldesign's NWChem model with its default guess.
+    """
     import moldesign as mdt
     from moldesign import units as u
 
@@ -94,15 +136,132 @@ def single_point_singlet(mol):
     params = dict(theory='rks',
                   functional='b3lyp',
                   basis='6-31g')
-    mol.set_energy_model(mdt.models.NWChemQM,
-                         **params)
-    mol.calculate()
-    return {'mol': mol}
+
+    guess, iterations = None, None
+    if doublet_movecs is not None:
+        doublet_movecs.put('doublet.movecs')
+        try:
+            energy, output = run_nwchem_singlet(mol, 'doublet.movecs')
+        except Exception as e:
+            print 'Singlet SCF failed from the doublet orbitals (%s); using the default guess' % e
+        else:
+            mol.properties = mdt.MolecularProperties(mol, potential_energy=energy)
+            counts = scf_iterations(output)
+            iterations = counts[-1] if counts else None
+            guess = 'doublet'
+
+    if guess is None:
+        mol.set_energy_model(mdt.models.NWChemQM,
+                             **params)
+        make_job = getattr(mol.energy_model, '_make_calculation_job', None)
+        if make_job is None:
+            mol.calculate()
+        else:  # as mol.calculate does, but keeping the job to count SCF iterations
+            job = mdt.compute.run_job(make_job(mol.energy_model.DEFAULT_PROPERTIES))
+            mol.properties = job.result
+            counts = scf_iterations(nwchem_output(job))
+            iterations = counts[-1] if counts else None
+        guess = 'default'
+
+    return {'mol': mol,
+            'scf_iterations': iterations,
+            'initial_guess': guess}
+
+
+def run_nwchem_singlet(mol, movecs):
+    """ Closed-shell B3LYP/6-31G single point with NWChem, starting from the orbitals in
+    ``movecs`` (the doublet anion's, at the same geometry)
+
+    For the neutral singlet, NWChem fills the lowest N/2 orbitals of the guess, so the
+    anion's SOMO is left empty; at the anion's geometry, its remaining occupied orbitals
+    are close to the neutral's. Whether this converges in fewer iterations is what the
+    ``scf_iterations`` results report.
+
+    Returns:
+        moldesign.units.Scalar[energy]: the SCF energy
+        str: NWChem's output
+
+    Raises:
+        ValueError: if NWChem failed or the SCF didn't converge
+    """
+    import distutils.spawn
+    import os
+    import re
+    import subprocess
+    from moldesign import units as u
+
+    lines = ['start singlet',
+             'charge 0',
+             'geometry units angstroms',
+             '  symmetry c1']
+    for atom in mol.atoms:
+        x, y, z = atom.position.value_in(u.angstrom)
+        lines.append('  %s %20.12f %20.12f %20.12f' % (atom.element, x, y, z))
+    lines += ['end',
+              'basis',
+              '  * library 6-31g',
+              'end',
+              'dft',
+              '  xc b3lyp',
+              '  mult 1',
+              '  iterations 100',
+              '  vectors input %s output singlet.movecs' % movecs,
+              'end',
+              'task dft energy']
+    with open('singlet.nw', 'w') as infile:
+        infile.write('\n'.join(lines) + '\n')
+
+    command = ['nwchem', 'singlet.nw']
+    cores = int(os.environ.get('CHEMWORKFLOWS_CORES', '1'))
+    if cores > 1 and distutils.spawn.find_executable('mpirun'):
+        command = ['mpirun', '-np', str(cores)] + command
+    with open('singlet.out', 'w') as outfile:
+        returncode = subprocess.call(command, stdout=outfile, stderr=subprocess.STDOUT)
+    with open('singlet.out') as outfile:
+        output = outfile.read()
+
+    energies = re.findall(r'Total DFT energy\s*=\s*(-?\d+\.\d+)', output)
+    if returncode != 0 or 'failed to converge' in output.lower() or not energies:
+        raise ValueError('NWChem exited with status %d%s' % (
+            returncode, '' if energies else ' and reported no energy'))
+    return float(energies[-1]) * u.hartree, output
+
+
+def nwchem_output(job):
+    """ NWChem's output from a moldesign NWChem job: any ``*.out`` files it wrote, or else
+    its stdout
+    """
+    outputs = job.get_output()
+    logs = sorted(name for name in outputs if name.endswith('.out'))
+    if logs:
+        return '\n'.join(outputs[name].read() for name in logs)
+    return job.stdout
+
+
+def scf_iterations(output):
+    """ Number of iterations of each SCF in NWChem's DFT output, in order
+    """
+    import re
+
+    counts = []
+    previous = None
+    for match in re.finditer(r'^\s*d=\s*\d+,ls=[\d.]+,\w+\s+(\d+)\s', output, re.MULTILINE):
+        iteration = int(match.group(1))
+        if previous is None or iteration <= previous:  # a new SCF
+            counts.append(0)
+        counts[-1] = max(counts[-1], iteration)
+        previous = iteration
+    return counts
 
 
 @vde.task(doublet=minimize_doublet['mol'],
-          singlet=single_point_singlet['mol'])
-def get_results(singlet, doublet):
+          singlet=single_point_singlet['mol'],
+          doublet_iterations=minimize_doublet['scf_iterations'],
+          singlet_iterations=single_point_singlet['scf_iterations'],
+          singlet_guess=single_point_singlet['initial_guess'])
+@lightweight
+def get_results(singlet, doublet, doublet_iterations=None, singlet_iterations=None,
+                singlet_guess=None):
     from moldesign import units as u
     vde = singlet.potential_energy - doublet.potential_energy
     vde_json = vde.to(u.eV).to_json()
@@ -110,6 +269,9 @@ def get_results(singlet, doublet):
     results = {'vde': (vde).to(u.eV).to_json(),
                'singlet_energy': singlet.potential_energy.to(u.eV).to_json(),
                'doublet_energy': doublet.potential_energy.to(u.eV).to_json(),
+               'scf_iterations': {'doublet_final_step': doublet_iterations,
+                                  'singlet': singlet_iterations,
+                                  'singlet_initial_guess': singlet_guess},
                'output_values': [vde_json]}
     return {'results': results}
 
@@ -0,0 +1,201 @@
+""" A content-addressed store for task outputs.
+
+Each distinct value is serialized once and stored under the SHA-256 of its bytes, so
+outputs that are identical - within one run, or across every run sharing the store - are
+kept (and copied) only once::
+
+    artifacts/
+        3f/3f9a...e1.dill      a pickled output
+        5b/5b21...0c.cwmol     a moldesign Molecule, in the compact ``molformat`` format
+        a0/a07c...42.file      an output that is a file reference, copied locally
+
+An artifact is identified by a small dict, ``{'sha256': ..., 'kind': 'dill', 'cwmol' or
+'file', 'bytes': ...}``, that is cheap to record and to pass around in place of the value
+itself.
+Files are written to a temporary name and renamed into place, so a store can be shared by
+concurrent runs.
+"""
+from __future__ import print_function
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+from . import molformat
+from .utils import human_bytes
+
+HASH_CHUNK = 1024**2
+
+
+class ArtifactStore(object):
+    """ Directory of content-addressed task outputs.
+
+    ``stats`` counts what this instance has stored: open one instance per run to get
+    per-run statistics, even if the directory is shared.
+
+    Args:
+        directory (str): location of the store (created if necessary)
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:  # created by another process in the meantime
+                if not os.path.isdir(self.directory):
+                    raise
+        self.stats = {'artifacts': 0, 'references': 0,
+                      'bytes_stored': 0, 'bytes_deduplicated': 0}
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def path(self, artifact):
+        sha = artifact['sha256']
+        return os.path.join(self.directory, sha[:2], '%s.%s' % (sha, artifact['kind']))
+
+    def __contains__(self, artifact):
+        return os.path.exists(self.path(artifact))
+
+    def put(self, value, pickled=False):
+        """ Store a value (or a file reference) if it isn't stored already
+
+        Args:
+            value (object): the value
+            pickled (bool): pickle even a moldesign Molecule, for readers that don't have
+                ``molformat``
+
+        Returns:
+            dict: the artifact's identifier
+        """
+        import dill
+
+        if is_file_reference(value) or (not pickled and molformat.is_plain_molecule(value)):
+            data = None
+        else:  # hash in memory, so duplicates are never written at all
+            data = dill.dumps(value, protocol=dill.HIGHEST_PROTOCOL)
+            artifact = {'sha256': hashlib.sha256(data).hexdigest(),
+                        'kind': 'dill',
+                        'bytes': len(data)}
+            if artifact in self:
+                self._count(artifact, stored=False)
+                return artifact
+
+        fd, tmppath = tempfile.mkstemp(dir=self.directory, prefix='.tmp.')
+        try:
+            if data is None:
+                os.close(fd)
+                if is_file_reference(value):
+                    value.put(tmppath)
+                    kind = 'file'
+                else:
+                    molformat.write_molecule(value, tmppath)
+                    kind = 'cwmol'
+                artifact = {'sha256': file_digest(tmppath),
+                            'kind': kind,
+                            'bytes': os.path.getsize(tmppath)}
+            else:
+                with os.fdopen(fd, 'wb') as outfile:
+                    outfile.write(data)
+            self._add(artifact, tmppath)
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+        return artifact
+
+    def reference(self, artifact):
+        """ Count another use of an artifact that has already been stored
+        """
+        self._count(artifact, stored=False)
+
+    def get(self, artifact):
+        """ Load a stored value; file artifacts are returned as ``pyccc.LocalFile`` objects
+        """
+        import dill
+        import pyccc
+
+        path = self.path(artifact)
+        if artifact['kind'] == 'file':
+            return pyccc.LocalFile(path)
+        elif artifact['kind'] == 'cwmol':
+            return molformat.read_molecule(path)
+        with open(path, 'rb') as infile:
+            return dill.load(infile)
+
+    def copy_from(self, other, artifact):
+        """ Add an artifact from another store (hard-linked when possible)
+        """
+        if other.directory == self.directory:
+            self._count(artifact, stored=False)
+            return
+        fd, tmppath = tempfile.mkstemp(dir=self.directory, prefix='.tmp.')
+        os.close(fd)
+        os.remove(tmppath)
+        try:
+            try:
+                os.link(other.path(artifact), tmppath)
+            except OSError:  # e.g., a different filesystem
+                shutil.copy(other.path(artifact), tmppath)
+            self._add(artifact, tmppath)
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+
+    def summary(self):
+        return ('%d outputs stored as %d distinct artifacts: %s written, %s deduplicated'
+                % (self.stats['references'], self.stats['artifacts'],
+                   human_bytes(self.stats['bytes_stored']),
+                   human_bytes(self.stats['bytes_deduplicated'])))
+
+    def _add(self, artifact, tmppath):
+        dest = self.path(artifact)
+        if os.path.exists(dest):
+            self._count(artifact, stored=False)
+            return
+        if not os.path.isdir(os.path.dirname(dest)):
+            try:
+                os.makedirs(os.path.dirname(dest))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(dest)):
+                    raise
+        os.rename(tmppath, dest)
+        self._count(artifact, stored=True)
+
+    def _count(self, artifact, stored):
+        with self._lock:
+            self.stats['references'] += 1
+            if artifact['sha256'] not in self._seen:
+                self._seen.add(artifact['sha256'])
+                self.stats['artifacts'] += 1
+            if stored:
+                self.stats['bytes_stored'] += artifact['bytes']
+            else:
+                self.stats['bytes_deduplicated'] += artifact['bytes']
+
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(HASH_CHUNK), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def is_file_reference(value):
+    """ True for file references like ``pyccc.LocalFile`` (numpy arrays also have a ``put``
+    method, but are pickled like any other value)
+    """
+    numpy = sys.modules.get('numpy')
+    return (hasattr(value, 'put') and
+            not (numpy is not None and isinstance(value, numpy.ndarray)))
@@ -0,0 +1,157 @@
+""" Run one app over many inputs in a single process.
+
+Inputs come from a JSONL file (one ``molecule_json`` description per line) or from a
+directory (one input file per entry, read just like the ``inputfile`` argument of a
+single run). Each input gets its own runner and its own output subdirectory; all of them
+share the engine, the result cache, a limit on the total number of running tasks, the
+budget for keeping finished tasks' outputs in memory and (on a CCC server) the tracker
+that polls the status of every job. Peak memory is that of the whole
+process when each run finished.
+"""
+from __future__ import print_function
+
+import functools
+import json
+import os
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from .apps import get_app
+from .utils import pflush
+
+DEFAULT_WORKERS = 8
+
+
+def main(args):
+    from . import runapp, runners, spill
+
+    rootdir = runapp.make_output_dir(args)
+    inputs = read_batch_inputs(args.inputfile)
+    app = get_app(args.appname)
+    engine, RunnerClass = runapp.get_execution_env(args)
+    cache = runapp.get_cache(args)
+    ligand_library = runapp.get_ligand_library(args)
+    resource_pool = runapp.get_resource_pool(args)  # shared, so runs don't oversubscribe
+    spiller = runapp.get_spiller(args)  # shared, so --output-memory holds for all runs
+    job_tracker = runapp.get_job_tracker(engine)  # shared, so one thread polls every job
+    slots = threading.BoundedSemaphore(args.max_parallel or runners.DEFAULT_MAX_PARALLEL)
+
+    def run_one(item):
+        name, load_input = item
+        outdir = os.path.join(rootdir, name)
+        record = {'name': name, 'outputdir': outdir}
+        start = time.time()
+        try:
+            os.mkdir(outdir)
+            inputjson = runapp.localize_input(load_input(), args)
+            runner = RunnerClass(app,
+                                 engine=engine,
+                                 max_parallel=args.max_parallel,
+                                 fuse_tasks=not args.no_fusion,
+                                 slots=slots,
+                                 resources=resource_pool,
+                                 spiller=spiller,
+                                 cache=cache,
+                                 ligand_library=ligand_library,
+                                 **runapp.workflow_inputs(args, inputjson))
+            runapp.attach_checkpoint(runner, args.appname, outdir, args.artifact_store)
+            runapp.attach_profiler(runner, args)
+            runapp.attach_job_tracker(runner, job_tracker)
+            runapp.configure_local_tasks(runner, args)
+            runapp.run_workflow(runner, outdir)
+            record['values'] = summary_values(runner)
+            record['artifacts'] = runner.checkpoint.artifacts.stats
+            if getattr(runner, 'reference_store', None) is not None:
+                record['input_references'] = runner.reference_store.stats
+            record['memory'] = spill.memory_summary(runner)
+        except Exception as exc:
+            record['status'] = 'failed'
+            record['error'] = '%s: %s' % (exc.__class__.__name__, exc)
+            if os.path.isdir(outdir):
+                with open(os.path.join(outdir, 'error.txt'), 'w') as errfile:
+                    traceback.print_exc(file=errfile)
+        else:
+            record['status'] = 'success'
+        record['elapsed'] = time.time() - start
+        return record
+
+    pflush('Running %d inputs with %d workers' % (len(inputs), args.workers))
+    records = []
+    pool = ThreadPool(args.workers)
+    with open(os.path.join(rootdir, 'summary.jsonl'), 'w') as logfile:
+        for record in pool.imap_unordered(run_one, inputs):
+            pflush('[%d/%d] %s: %s' % (len(records) + 1, len(inputs),
+                                       record['name'], record['status']))
+            print(json.dumps(record), file=logfile)
+            logfile.flush()
+            records.append(record)
+    pool.close()
+
+    records.sort(key=lambda r: r['name'])
+    write_summary_table(records, os.path.join(rootdir, 'summary.tsv'))
+
+    nfailed = sum(1 for r in records if r['status'] != 'success')
+    pflush('\nBatch complete: %d succeeded, %d failed. Summary: %s'
+           % (len(records) - nfailed, nfailed, os.path.join(rootdir, 'summary.tsv')))
+
+
+def read_batch_inputs(path):
+    """ Returns a list of ``(name, load)`` pairs from a JSONL file or a directory, where
+    ``load()`` returns the input's ``molecule_json``. Inputs are only parsed when they run,
+    so that a malformed one fails on its own instead of stopping the batch.
+    """
+    from . import runapp
+
+    inputs = []
+    if os.path.isdir(path):
+        for filename in sorted(os.listdir(path)):
+            if filename.startswith('.'):
+                continue
+            inputs.append((filename, functools.partial(runapp.process_input_file,
+                                                       os.path.join(path, filename))))
+    else:
+        with open(path, 'r') as infile:
+            for iline, line in enumerate(infile):
+                if line.strip():
+                    inputs.append(('input.%06d' % iline, functools.partial(json.loads, line)))
+    return inputs
+
+
+def summary_values(runner):
+    """ Collect the ``output_values`` from a finished workflow's ``results`` output
+
+    Returns:
+        dict: mapping of column title to value, e.g. ``{'VDE (eV)': 2.13}``
+    """
+    if 'results' not in runner.outputfields:
+        return {}
+
+    values = {}
+    for item in runner.getoutput('results').get('output_values', []):
+        title = item['name']
+        if item.get('units'):
+            title += ' (%s)' % item['units']
+        values[title] = item.get('value', item.get('magnitude'))
+    return values
+
+
+def write_summary_table(records, path):
+    columns = []
+    for record in records:
+        for title in record.get('values', {}):
+            if title not in columns:
+                columns.append(title)
+
+    with open(path, 'w') as outfile:
+        print('\t'.join(['name', 'status', 'elapsed_s', 'peak_rss_mb'] + columns + ['error']),
+              file=outfile)
+        for record in records:
+            values = record.get('values', {})
+            memory = record.get('memory')
+            row = [record['name'], record['status'], '%.1f' % record['elapsed'],
+                   '%d' % (memory['peak_rss_bytes'] // 1024**2) if memory else '']
+            row.extend(str(values.get(title, '')) for title in columns)
+            row.append(' '.join(record.get('error', '').split()))  # no tabs or newlines
+            print('\t'.join(row), file=outfile)
@@ -0,0 +1,198 @@
+""" On-disk cache of task results, shared between workflow runs.
+
+Each entry is a directory named by the task's cache key, holding a dill pickle of the
+task's outputs. Outputs that are file references (see ``artifacts.is_file_reference``) are
+copied into the entry directory and come back as ``pyccc.LocalFile`` objects, so cached
+results don't depend on containers or jobs that may no longer exist.
+
+Entries are written to a temporary directory and renamed into place, so several processes
+can share one cache directory. When the cache grows past ``max_bytes``, the least recently
+used entries are deleted. File outputs are copied out of their entry when it's loaded, so
+deleting it doesn't affect results that are already in use.
+"""
+from __future__ import print_function
+
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from .artifacts import is_file_reference
+from .fusion import function_source
+
+DEFAULT_CACHE_DIR = os.path.join('~', '.chemworkflows', 'cache')
+DEFAULT_MAX_BYTES = 10 * 1024**3
+_OUTPUTS = 'outputs.dill'
+
+
+def digest(value):
+    """ A stable hash of a value, preferring its canonical JSON form
+    """
+    import dill
+
+    try:
+        serialized = json.dumps(value, sort_keys=True)
+    except (TypeError, ValueError):
+        serialized = dill.dumps(value)
+    return hashlib.sha256(serialized).hexdigest()
+
+
+def function_digest(func):
+    """ Hash of a task function's source code, with the sources of the global functions it
+    calls (see ``fusion.function_source``) - or, failing that, its pickle
+    """
+    try:
+        source = function_source(func)['source']
+    except (IOError, TypeError):
+        return digest(func)
+    else:
+        return hashlib.sha256(source).hexdigest()
+
+
+class ResultCache(object):
+    """ A size-limited, least-recently-used store of task outputs
+
+    Args:
+        directory (str): where to store the cache (default: ``~/.chemworkflows/cache``)
+        max_bytes (int): the cache is pruned to this size whenever a write takes it past
+            this size
+    """
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = os.path.abspath(os.path.expanduser(directory or DEFAULT_CACHE_DIR))
+        self.max_bytes = max_bytes
+        self._total = None  # size as of the last scan, plus what this process stored since
+        self._loaded = None  # copies of loaded file outputs
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:  # created by another process in the meantime
+                if not os.path.isdir(self.directory):
+                    raise
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        state['_loaded'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self.directory, key, _OUTPUTS))
+
+    def load(self, key):
+        """ Return the cached outputs for ``key``, or None if there aren't any
+        """
+        import dill
+        import pyccc
+
+        entry = os.path.join(self.directory, key)
+        copydir = None
+        try:
+            with open(os.path.join(entry, _OUTPUTS), 'rb') as infile:
+                outputs = dill.load(infile)
+            os.utime(os.path.join(entry, _OUTPUTS), None)  # mark as recently used
+
+            for field, value in outputs.iteritems():
+                if isinstance(value, _StoredFile):
+                    if copydir is None:
+                        copydir = tempfile.mkdtemp(dir=self._loaded_dir(), prefix=key[:16])
+                    path = os.path.join(copydir, value.filename)
+                    shutil.copyfile(os.path.join(entry, value.filename), path)
+                    outputs[field] = pyccc.LocalFile(path)
+        except (IOError, OSError, EOFError):  # missing, or evicted while we were reading
+            if copydir is not None:
+                shutil.rmtree(copydir, ignore_errors=True)
+            return None
+        return outputs
+
+    def _loaded_dir(self):
+        """ Temporary directory (removed at exit) for copies of loaded file outputs
+        """
+        with self._lock:
+            if self._loaded is None:
+                self._loaded = tempfile.mkdtemp(prefix='chemworkflows-cached.')
+                atexit.register(shutil.rmtree, self._loaded, True)
+            return self._loaded
+
+    def store(self, key, outputs):
+        """ Add a task's outputs (a dict) to the cache
+        """
+        import dill
+
+        if key in self:
+            return
+
+        tmpdir = tempfile.mkdtemp(dir=self.directory, prefix='.tmp.')
+        try:
+            tostore = {}
+            for i, (field, value) in enumerate(outputs.iteritems()):
+                if is_file_reference(value):
+                    filename = 'file.%d' % i
+                    value.put(os.path.join(tmpdir, filename))
+                    tostore[field] = _StoredFile(filename)
+                else:
+                    tostore[field] = value
+
+            with open(os.path.join(tmpdir, _OUTPUTS), 'wb') as outfile:
+                dill.dump(tostore, outfile)
+
+            size = _entry_size(tmpdir)
+            try:
+                os.rename(tmpdir, os.path.join(self.directory, key))
+            except OSError:  # another process stored the same result first
+                return
+        finally:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+        with self._lock:
+            if self._total is not None and self._total + size <= self.max_bytes:
+                self._total += size
+                return
+        self.evict()
+
+    def evict(self):
+        """ Delete least recently used entries until the cache fits in ``max_bytes``
+
+        This scans the whole cache, so ``store`` only calls it when its running total of
+        the cache's size goes past ``max_bytes`` (or before the first scan). Entries other
+        processes store in the meantime are counted at the next scan.
+        """
+        entries = []
+        total = 0
+        for key in os.listdir(self.directory):
+            entry = os.path.join(self.directory, key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            try:
+                size = _entry_size(entry)
+                lastused = os.path.getmtime(os.path.join(entry, _OUTPUTS))
+            except OSError:
+                continue
+            entries.append((lastused, size, entry))
+            total += size
+
+        entries.sort()
+        while total > self.max_bytes and entries:
+            lastused, size, entry = entries.pop(0)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+        with self._lock:
+            self._total = total
+
+
+def _entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+
+
+class _StoredFile(object):
+    def __init__(self, filename):
+        self.filename = filename
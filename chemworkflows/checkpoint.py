@@ -0,0 +1,213 @@
+""" Incremental, per-task workflow checkpoints.
+
+A checkpoint is a directory::
+
+    workflow_state/
+        manifest.json          app name, workflow name, runner class, artifact store
+        inputs.dill            the workflow's inputs
+        tasks/<taskname>/
+            record.json        output fields, the artifact holding each one, and the
+                               task's cache key
+        artifacts/             ``artifacts.ArtifactStore`` holding the output values
+
+Output values are content-addressed, so identical outputs are written once. The artifact
+store can also live outside the checkpoint (``--artifact-store``) and be shared between
+runs. Checkpoints written before artifacts were introduced (format 1) hold one
+``<n>.dill`` or ``<n>.file`` per output field in each task directory, and can still be
+restored.
+
+Each task's record is written as soon as that task finishes (to a temporary directory
+that's renamed into place, so a crash never leaves a partial record). On restart, the
+runner is rebuilt from the manifest and inputs, and finished tasks are replaced by
+``CheckpointedTask`` objects that only unpickle an output when something asks for it.
+"""
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import dill
+
+from .artifacts import ArtifactStore
+from .utils import pflush
+
+MANIFEST = 'manifest.json'
+INPUTS = 'inputs.dill'
+RECORD = 'record.json'
+ARTIFACTS = 'artifacts'
+
+
+class Checkpoint(object):
+    """ Writes task records for a runner into a checkpoint directory
+
+    Args:
+        path (str): checkpoint directory (created if necessary)
+        appname (str): name of the app being run (see ``apps.get_app``)
+        runner (pyccc.workflow.runner.SerialRuntimeRunner): the runner being checkpointed
+        artifact_dir (str): artifact store to keep output values in (default: inside the
+            checkpoint)
+    """
+    def __init__(self, path, appname, runner, artifact_dir=None):
+        self.path = os.path.abspath(path)
+        self.taskdir = os.path.join(self.path, 'tasks')
+        if not os.path.isdir(self.taskdir):
+            os.makedirs(self.taskdir)
+        self.artifacts = ArtifactStore(artifact_dir or os.path.join(self.path, ARTIFACTS))
+
+        manifest = {'format': 2,
+                    'appname': appname,
+                    'workflow': runner.workflow.name,
+                    'runner': runner.__class__.__name__,
+                    'artifacts': self.artifacts.directory}
+        with open(os.path.join(self.path, MANIFEST), 'w') as outfile:
+            json.dump(manifest, outfile, indent=2)
+        with open(os.path.join(self.path, INPUTS), 'wb') as outfile:
+            dill.dump(getattr(runner, 'inputvalues', {}), outfile)
+
+    def __contains__(self, taskname):
+        return os.path.exists(os.path.join(self.taskdir, taskname, RECORD))
+
+    def record(self, taskname, task, cachekey=None):
+        """ Write the record for a finished task (does nothing if it's already recorded)
+        """
+        if taskname in self:
+            return
+
+        tmpdir = tempfile.mkdtemp(dir=self.taskdir, prefix='.tmp.')
+        try:
+            record = {'fields': {}, 'cachekey': cachekey}
+            for field in task.outputfields:
+                if isinstance(task, CheckpointedTask) and task.artifacts is not None:
+                    artifact = task.record['fields'][field]  # from a previous checkpoint
+                    self.artifacts.copy_from(task.artifacts, artifact)
+                else:
+                    artifact = self.artifacts.put(task.getoutput(field))
+                record['fields'][field] = artifact
+
+            with open(os.path.join(tmpdir, RECORD), 'w') as outfile:
+                json.dump(record, outfile, indent=2)
+            os.rename(tmpdir, os.path.join(self.taskdir, taskname))
+        finally:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def task_record(self, taskname):
+        """ The record written for a task by ``record``
+        """
+        with open(os.path.join(self.taskdir, taskname, RECORD), 'r') as infile:
+            return json.load(infile)
+
+    def record_all(self, runner):
+        """ Record every finished task in the runner that isn't recorded yet
+        """
+        cachekeys = getattr(runner, '_cachekeys', {})
+        for taskname, task in runner.tasks.iteritems():
+            if task.finished and taskname not in self:
+                try:
+                    self.record(taskname, task, cachekeys.get(taskname))
+                except Exception as exc:
+                    pflush('WARNING: failed to checkpoint task "%s": %s' % (taskname, exc))
+
+
+class CheckpointedTask(object):
+    """ A finished task restored from a checkpoint. Outputs are loaded on first access.
+
+    Args:
+        spec (pyccc.workflow.TaskSpec): the task's spec
+        path (str): the task's directory in the checkpoint
+        record (dict): the task's record
+        artifacts (artifacts.ArtifactStore): store holding the outputs (None for
+            checkpoints written before artifacts were introduced)
+    """
+    finished = True
+
+    def __init__(self, spec, path, record, artifacts=None):
+        self.spec = spec
+        self.path = path
+        self.record = record
+        self.artifacts = artifacts
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def outputfields(self):
+        return self.record['fields'].keys()
+
+    def getoutput(self, field):
+        with self._lock:
+            if field not in self._values:
+                self._values[field] = self._load(field)
+            return self._values[field]
+
+    def _load(self, field):
+        import pyccc
+
+        if self.artifacts is not None:
+            return self.artifacts.get(self.record['fields'][field])
+
+        filename = os.path.join(self.path, self.record['fields'][field])
+        if filename.endswith('.file'):
+            return pyccc.LocalFile(filename)
+        with open(filename, 'rb') as infile:
+            return dill.load(infile)
+
+    def __repr__(self):
+        return '<CheckpointedTask %s (%s)>' % (self.spec.name, self.path)
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST), 'r') as infile:
+        return json.load(infile)
+
+
+def restore(path, workflow, RunnerClass, **kwargs):
+    """ Rebuild a runner from a checkpoint directory
+
+    Args:
+        path (str): checkpoint directory
+        workflow (pyccc.workflow.Workflow): the app's workflow
+        RunnerClass (type): runner class to create
+        **kwargs: passed to the runner's constructor (e.g., ``engine``)
+    """
+    with open(os.path.join(path, INPUTS), 'rb') as infile:
+        inputs = dill.load(infile)
+    kwargs.update(inputs)
+    runner = RunnerClass(workflow, **kwargs)
+
+    manifest = read_manifest(path)
+    if manifest.get('format', 1) >= 2:
+        artifact_dir = manifest['artifacts']
+        if not os.path.isdir(artifact_dir):  # the checkpoint was moved
+            artifact_dir = os.path.join(path, ARTIFACTS)
+        artifacts = ArtifactStore(artifact_dir)
+    else:
+        artifacts = None
+
+    taskdir = os.path.join(path, 'tasks')
+    for taskname in os.listdir(taskdir):
+        recordpath = os.path.join(taskdir, taskname, RECORD)
+        if taskname.startswith('.') or not os.path.exists(recordpath):
+            continue
+        with open(recordpath, 'r') as infile:
+            record = json.load(infile)
+
+        spec = runner.tasks[taskname].spec
+        runner.tasks[taskname] = CheckpointedTask(spec, os.path.dirname(recordpath), record,
+                                                  artifacts)
+        if record.get('cachekey') and hasattr(runner, '_cachekeys'):
+            runner._cachekeys[taskname] = record['cachekey']
+
+    return runner
+
@@ -1,3 +1,7 @@
+from .fusion import lightweight
+from .ligandlib import ligand_library_key
+
+
 def missing_internal_residues(mol):
     """ Return a list of missing internal residues
     """
@@ -18,6 +22,79 @@ def missing_internal_residues(mol):
     return missing_internal
 
 
+def ligand_residue_groups(mol, candidates):
+    """ Find the candidate residues that could be ligands.
+
+    A candidate is a ligand if it isn't bonded to any other residue, or if it's bonded to
+    exactly one other residue which isn't bonded to anything else (i.e., it belongs to a
+    connected component of the residue bond graph with at most 2 residues).
+
+    Args:
+        mol (moldesign.Molecule): the molecule
+        candidates (List[int]): indices of residues to consider
+
+    Returns:
+        List[List[int]]: for each ligand, the index of its residue (plus the index of its
+            bonded partner, if any)
+    """
+    import numpy as np
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    # One pass over the atoms and one over the bonds; everything else is array operations
+    resindex = np.fromiter((atom.residue.index for atom in mol.atoms), dtype='int64',
+                           count=mol.num_atoms)
+    bonds = np.fromiter((index
+                         for atom in mol.atoms
+                         for nbr in mol.bond_graph[atom]
+                         if atom.index < nbr.index
+                         for index in (atom.index, nbr.index)),
+                        dtype='int64').reshape(-1, 2)
+    edges = resindex[bonds]
+    edges = edges[edges[:, 0] != edges[:, 1]]  # only bonds between residues
+
+    nres = mol.num_residues
+    graph = coo_matrix((np.ones(2 * len(edges), dtype='int8'),
+                        (np.concatenate([edges[:, 0], edges[:, 1]]),
+                         np.concatenate([edges[:, 1], edges[:, 0]]))),
+                       shape=(nres, nres)).tocsr()
+    graph.sum_duplicates()
+
+    ncomponents, labels = connected_components(graph, directed=False)
+    sizes = np.bincount(labels, minlength=ncomponents)
+
+    groups = []
+    for ires in candidates:
+        size = sizes[labels[ires]]
+        if size == 1:
+            groups.append([ires])
+        elif size == 2:
+            partner = graph.indices[graph.indptr[ires]:graph.indptr[ires + 1]][0]
+            groups.append([ires, int(partner)])
+    return groups
+
+
+def ligand_options(mol, groups):
+    """ Describe ligands found by ``ligand_residue_groups``
+
+    Returns:
+        dict: ``{ligand_name: [atom_idx1, atom_idx2, ...], ...}`` (0-based atom indices)
+        dict: ``{ligand_name: [selection strings for the molecule viewer], ...}``
+    """
+    found_ligands = {}
+    mv_ligand_strings = {}
+    for group in groups:
+        residues = [mol.residues[ires] for ires in group]
+        ligname = ' - '.join(residue.name for residue in residues)
+        found_ligands[ligname] = [atom.index for residue in residues for atom in residue.atoms]
+        mv_ligand_strings[ligname] = ['1.%s.%s-%s' % (residue.chain.name,
+                                                      residue.chain.name,
+                                                      residue.pdbindex)
+                                      for residue in residues]
+    return found_ligands, mv_ligand_strings
+
+
+@lightweight
 def read_molecule(description):
     """ All-purpose routine for initializing molecules.
     The input "description" must be a yaml or JSON file with exactly one
@@ -31,6 +108,9 @@ def read_molecule(description):
 
     If "asfile" is passed, then "molfile" should also be present. The format
     will be determined from the filename passed in the description JSON
+
+    A bare "input" is usually resolved on the client already (see
+    ``structures.resolve_input``), and arrives here as a pickled molecule file.
     """
     import moldesign as mdt
 
@@ -40,6 +120,11 @@ def read_molecule(description):
     if 'filename' in d:
         format, compression = mdt.fileio._get_format(d['filename'], None)
         m = mdt.read(description['content'], format=format)
+        if 'pdbid' in d:  # a structure from the local store; see structures.localize_input
+            m.name = d['pdbid']
+            m.metadata.pdbid = d['pdbid']
+            m.metadata.sourceformat = 'mmcif' if format == 'cif' else 'pdb'
+
     elif 'smiles' in d:
         m = mdt.from_smiles(d['smiles'])
     elif 'iupac' in d:
@@ -56,49 +141,81 @@ def read_molecule(description):
         assert len(d) == 1
         data = d['input']
 
-        if len(data) == 4 and data[0].isdigit():
+        # Try the resolver that the input looks like first, then fall through the rest
+        kind = classify_input(data)
+        resolvers = [('pdb', 'PDB ID', mdt.from_pdb),
+                     ('smiles', 'smiles', mdt.from_smiles),
+                     ('name', 'IUPAC name', mdt.from_name),
+                     ('inchi', 'inchi string', mdt.from_inchi)]
+        if not (len(data) == 4 and data[0].isdigit()):
+            resolvers.pop(0)
+        resolvers.sort(key=lambda resolver: resolver[0] != kind)
+
+        for resolvername, inputtype, resolver in resolvers:
             try:
-                m = mdt.from_pdb(data)
+                m = resolver(data)
             except Exception as e:
-                print 'Not recognized as PDB ID', e
+                print 'Not recognized as %s' % inputtype, e
             else:
-                print 'Reading molecule as PDB ID "%s"' % data
-                return {'mol':m}
-
-        try:
-            m = mdt.from_smiles(data)
-        except Exception as e:
-            print 'Not recognized as SMILES name', e
-        else:
-            print 'Reading molecule as smiles "%s"' % data
-            return {'mol':m}
-
-        try:
-            m = mdt.from_name(data)
-        except Exception as e:
-            print 'Not recognized as IUPAC name', e
-        else:
-            print 'Reading molecule as IUPAC name "%s"' % data
-            return {'mol': m}
-
-        try:
-            m = mdt.from_inchi(data)
-        except Exception as e:
-            print 'Not recognized as INCHI string', e
-        else:
-            print 'Reading molecule as inchi string "%s"' % data
-            return {'mol': m}
+                print 'Reading molecule as %s "%s"' % (inputtype, data)
+                return {'mol': m}
 
         raise ValueError("Failed to parse input data '%s' as PDB id, SMILES, IUPAC, or INCHI" %
                          data)
 
-
     else:
         raise ValueError(description)
 
     return {'mol': m}
 
 
+def protonate_ligand(mol, ligand_atom_ids, ligandname, ph, charges):
+    """
+    Protonate the chosen ligand and identify it for the ligand parameter library
+    """
+    import moldesign as mdt
+
+    ligand = mdt.Molecule([mol.atoms[idx] for idx in ligand_atom_ids], name=ligandname)
+    ligh = mdt.set_hybridization_and_ph(ligand, ph)
+
+    pbmol = mdt.interfaces.openbabel.mol_to_pybel(ligh)
+    try:
+        identity = pbmol.write('inchikey').strip()
+    except Exception as e:
+        print 'Failed to compute InChIKey, identifying ligand by SMILES instead:', e
+        identity = pbmol.write('can').split()[0]
+
+    return {'ligand': ligh,
+            'ligand_key': ligand_library_key(
+                    identity, ph, charges,
+                    resname=' - '.join(residue.resname for residue in ligh.residues),
+                    atomnames=[atom.name for atom in ligh.atoms])}
+
+
+def classify_input(data):
+    """ Guess what kind of identifier a bare input string is, without any network access
+
+    Returns:
+        str: one of 'pdb', 'inchi', 'smiles' or 'name'
+    """
+    import re
+
+    data = data.strip()
+    if len(data) == 4 and data[0].isdigit() and data.isalnum():
+        return 'pdb'
+    elif data.startswith('InChI='):
+        return 'inchi'
+
+    # Every character must belong to a bracket atom, an organic-subset atom, a bond,
+    # a branch or a ring closure
+    smiles_token = (r'\[[^\]]+\]|Br|Cl|[BCNOPSFI]|[bcnops]|\*|%\d\d|\d'
+                    r'|[-=#$:/\\.()]')
+    if data and re.match(r'^(?:%s)+$' % smiles_token, data):
+        return 'smiles'
+    else:
+        return 'name'
+
+
 #def write(fmt):
 #   import moldesign as mdt
 #    mol = mdt.read('in.pkl')
@@ -0,0 +1,539 @@
+""" Warm, reusable worker containers for ``--localdocker`` runs.
+
+Normally every task starts a new container and imports moldesign from scratch, which takes
+longer than short tasks like ``read_molecule`` or ``validate`` themselves. ``PooledDocker``
+is a ``pyccc.Docker`` engine that instead sends python jobs to long-lived worker containers,
+one pool per image. Each worker runs ``WORKER_SOURCE``: it reads a job's files (the
+``run_job.py``, ``function.pkl`` and ``source.py`` that ``pyccc.PythonJob`` creates) from
+its stdin, runs the job in-process in a fresh working directory, and sends back the files
+the job wrote, with its stdout and stderr. Messages are length-prefixed pickles. A job's
+``resources.thread_environment`` is set in the worker's environment while it runs (but
+libraries a previous job already loaded keep their thread counts), and workers mount the
+engine's artifact store like its other containers do.
+
+Between jobs, a worker deletes the job's working directory, restores its environment
+variables and forgets the job's modules, but keeps everything else it imported. Workers
+are started on demand up to ``max_size`` per image, and stopped after ``idle_timeout``
+seconds without work. Jobs that aren't python jobs, or whose image can't run a worker,
+are run by the normal docker engine. Runners call ``cleanup(job)`` once they've fetched a
+pooled job's results, which deletes its output files.
+"""
+from __future__ import print_function
+
+import atexit
+import itertools
+import os
+import pickle
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+import pyccc
+from pyccc import status
+
+from .resources import ARTIFACT_MOUNT, LocalDocker, current_allocation, thread_environment
+from .utils import pflush
+
+DEFAULT_MAX_SIZE = 2
+DEFAULT_IDLE_TIMEOUT = 300.0
+_HEADER = struct.Struct('>Q')
+
+WORKER_SOURCE = r'''
+import os, pickle, shutil, struct, sys, tempfile, traceback
+
+channel_in = os.fdopen(os.dup(0), 'rb')
+channel_out = os.fdopen(os.dup(1), 'wb')
+os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+os.dup2(2, 1)  # anything else written to stdout would corrupt the channel
+
+
+def recv():
+    header = channel_in.read(8)
+    if len(header) < 8:
+        return None
+    size, = struct.unpack('>Q', header)
+    return pickle.loads(channel_in.read(size))
+
+
+def send(message):
+    data = pickle.dumps(message, 2)
+    channel_out.write(struct.pack('>Q', len(data)))
+    channel_out.write(data)
+    channel_out.flush()
+
+
+def run(request):
+    workdir = tempfile.mkdtemp(prefix='cwtask.')
+    for name, content in request['files'].items():
+        path = os.path.join(workdir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as infile:
+            infile.write(content)
+
+    modules = set(sys.modules)
+    environ = dict(os.environ)
+    os.environ.update(request.get('environment', {}))
+    cwd = os.getcwd()
+    saved = [os.dup(1), os.dup(2)]
+    stdout = open(os.path.join(workdir, '.stdout'), 'wb')
+    stderr = open(os.path.join(workdir, '.stderr'), 'wb')
+    exitcode = 0
+    try:
+        os.chdir(workdir)
+        sys.path.insert(0, workdir)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(stdout.fileno(), 1)
+        os.dup2(stderr.fileno(), 2)
+        try:
+            import run_job
+            run_job.main()
+        except BaseException:
+            traceback.print_exc()
+            exitcode = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved:
+            os.close(fd)
+        stdout.close()
+        stderr.close()
+        os.chdir(cwd)
+        sys.path.remove(workdir)
+        os.environ.clear()
+        os.environ.update(environ)
+        for name in set(sys.modules) - modules:  # keep only installed modules loaded
+            path = getattr(sys.modules[name], '__file__', None)
+            if path is None or os.path.abspath(path).startswith(workdir):
+                del sys.modules[name]
+
+    response = {'files': {}, 'exitcode': exitcode}
+    for name in ('.stdout', '.stderr'):
+        with open(os.path.join(workdir, name), 'rb') as stdfile:
+            response[name[1:]] = stdfile.read()
+    for dirpath, dirnames, filenames in os.walk(workdir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, workdir)
+            if name in request['files'] or name in ('.stdout', '.stderr'):
+                continue
+            with open(path, 'rb') as outfile:
+                response['files'][name] = outfile.read()
+    shutil.rmtree(workdir, ignore_errors=True)
+    return response
+
+
+try:
+    import moldesign
+except ImportError:
+    pass
+send({'ready': True, 'python': sys.version})
+
+while True:
+    request = recv()
+    if request is None:
+        break
+    send(run(request))
+'''
+
+
+class WorkerFailed(Exception):
+    pass
+
+
+class PoolWorker(object):
+    """ One long-lived worker container, driven through ``docker run -i``
+
+    Args:
+        image (str): the worker's image
+        mounts (Mapping[str, str]): host directories to mount read-only in the worker, and
+            where to mount them
+    """
+    def __init__(self, image, mounts=None):
+        self.image = image
+        self.name = 'chemworkflows-worker-%s' % uuid.uuid4().hex[:12]
+        self.last_used = time.time()
+        self.jobs_run = 0
+        volumes = []
+        for hostdir, mountpoint in sorted((mounts or {}).iteritems()):
+            volumes.extend(['-v', '%s:%s:ro' % (hostdir, mountpoint)])
+        self.process = subprocess.Popen(['docker', 'run', '-i', '--rm', '--name', self.name] +
+                                        volumes +
+                                        [image, 'python', '-u', '-c', WORKER_SOURCE],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        ready = self._recv()
+        if not ready or not ready.get('ready'):
+            self.close()
+            raise WorkerFailed('Worker container for image %s failed to start' % image)
+
+    def call(self, files, environment=None):
+        """ Run a python job in the worker
+
+        Args:
+            files (Mapping[str, bytes]): the job's input files
+            environment (Mapping[str, str]): environment variables to set for the job
+
+        Returns:
+            dict: ``files`` (new files the job wrote), ``stdout``, ``stderr`` and ``exitcode``
+        """
+        self._send({'files': files, 'environment': environment or {}})
+        response = self._recv()
+        if response is None:
+            self.close()
+            raise WorkerFailed('Worker container %s exited unexpectedly' % self.name)
+        self.jobs_run += 1
+        self.last_used = time.time()
+        return response
+
+    def close(self):
+        """ Stop the worker: it exits when its input is closed; remove it if it doesn't
+        """
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        for i in xrange(50):
+            if self.process.poll() is not None:
+                return
+            time.sleep(0.1)
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(['docker', 'rm', '-f', self.name], stdout=devnull, stderr=devnull)
+
+    def _send(self, message):
+        data = pickle.dumps(message, 2)
+        self.process.stdin.write(_HEADER.pack(len(data)))
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def _recv(self):
+        header = self.process.stdout.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return None
+        size, = _HEADER.unpack(header)
+        return pickle.loads(self.process.stdout.read(size))
+
+
+class ContainerPool(object):
+    """ Pools of worker containers, keyed by image
+
+    Args:
+        max_size (int): maximum number of workers per image
+        idle_timeout (float): stop workers that have been idle for this many seconds
+        mounts (Mapping[str, str]): host directories to mount read-only in every worker,
+            and where to mount them
+    """
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 mounts=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.mounts = mounts or {}
+        self.unusable = set()  # images that can't run a worker
+        self._idle = {}  # image -> list of idle workers
+        self._counts = {}  # image -> number of live workers
+        self._lock = threading.Condition()
+        self._closed = False
+
+        reaper = threading.Thread(target=self._reap, name='ContainerPool reaper')
+        reaper.daemon = True
+        reaper.start()
+        atexit.register(self.shutdown)
+
+    def run(self, image, files, environment=None):
+        """ Run a python job in a worker for ``image`` (see ``PoolWorker.call``)
+        """
+        worker = self._acquire(image)
+        try:
+            response = worker.call(files, environment)
+        except Exception:
+            self._discard(worker)
+            raise
+        self._release(worker)
+        return response
+
+    def prewarm(self, image):
+        """ Start a worker for an image in the background, if there isn't one yet
+        """
+        with self._lock:
+            if self._counts.get(image, 0) or image in self.unusable:
+                return
+            self._counts[image] = 1
+
+        def start():
+            worker = self._start(image)
+            if worker is not None:
+                self._release(worker)
+
+        thread = threading.Thread(target=start, name='prewarm %s' % image)
+        thread.daemon = True
+        thread.start()
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            workers = [w for idle in self._idle.itervalues() for w in idle]
+            self._idle = {}
+            self._lock.notify_all()
+        for worker in workers:
+            worker.close()
+
+    def _acquire(self, image):
+        with self._lock:
+            while True:
+                if self._closed:
+                    raise WorkerFailed('The container pool has been shut down')
+                if image in self.unusable:
+                    raise WorkerFailed('Image %s cannot run pool workers' % image)
+                if self._idle.get(image):
+                    return self._idle[image].pop()
+                if self._counts.get(image, 0) < self.max_size:
+                    self._counts[image] = self._counts.get(image, 0) + 1
+                    break
+                self._lock.wait()
+
+        worker = self._start(image)
+        if worker is None:
+            raise WorkerFailed('Image %s cannot run pool workers' % image)
+        return worker
+
+    def _start(self, image):
+        """ Start a worker, whose slot has already been counted. Returns None on failure.
+        """
+        try:
+            worker = PoolWorker(image, self.mounts)
+        except (WorkerFailed, OSError) as exc:
+            pflush('WARNING: not pooling containers for %s: %s' % (image, exc))
+            with self._lock:
+                self.unusable.add(image)
+                self._counts[image] -= 1
+                self._lock.notify_all()
+            return None
+        return worker
+
+    def _release(self, worker):
+        with self._lock:
+            if not self._closed:
+                self._idle.setdefault(worker.image, []).append(worker)
+                self._lock.notify_all()
+                return
+        worker.close()
+
+    def _discard(self, worker):
+        worker.close()
+        with self._lock:
+            self._counts[worker.image] -= 1
+            self._lock.notify_all()
+
+    def _reap(self):
+        while True:
+            time.sleep(max(1.0, min(self.idle_timeout / 4.0, 30.0)))
+            expired = []
+            with self._lock:
+                if self._closed:
+                    return
+                cutoff = time.time() - self.idle_timeout
+                for image, idle in self._idle.iteritems():
+                    expired.extend(w for w in idle if w.last_used < cutoff)
+                    idle[:] = [w for w in idle if w.last_used >= cutoff]
+                for worker in expired:
+                    self._counts[worker.image] -= 1
+            for worker in expired:
+                worker.close()
+
+
+class PooledDocker(LocalDocker):
+    """ Docker engine that runs python jobs in warm, reused worker containers
+
+    Args:
+        client (docker.Client): passed to ``pyccc.Docker``
+        max_size (int): maximum number of workers per image
+        idle_timeout (float): stop workers that have been idle for this many seconds
+    """
+    _jobids = itertools.count()
+
+    def __init__(self, client=None, max_size=DEFAULT_MAX_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, **kwargs):
+        super(PooledDocker, self).__init__(client, **kwargs)
+        self.pool = ContainerPool(max_size, idle_timeout, self._mounts())
+        self._pooled = {}
+        atexit.register(self.cleanup)
+
+    def cleanup(self, job=None):
+        """ Delete the local copies of a pooled job's output files and forget the job, once
+        its results have been fetched (by default, every pooled job's, e.g. at exit)
+        """
+        if job is None:
+            jobids = self._pooled.keys()
+        else:
+            jobids = [job.jobid]
+        for jobid in jobids:
+            pooled = self._pooled.pop(jobid, None)
+            if pooled is not None:
+                pooled.cleanup()
+
+    def __getstate__(self):
+        state = super(PooledDocker, self).__getstate__()
+        state['pool'] = None
+        state['_pooled'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pool = ContainerPool(mounts=self._mounts())
+        atexit.register(self.cleanup)
+
+    def _mounts(self):
+        return {self.artifact_dir: ARTIFACT_MOUNT}
+
+    def prewarm(self, images):
+        """ Start workers for these images in the background
+        """
+        for image in images:
+            self.pool.prewarm(image)
+
+    def _poolable(self, job):
+        inputs = getattr(job, 'inputs', None) or {}
+        return ('function.pkl' in inputs and 'run_job.py' in inputs and
+                job.command.endswith('run_job.py') and job.image not in self.pool.unusable)
+
+    def submit(self, job):
+        if not self._poolable(job):
+            return super(PooledDocker, self).submit(job)
+
+        self._check_job(job)
+        pooled = PooledJob(job, 'pool-%d-%d' % (os.getpid(), next(self._jobids)))
+        job.jobid = pooled.jobid
+        self._pooled[job.jobid] = pooled
+
+        thread = threading.Thread(target=self._run_pooled,
+                                  args=(job, pooled, current_allocation()),
+                                  name='pooled %s' % job.jobid)
+        thread.daemon = True
+        thread.start()
+        return job.jobid
+
+    def _run_pooled(self, job, pooled, allocation):
+        try:
+            files = {name: _read_input(inputfile)
+                     for name, inputfile in job.inputs.iteritems()}
+            pooled.status = status.RUNNING
+            response = self.pool.run(job.image, files,
+                                     allocation and thread_environment(allocation))
+        except WorkerFailed as exc:
+            if job.image not in self.pool.unusable:
+                pooled.fail(exc)
+                return
+            pflush('Running job %s in a new container instead' % pooled.jobid)
+            try:  # this sets a new jobid, so the normal docker methods take over
+                self._submit_container(job, allocation)
+            except Exception as exc:
+                pooled.fail(exc)
+                return
+            del self._pooled[pooled.jobid]
+            pooled.done.set()
+        except Exception as exc:
+            pooled.fail(exc)
+        else:
+            pooled.finish(response)
+
+    def wait(self, job):
+        pooled = self._pooled.get(job.jobid)
+        if pooled is not None:
+            pooled.done.wait()
+        if job.jobid not in self._pooled:  # also if it fell back to a new container
+            super(PooledDocker, self).wait(job)
+
+    def kill(self, job):
+        pooled = self._pooled.get(job.jobid)
+        if pooled is not None:  # can't interrupt a worker; just stop waiting
+            pooled.fail(RuntimeError('Job was killed'), status.KILLED)
+        else:
+            super(PooledDocker, self).kill(job)
+
+    def get_status(self, job):
+        pooled = self._pooled.get(job.jobid)
+        if pooled is not None:
+            return pooled.status
+        else:
+            return super(PooledDocker, self).get_status(job)
+
+    def _list_output_files(self, job):
+        pooled = self._pooled.get(job.jobid)
+        if pooled is not None:
+            return pooled.output_files()
+        else:
+            return super(PooledDocker, self)._list_output_files(job)
+
+    def _get_final_stds(self, job):
+        pooled = self._pooled.get(job.jobid)
+        if pooled is not None:
+            return pooled.stdout, pooled.stderr
+        else:
+            return super(PooledDocker, self)._get_final_stds(job)
+
+
+class PooledJob(object):
+    """ State of a job running in a pool worker
+    """
+    def __init__(self, job, jobid):
+        self.jobid = jobid
+        self.status = status.QUEUED
+        self.stdout = self.stderr = ''
+        self.outputdir = None
+        self.done = threading.Event()
+
+    def finish(self, response):
+        self.outputdir = tempfile.mkdtemp(prefix='chemworkflows-%s.' % self.jobid)
+        for name, content in response['files'].iteritems():
+            path = os.path.join(self.outputdir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as outfile:
+                outfile.write(content)
+        self.stdout = response['stdout']
+        self.stderr = response['stderr']
+        self.status = status.FINISHED if response['exitcode'] == 0 else status.ERROR
+        self.done.set()
+
+    def fail(self, exc, state=status.ERROR):
+        self.stderr += '%s: %s\n' % (exc.__class__.__name__, exc)
+        self.status = state
+        self.done.set()
+
+    def output_files(self):
+        if self.outputdir is None:
+            return {}
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.outputdir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                files[os.path.relpath(path, self.outputdir)] = pyccc.LocalFile(path)
+        return files
+
+    def cleanup(self):
+        if self.outputdir is not None:
+            shutil.rmtree(self.outputdir, ignore_errors=True)
+
+
+def _read_input(inputfile):
+    """ Contents of one of a job's input files (a string or a pyccc file object)
+    """
+    if isinstance(inputfile, basestring):
+        return inputfile
+    elif hasattr(inputfile, 'read'):
+        return inputfile.read()
+    fd, tmppath = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        inputfile.put(tmppath)
+        with open(tmppath, 'rb') as infile:
+            return infile.read()
+    finally:
+        os.remove(tmppath)
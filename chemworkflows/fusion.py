@@ -0,0 +1,190 @@
+""" Run chains of cheap tasks that share an image as a single job.
+
+Tasks like ``read_molecule``, ``get_ligands`` and ``validate`` do milliseconds of work, but
+each one normally gets its own container and its own round trip to serialize its inputs
+and outputs. Tasks are marked as cheap with ``lightweight``; the parallel runners group
+connected lightweight tasks that use the same image (``fusion_groups``) and run each group
+as one job (``run_task_chain``). Values passed between the group's tasks stay in that
+process; every task's outputs are still returned, so each task ends up finished with its
+own outputs just as if it had run alone.
+
+``runners.ParallelHybridRunner`` also runs lightweight tasks in local processes instead of
+on the engine.
+"""
+MAX_GROUP_SIZE = 8
+CHAIN_TIMINGS = 'chain_timings.json'  # where engine jobs record how long each task ran
+
+
+def lightweight(func):
+    """ Decorator marking a cheap task: it may run in the same job as neighbouring tasks,
+    and ``runners.ParallelHybridRunner`` runs it locally
+    """
+    func.__lightweight__ = True
+    return func
+
+
+def fusion_groups(runner, tasknames):
+    """ Group lightweight tasks that use the same image and are connected by their inputs
+
+    A task joins the group of one of its lightweight upstream tasks only if none of its other
+    upstream tasks depend on that group (the group could never become ready otherwise).
+
+    Args:
+        runner (runners.ParallelRunnerMixin): the runner
+        tasknames (List[str]): tasks to group, in workflow order
+
+    Returns:
+        Mapping[str, tuple]: task name -> names of every task in its group, in workflow order,
+            for tasks in groups of two or more
+    """
+    from .runners import is_user_interaction, task_image, upstream_tasknames
+
+    def candidate(name):
+        task = runner.tasks[name]
+        return (getattr(task.spec.func, '__lightweight__', False) and
+                not hasattr(task.spec.func, '__ligandkey__') and
+                not is_user_interaction(task))
+
+    order = {name: i for i, name in enumerate(tasknames)}
+    groups = {}
+    for name in tasknames:
+        if not candidate(name):
+            continue
+        task = runner.tasks[name]
+        upstream = upstream_tasknames(task)
+        for parent in sorted(upstream, key=order.get):
+            group = groups.get(parent)
+            if (group is None or len(group) >= MAX_GROUP_SIZE or
+                    task_image(runner.workflow, runner.tasks[parent]) !=
+                    task_image(runner.workflow, task)):
+                continue
+            if any(group.intersection(runner.ancestors(other))
+                   for other in upstream if other not in group):
+                continue
+            group.add(name)
+            groups[name] = group
+            break
+        else:
+            groups[name] = {name}
+
+    return {name: tuple(sorted(group, key=order.get))
+            for name, group in groups.iteritems() if len(group) > 1}
+
+
+def task_chain_steps(runner, tasknames, ship_source=True, values=None, references=False):
+    """ Describe a group of tasks for ``run_task_chain``
+
+    Inputs from outside the group are resolved now (see ``runner.input_value`` for
+    ``values``), or with ``references``, passed as paths to where the job can load them
+    (see ``runner.input_reference``); inputs from other tasks in the group are passed
+    along inside the job.
+    With ``ship_source``, each function is described by its source code and the globals
+    it uses (like ``pyccc.PythonJob`` does), so that it can run in a container; otherwise
+    the functions themselves are included.
+    """
+    steps = []
+    for name in tasknames:
+        task = runner.tasks[name]
+        inputs = {}
+        for field, source in task.spec.inputfields.iteritems():
+            upstream = getattr(source, 'task', None)
+            if upstream is not None and upstream.name in tasknames:
+                inputs[field] = ('task', (upstream.name, source.field))
+            elif references:
+                inputs[field] = runner.input_reference(task, field, values)
+            else:
+                inputs[field] = ('value', runner.input_value(task, field, values))
+
+        step = {'name': name, 'inputs': inputs}
+        if ship_source:
+            step.update(function_source(task.spec.func))
+        else:
+            step['func'] = task.spec.func
+        steps.append(step)
+    return steps
+
+
+def function_source(func):
+    """ A task function's source, with the sources of the global functions it calls and
+    the modules and variables they all need, to ship to a container (helpers run in the
+    task's namespace, so only helpers the task calls directly are included)
+    """
+    from pyccc import source_inspections as src
+
+    globalvars = src.get_global_vars(func)
+    sources = [src.getsource(func)]
+    modules, variables = dict(globalvars['modules']), dict(globalvars['vars'])
+    for name, globalfunc in globalvars['functions'].iteritems():
+        sources.append(src.getsource(globalfunc))
+        helpervars = src.get_global_vars(globalfunc)  # helpers share the task's namespace
+        modules.update(helpervars['modules'])
+        variables.update(helpervars['vars'])
+    return {'funcname': func.__name__,
+            'source': '\n\n'.join(sources),
+            'modules': modules,
+            'vars': variables}
+
+
+def run_task_chain(steps, workdir=None, timings=None):
+    """ Run several tasks, in order, in this process
+
+    This is shipped to task containers by source, so it's kept self-contained.
+
+    Args:
+        steps (List[dict]): from ``task_chain_steps``
+        workdir (str): run the tasks in this directory, then change back (this changes
+            the whole process's working directory, so it's only for processes that run
+            one chain at a time)
+        timings (str): write when the chain and each task started and ended (as
+            ``time.time()`` in this process, which may be on another machine) to this JSON
+            file, for the runner's profiler
+
+    Returns:
+        Mapping[str, dict]: each task's outputs, by task name
+    """
+    import importlib
+    import json
+    import os
+    import time
+    try:
+        import dill as pickle
+    except ImportError:
+        import pickle
+
+    record = {'start': time.time(), 'tasks': {}}
+    if workdir is not None:
+        previous = os.getcwd()
+        os.chdir(workdir)
+    try:
+        outputs = {}
+        for step in steps:
+            if 'func' in step:
+                func = step['func']
+            else:
+                namespace = {}
+                for alias, modulename in step['modules'].items():
+                    namespace[alias] = importlib.import_module(modulename)
+                namespace.update(step['vars'])
+                exec(step['source'], namespace)
+                func = namespace[step['funcname']]
+
+            kwargs = {}
+            for field, (kind, value) in step['inputs'].items():
+                if kind == 'task':
+                    kwargs[field] = outputs[value[0]][value[1]]
+                elif kind == 'artifact':
+                    with open(value, 'rb') as infile:
+                        kwargs[field] = pickle.load(infile)
+                else:
+                    kwargs[field] = value
+            started = time.time()
+            outputs[step['name']] = func(**kwargs)
+            record['tasks'][step['name']] = [started, time.time()]
+        if timings is not None:
+            record['end'] = time.time()
+            with open(timings, 'w') as outfile:
+                json.dump(record, outfile)
+        return outputs
+    finally:
+        if workdir is not None:
+            os.chdir(previous)
@@ -4,6 +4,12 @@ class UserInteraction(object):
     def __init__(self):
         self.__name__ = self.__class__.__name__
 
+    def candidates(self, **inputs):
+        """ Every output this interaction could return for these inputs, if that's a short,
+        known list (used by ``speculation.Speculator``); otherwise None
+        """
+        return None
+
 
 # Might want to see
 # https://gist.github.com/maartenbreddels/3378e8257bf0ee18cfcbdacce6e6a77e
@@ -11,6 +17,10 @@ class UserInteraction(object):
 
 
 class SelectAtomsFromOptions(UserInteraction):
+    def candidates(self, choices):
+        return [{'ligandname': name, 'atom_ids': atom_ids}
+                for name, atom_ids in choices.iteritems()]
+
     def __call__(self, choices):
         if len(choices) > 1:
 
@@ -0,0 +1,365 @@
+""" Keep many engine jobs in flight without a thread per job.
+
+``job.wait()`` (and ``utils.finish_job``) block a thread for the whole life of a job. A
+``JobTracker`` instead submits jobs, polls their status and fetches their results from a
+single polling thread plus a small pool of I/O threads, so one client can manage hundreds
+of jobs on ``pyccc.engines.CloudComputeCannon`` or ``pyccc.Docker``::
+
+    tracker = JobTracker()
+    handles = [tracker.submit(job) for job in jobs]
+    for handle in handles:
+        job = handle.result()  # finished, with stdout, stderr and output files fetched
+    tracker.shutdown()
+
+Each job's status is polled with exponential backoff: the interval starts at
+``min_interval``, grows by ``backoff`` every time the status hasn't changed, and drops back
+to ``min_interval`` when it does. ``max_poll_rate`` caps the total number of status
+requests per second, however many jobs are in flight.
+
+Runs on a CCC server wait for their jobs through a tracker (``runapp.get_job_tracker``),
+shared by every run in a batch. ``benchmarks/job_tracking.py`` measures how many status
+requests a tracker makes.
+
+Python 2 has no asyncio, so this uses threads and ``JobHandle`` objects in place of
+coroutines and futures. ``LocalEngine`` runs jobs as local subprocesses, as a stand-in for
+a CCC server or docker daemon.
+"""
+from __future__ import print_function
+
+import atexit
+import collections
+import heapq
+import itertools
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from .utils import pflush
+
+DEFAULT_MAX_IN_FLIGHT = 256
+DEFAULT_IO_THREADS = 8
+MIN_POLL_INTERVAL = 0.5
+MAX_POLL_INTERVAL = 30.0
+POLL_BACKOFF = 1.5
+MAX_POLL_RATE = 50.0
+
+# pyccc.status.DONE_STATES, lowercased (statuses are compared case-insensitively)
+DONE_STATES = ('finished', 'error', 'killed', 'timeout')
+FINISHED = 'finished'
+
+
+class JobFailed(Exception):
+    def __init__(self, job, status):
+        super(JobFailed, self).__init__('Job %s ended with status "%s"'
+                                        % (getattr(job, 'jobid', job), status))
+        self.job = job
+        self.status = status
+
+
+class JobHandle(object):
+    """ A job managed by a ``JobTracker``; becomes done once the job has finished and its
+    results have been fetched
+    """
+    def __init__(self, job):
+        self.job = job
+        self.status = None
+        self.polls = 0
+        self.submitted_at = None
+        self.finished_at = None
+        self._exc_info = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """ Wait for the job and return it
+
+        Raises:
+            JobFailed: if the job ended in an error state (or the exception raised while
+                submitting it or fetching its results)
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting for job %s' % self.job)
+        if self._exc_info is not None:
+            exc_type, exc_value, tb = self._exc_info
+            raise exc_type, exc_value, tb
+        return self.job
+
+    def add_done_callback(self, func):
+        """ Call ``func(handle)`` when the job is done (right away if it already is)
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _finish(self, exc_info=None):
+        self._exc_info = exc_info
+        self.finished_at = time.time()
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception as exc:
+                pflush('WARNING: job callback failed: %s' % exc)
+
+    def __repr__(self):
+        return '<JobHandle %s: %s>' % (getattr(self.job, 'jobid', None), self.status)
+
+
+class JobTracker(object):
+    """ Submits jobs, polls their status with adaptive backoff and fetches their results
+    concurrently
+
+    Args:
+        max_in_flight (int): jobs beyond this many wait locally before being submitted
+        io_threads (int): number of threads submitting jobs and fetching results
+        min_interval (float): shortest time between status requests for one job (seconds)
+        max_interval (float): longest time between status requests for one job (seconds)
+        backoff (float): factor by which the interval grows while a job's status is
+            unchanged
+        max_poll_rate (float): most status requests per second, across all jobs
+    """
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT, io_threads=DEFAULT_IO_THREADS,
+                 min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL,
+                 backoff=POLL_BACKOFF, max_poll_rate=MAX_POLL_RATE):
+        self.max_in_flight = max_in_flight
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_poll_rate = max_poll_rate
+
+        self._pool = ThreadPool(io_threads)
+        self._waiting = collections.deque()  # handles not yet submitted
+        self._polls = []  # heap of (next poll time, sequence number, handle, interval)
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._pending = set()  # every handle that isn't done yet
+        self._stopped = False
+        self._wakeup = threading.Condition()
+        self._thread = threading.Thread(target=self._poll_loop, name='JobTracker')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, job):
+        """ Queue a (not yet submitted) pyccc job
+
+        Returns:
+            JobHandle: handle to wait on the job
+        """
+        handle = JobHandle(job)
+        with self._wakeup:
+            if self._stopped:
+                raise RuntimeError('This JobTracker has been shut down')
+            self._pending.add(handle)
+            self._waiting.append(handle)
+            self._wakeup.notify()
+        return handle
+
+    def track(self, job):
+        """ Track a job that was already submitted elsewhere
+
+        Returns:
+            JobHandle: handle to wait on the job
+        """
+        handle = JobHandle(job)
+        handle.submitted_at = time.time()
+        with self._wakeup:
+            self._pending.add(handle)
+            self._in_flight += 1
+            self._schedule(handle, self.min_interval)
+        return handle
+
+    def wait_all(self, handles):
+        """ Wait for every handle, and return their jobs (failed jobs are returned as
+        their ``JobFailed`` exceptions)
+        """
+        results = []
+        for handle in handles:
+            try:
+                results.append(handle.result())
+            except Exception as exc:
+                results.append(exc)
+        return results
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def shutdown(self, wait=True):
+        """ Stop polling. With ``wait``, first let every queued or running job finish.
+        """
+        if wait:
+            with self._wakeup:
+                handles = list(self._pending)
+            for handle in handles:
+                handle._done.wait()
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+        self._thread.join()
+        self._pool.close()
+        self._pool.join()
+
+    def _schedule(self, handle, interval):
+        """ Queue the next status request for a handle (call with ``_wakeup`` held)
+        """
+        heapq.heappush(self._polls, (time.time() + interval, next(self._sequence),
+                                     handle, interval))
+        self._wakeup.notify()
+
+    def _poll_loop(self):
+        last_poll = 0.0
+        while True:
+            with self._wakeup:
+                while not self._stopped:
+                    while self._waiting and self._in_flight < self.max_in_flight:
+                        self._in_flight += 1
+                        self._pool.apply_async(self._submit, (self._waiting.popleft(),))
+                    if self._polls and self._polls[0][0] <= time.time():
+                        break
+                    timeout = self._polls[0][0] - time.time() if self._polls else None
+                    self._wakeup.wait(timeout)
+                if self._stopped:
+                    return
+                when, sequence, handle, interval = heapq.heappop(self._polls)
+
+            pause = last_poll + 1.0 / self.max_poll_rate - time.time()
+            if pause > 0:
+                time.sleep(pause)
+            last_poll = time.time()
+            self._poll(handle, interval)
+
+    def _poll(self, handle, interval):
+        try:
+            status = str(handle.job.status)
+        except Exception:
+            self._done(handle, sys.exc_info())
+            return
+        handle.polls += 1
+
+        if status.lower() in DONE_STATES:
+            handle.status = status
+            self._pool.apply_async(self._fetch, (handle,))
+            return
+
+        if status == handle.status:
+            interval = min(interval * self.backoff, self.max_interval)
+        else:
+            interval = self.min_interval
+        handle.status = status
+        with self._wakeup:
+            self._schedule(handle, interval)
+
+    def _submit(self, handle):
+        try:
+            handle.job.submit()
+        except Exception:
+            self._done(handle, sys.exc_info())
+            return
+        handle.submitted_at = time.time()
+        with self._wakeup:
+            self._schedule(handle, self.min_interval)
+
+    def _fetch(self, handle):
+        """ Fetch a finished job's stdout, stderr and output file list
+        """
+        try:
+            if handle.status.lower() != FINISHED:
+                raise JobFailed(handle.job, handle.status)
+            handle.job.stdout
+            handle.job.stderr
+            handle.job.get_output()
+        except Exception:
+            self._done(handle, sys.exc_info())
+        else:
+            self._done(handle)
+
+    def _done(self, handle, exc_info=None):
+        with self._wakeup:
+            self._in_flight -= 1
+            self._pending.discard(handle)
+            self._wakeup.notify()
+        handle._finish(exc_info)
+
+
+class LocalEngine(object):
+    """ Stand-in for a pyccc engine that runs each job's command in a local subprocess,
+    ignoring its image. For testing job management without a CCC server or docker.
+
+    Each job runs in a directory of its own under ``tempdir``; ``cleanup(job)`` removes it
+    once its results have been read, and ``shutdown()`` (also called at exit) removes
+    whatever is left.
+
+    Args:
+        tempdir (str): where to create the job directories (default: the system's
+            temporary directory)
+    """
+    hostname = 'local'
+
+    def __init__(self, tempdir=None):
+        self.tempdir = tempfile.mkdtemp(prefix='chemworkflows-jobs.', dir=tempdir)
+        self._processes = {}
+        atexit.register(self.shutdown)
+
+    def submit(self, job):
+        job.workingdir = tempfile.mkdtemp(prefix='job.', dir=self.tempdir)
+        for filename, inputfile in (getattr(job, 'inputs', None) or {}).iteritems():
+            inputfile.put(os.path.join(job.workingdir, filename))
+        stdout = open(os.path.join(job.workingdir, '.stdout'), 'wb')
+        stderr = open(os.path.join(job.workingdir, '.stderr'), 'wb')
+        process = subprocess.Popen(job.command, shell=True, cwd=job.workingdir,
+                                   stdout=stdout, stderr=stderr)
+        stdout.close()
+        stderr.close()
+        job.jobid = 'local-%d' % process.pid
+        self._processes[job.jobid] = process
+        return job.jobid
+
+    def get_status(self, job):
+        returncode = self._processes[job.jobid].poll()
+        if returncode is None:
+            return 'Running'
+        return 'Finished' if returncode == 0 else 'Error'
+
+    def wait(self, job):
+        self._processes[job.jobid].wait()
+
+    def kill(self, job):
+        self._processes[job.jobid].terminate()
+
+    def _list_output_files(self, job):
+        import pyccc
+
+        return {filename: pyccc.LocalFile(os.path.join(job.workingdir, filename))
+                for filename in os.listdir(job.workingdir)
+                if not filename.startswith('.')}
+
+    def _get_final_stds(self, job):
+        stds = []
+        for name in ('.stdout', '.stderr'):
+            with open(os.path.join(job.workingdir, name), 'rb') as stdfile:
+                stds.append(stdfile.read())
+        return tuple(stds)
+
+    def cleanup(self, job):
+        """ Remove a finished job's directory (and with it, its output files)
+        """
+        self._processes.pop(job.jobid, None)
+        shutil.rmtree(job.workingdir, ignore_errors=True)
+
+    def shutdown(self):
+        """ Remove the directories of every job
+        """
+        shutil.rmtree(self.tempdir, ignore_errors=True)
@@ -0,0 +1,142 @@
+""" A persistent library of ligand force field parameters.
+
+Entries are keyed by a canonical ligand identity - InChIKey (or canonical SMILES), the pH
+it was protonated at, and the charge model - plus the force field and what the parameters
+refer to the ligand by: its residue name and atom names. A ligand parameterized once is
+never re-parameterized for a structure that names it the same way; one whose residue or
+atoms are named differently is a miss, because its stored parameters wouldn't match it. Tasks opt in with ``keyed_by_ligand``;
+when a runner has a library, it looks the task up before running it and stores its outputs
+afterwards.
+
+Each entry is a single pickle, written to a temporary file and renamed into place, so one
+library directory can be shared by any number of concurrent runs.
+"""
+from __future__ import print_function
+
+import hashlib
+import os
+import tarfile
+import tempfile
+
+from .utils import pflush
+
+ENTRY_SUFFIX = '.ligand.dill'
+
+
+def keyed_by_ligand(fieldname):
+    """ Decorator marking a task whose outputs depend only on the ligand identity found in
+    its input ``fieldname``
+    """
+    def decorator(func):
+        func.__ligandkey__ = fieldname
+        return func
+    return decorator
+
+
+def ligand_library_key(identity, ph, charges, resname, atomnames, forcefield='gaff2'):
+    """ Library key for a ligand's parameters (kept self-contained, since it's called from
+    tasks)
+
+    Args:
+        identity (str): InChIKey or canonical SMILES
+        ph (float): pH the ligand was protonated at
+        charges (str): charge model
+        resname (str): the ligand's residue name(s) (not ``ligandname``, which includes the
+            residue numbers)
+        atomnames (List[str]): names of the ligand's atoms, after protonation
+        forcefield (str): the force field the parameters are for
+    """
+    import hashlib
+
+    names = hashlib.sha1('\n'.join(sorted(atomnames))).hexdigest()[:16]
+    return '%s/pH%.2f/%s/%s/%s/atoms-%s' % (identity, ph, charges, forcefield, resname, names)
+
+
+class LigandLibrary(object):
+    """ Directory of stored ligand parameters
+
+    Args:
+        directory (str): location of the library (created if necessary)
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:  # created by another process in the meantime
+                if not os.path.isdir(self.directory):
+                    raise
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key).hexdigest() + ENTRY_SUFFIX)
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def load(self, key):
+        """ Returns the stored outputs for a ligand key, or None
+        """
+        import dill
+
+        try:
+            with open(self._path(key), 'rb') as infile:
+                entry = dill.load(infile)
+        except (IOError, OSError, EOFError):
+            return None
+        return entry['outputs']
+
+    def store(self, key, outputs):
+        """ Store a task's outputs (a dict) under a ligand key
+        """
+        import dill
+
+        if key in self:
+            return
+        fd, tmppath = tempfile.mkstemp(dir=self.directory, prefix='.tmp.')
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                dill.dump({'key': key, 'outputs': outputs}, outfile)
+            os.rename(tmppath, self._path(key))
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+
+    def keys(self):
+        import dill
+
+        for filename in sorted(os.listdir(self.directory)):
+            if filename.endswith(ENTRY_SUFFIX):
+                with open(os.path.join(self.directory, filename), 'rb') as infile:
+                    yield dill.load(infile)['key']
+
+    def export(self, archive):
+        """ Write every entry to a gzipped tarball
+        """
+        count = 0
+        with tarfile.open(archive, 'w:gz') as tar:
+            for filename in sorted(os.listdir(self.directory)):
+                if filename.endswith(ENTRY_SUFFIX):
+                    tar.add(os.path.join(self.directory, filename), arcname=filename)
+                    count += 1
+        pflush('Exported %d ligands to %s' % (count, archive))
+        return count
+
+    def import_archive(self, archive):
+        """ Add the entries from a tarball written by ``export`` (existing entries are kept)
+        """
+        count = 0
+        with tarfile.open(archive, 'r:gz') as tar:
+            for member in tar:
+                filename = os.path.basename(member.name)
+                if (not member.isfile() or filename != member.name
+                        or not filename.endswith(ENTRY_SUFFIX)):
+                    continue
+                if os.path.exists(os.path.join(self.directory, filename)):
+                    continue
+                fd, tmppath = tempfile.mkstemp(dir=self.directory, prefix='.tmp.')
+                with os.fdopen(fd, 'wb') as outfile:
+                    outfile.write(tar.extractfile(member).read())
+                os.rename(tmppath, os.path.join(self.directory, filename))
+                count += 1
+        pflush('Imported %d new ligands from %s' % (count, archive))
+        return count
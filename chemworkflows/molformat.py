@@ -0,0 +1,323 @@
+""" Compact, array-backed molecule files.
+
+Layout (all integers little-endian)::
+
+    MAGIC                      8 bytes
+    arrays                     raw numpy arrays, each starting on a 64-byte boundary:
+                                   positions        float64 (natoms, 3), in angstroms
+                                   atomic_numbers   int16 (natoms,)
+                                   atom_names       S (natoms,)
+                                   atom_pdbnames    S (natoms,)
+                                   atom_pdbindex    int32 (natoms,)
+                                   masses           float64 (natoms,), in daltons
+                                   formal_charges   int16 (natoms,)
+                                   residue_index    int32 (natoms,)
+                                   residue_names    S (nresidues,)
+                                   residue_pdbindex int32 (nresidues,)
+                                   residue_chain    int32 (nresidues,)
+                                   chain_names      S (nchains,)
+                                   bonds            int32 (nbonds, 3): atom1, atom2, order
+    blobs                      raw byte strings for large attachments (e.g., a prmtop), and
+                               a pickle of the molecule's and atoms' ``metadata`` and the
+                               molecule's ``CARRIED_PROPERTIES``
+    header                     JSON: name, charge, the dtype, shape and offset of each array,
+                               the offset and length of each blob, and metadata
+    header offset              uint64
+    MAGIC                      8 bytes
+
+Missing PDB indices are stored as -1. Names that are None are stored as empty strings, and
+their indices listed in the header (``nulls``).
+
+Arrays are stored uncompressed and aligned, so ``MoleculeFile`` hands them out as views of
+a read-only memory map without copying. This is several times smaller and faster to load
+than a pickle of the full moldesign object graph.
+"""
+import json
+import mmap
+import struct
+
+MAGIC = 'CWMOL001'
+ALIGN = 64
+_FOOTER = struct.Struct('<Q')
+_STANDARD_ATTRIBUTES = None
+CARRIED_PROPERTIES = ('bioassemblies',)  # set by moldesign's PDB and mmCIF readers
+
+
+def write_molecule(mol, filename, metadata=None, attachments=None):
+    """ Write a moldesign Molecule in the compact format.
+
+    Args:
+        mol (moldesign.Molecule): molecule to write
+        filename (str): file to write
+        metadata (dict): JSON-serializable values to store in the header
+        attachments (Mapping[str, str]): large strings to store alongside the molecule,
+            e.g. ``{'prmtop': ..., 'inpcrd': ...}``
+
+    This is called inside task containers, which ship functions by source, so it's kept
+    self-contained.
+    """
+    import json
+    import pickle
+    import struct
+    import numpy as np
+
+    magic = 'CWMOL001'  # == MAGIC
+    align = 64  # == ALIGN
+
+    carried = ('bioassemblies',)  # == CARRIED_PROPERTIES
+
+    def magnitude(quantity, unitname):
+        if not hasattr(quantity, 'value_in'):  # already a plain number
+            return quantity
+        from moldesign import units
+        return quantity.value_in(getattr(units, unitname))
+
+    def pdbindex(obj):
+        return obj.pdbindex if obj.pdbindex is not None else -1
+
+    residues, chains = [], []
+    residue_ids, chain_ids = {}, {}
+    residue_index = np.empty(mol.num_atoms, dtype='int32')
+    for iatom, atom in enumerate(mol.atoms):
+        if id(atom.residue) not in residue_ids:
+            residue_ids[id(atom.residue)] = len(residues)
+            residues.append(atom.residue)
+        residue_index[iatom] = residue_ids[id(atom.residue)]
+    for residue in residues:
+        if id(residue.chain) not in chain_ids:
+            chain_ids[id(residue.chain)] = len(chains)
+            chains.append(residue.chain)
+
+    atom_ids = {id(atom): i for i, atom in enumerate(mol.atoms)}
+    bonds = np.array([[atom_ids[id(bond.a1)], atom_ids[id(bond.a2)], bond.order or 1]
+                      for bond in mol.bonds], dtype='int32').reshape(-1, 3)
+
+    arrays = [('positions', np.asarray(magnitude(mol.positions, 'angstrom'),
+                                       dtype='float64').reshape(-1, 3)),
+              ('atomic_numbers', np.array([atom.atnum for atom in mol.atoms], dtype='int16')),
+              ('atom_names', [atom.name for atom in mol.atoms]),
+              ('atom_pdbnames', [atom.pdbname for atom in mol.atoms]),
+              ('atom_pdbindex', np.array([pdbindex(atom) for atom in mol.atoms], dtype='int32')),
+              ('masses', np.array([magnitude(atom.mass, 'amu') for atom in mol.atoms],
+                                  dtype='float64')),
+              ('formal_charges', np.array([magnitude(atom.formal_charge, 'q_e')
+                                           for atom in mol.atoms], dtype='int16')),
+              ('residue_index', residue_index),
+              ('residue_names', [r.pdbname for r in residues]),
+              ('residue_pdbindex', np.array([pdbindex(r) for r in residues], dtype='int32')),
+              ('residue_chain', np.array([chain_ids[id(r.chain)] for r in residues],
+                                         dtype='int32')),
+              ('chain_names', [c.name for c in chains]),
+              ('bonds', bonds)]
+
+    attachments = dict(attachments or {})
+    atom_metadata = {i: atom.metadata for i, atom in enumerate(mol.atoms) if atom.metadata}
+    properties = {name: mol.properties[name] for name in carried if name in mol.properties}
+    if mol.metadata or atom_metadata or properties:
+        attachments['_metadata.pickle'] = pickle.dumps(
+                (mol.metadata, atom_metadata, properties), 2)
+
+    header = {'format': 1,
+              'name': mol.name,
+              'charge': int(magnitude(mol.charge, 'q_e')),
+              'natoms': mol.num_atoms,
+              'arrays': {},
+              'blobs': {},
+              'nulls': {},
+              'metadata': metadata or {}}
+
+    with open(filename, 'wb') as outfile:
+        outfile.write(magic)
+        for name, array in arrays:
+            if isinstance(array, list):  # names
+                nulls = [i for i, value in enumerate(array) if value is None]
+                if nulls:
+                    header['nulls'][name] = nulls
+                array = np.array([value or '' for value in array], dtype='S')
+            outfile.write('\0' * (-outfile.tell() % align))
+            header['arrays'][name] = {'offset': outfile.tell(),
+                                      'dtype': array.dtype.str,
+                                      'shape': list(array.shape)}
+            outfile.write(np.ascontiguousarray(array).tobytes())
+        for name, blob in sorted(attachments.iteritems()):
+            header['blobs'][name] = [outfile.tell(), len(blob)]
+            outfile.write(blob)
+
+        headerstart = outfile.tell()
+        outfile.write(json.dumps(header))
+        outfile.write(struct.pack('<Q', headerstart))
+        outfile.write(magic)
+
+
+class MoleculeFile(object):
+    """ Memory-mapped reader for compact molecule files
+
+    Examples:
+        >>> with MoleculeFile('mol.cwmol') as molfile:
+        ...     xyz = molfile.arrays['positions']  # zero-copy view, in angstroms
+        ...     mol = molfile.to_molecule()  # requires moldesign
+    """
+    def __init__(self, filename):
+        import numpy as np
+
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        footerstart = len(self._map) - _FOOTER.size - len(MAGIC)
+        if (self._map[:len(MAGIC)] != MAGIC or
+                self._map[footerstart + _FOOTER.size:] != MAGIC):
+            raise IOError('%s is not a compact molecule file' % filename)
+        headerstart, = _FOOTER.unpack(self._map[footerstart:footerstart + _FOOTER.size])
+        self.header = json.loads(self._map[headerstart:footerstart])
+
+        self.arrays = {}
+        for name, spec in self.header['arrays'].iteritems():
+            dtype = np.dtype(str(spec['dtype']))
+            count = int(np.prod(spec['shape'])) if spec['shape'] else 0
+            self.arrays[name] = np.frombuffer(self._map, dtype=dtype, count=count,
+                                              offset=spec['offset']).reshape(spec['shape'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # the map itself is released once no array views of it are left
+        self.arrays = {}
+        self._map = None
+        self._file.close()
+
+    @property
+    def name(self):
+        return self.header['name']
+
+    @property
+    def natoms(self):
+        return self.header['natoms']
+
+    @property
+    def metadata(self):
+        return self.header['metadata']
+
+    def names(self, name):
+        """ List[str]: one of the arrays of names, with None for names that were None
+        """
+        values = list(self.arrays[name])
+        for i in self.header['nulls'].get(name, ()):
+            values[i] = None
+        return values
+
+    def attachment(self, name):
+        """ str: contents of a stored attachment
+        """
+        offset, length = self.header['blobs'][name]
+        return self._map[offset:offset + length]
+
+    def to_molecule(self):
+        """ Build a moldesign Molecule from the stored arrays
+        """
+        import pickle
+        import moldesign as mdt
+        from moldesign import units as u
+
+        arrays = self.arrays
+        chains = [mdt.Chain(pdbname=name) for name in self.names('chain_names')]
+        residues = []
+        for resname, pdbindex, ichain in zip(self.names('residue_names'),
+                                             arrays['residue_pdbindex'],
+                                             arrays['residue_chain']):
+            residue = mdt.Residue(pdbname=resname,
+                                  pdbindex=None if pdbindex < 0 else int(pdbindex))
+            residue.chain = chains[ichain]
+            chains[ichain].add(residue)
+            residues.append(residue)
+
+        atomnames, pdbnames = self.names('atom_names'), self.names('atom_pdbnames')
+        atoms = []
+        for i, ires in enumerate(arrays['residue_index']):
+            pdbindex = arrays['atom_pdbindex'][i]
+            atom = mdt.Atom(name=atomnames[i],
+                            atnum=int(arrays['atomic_numbers'][i]),
+                            pdbname=pdbnames[i],
+                            pdbindex=None if pdbindex < 0 else int(pdbindex),
+                            mass=float(arrays['masses'][i]) * u.amu,
+                            formal_charge=int(arrays['formal_charges'][i]) * u.q_e)
+            atom.residue = residues[ires]
+            residues[ires].add(atom)
+            atoms.append(atom)
+
+        for a1, a2, order in arrays['bonds']:
+            atoms[a1].bond_to(atoms[a2], int(order))
+
+        if '_metadata.pickle' in self.header['blobs']:
+            metadata, atom_metadata, properties = pickle.loads(
+                    self.attachment('_metadata.pickle'))
+        else:
+            metadata, atom_metadata, properties = None, {}, {}
+        mol = mdt.Molecule(atoms, name=self.name, charge=self.header['charge'] * u.q_e,
+                           metadata=metadata)
+        mol.positions = arrays['positions'] * u.angstrom
+        for i, value in atom_metadata.iteritems():
+            mol.atoms[i].metadata = value
+        mol.properties.update(properties)
+        return mol
+
+
+def is_plain_molecule(value):
+    """ True if ``value`` is a moldesign Molecule that the compact format can hold without
+    losing anything: no energy model, integrator, force field, constraints, calculated
+    properties (other than ``CARRIED_PROPERTIES``) or momenta, and no attributes on it or its atoms, residues and chains
+    beyond the ones moldesign itself sets
+    """
+    import numpy as np
+
+    cls = type(value)
+    if cls.__name__ != 'Molecule' or not cls.__module__.startswith('moldesign'):
+        return False
+    if (getattr(value, 'energy_model', None) is not None or
+            getattr(value, 'integrator', None) is not None or
+            getattr(value, 'ff', None) is not None or
+            value.constraints or
+            set(value.properties) - {'positions'} - set(CARRIED_PROPERTIES) or
+            getattr(value.time, 'magnitude', value.time) or
+            np.any(getattr(value.momenta, 'magnitude', value.momenta))):
+        return False
+
+    known = _standard_attributes()
+    return (set(vars(value)) <= known['molecule'] and
+            all(set(vars(atom)) <= known['atom'] for atom in value.atoms) and
+            all(set(vars(residue)) <= known['residue'] for residue in value.residues) and
+            all(set(vars(chain)) <= known['chain'] for chain in value.chains))
+
+
+def _standard_attributes():
+    """ Names of the attributes that moldesign sets on molecules, atoms, residues and
+    chains built the way ``MoleculeFile.to_molecule`` builds them
+    """
+    global _STANDARD_ATTRIBUTES
+    if _STANDARD_ATTRIBUTES is None:
+        import moldesign as mdt
+
+        chain = mdt.Chain(pdbname='A')
+        residue = mdt.Residue(pdbname='UNK', pdbindex=1)
+        residue.chain = chain
+        chain.add(residue)
+        atom = mdt.Atom(name='C', atnum=6, pdbname='C', pdbindex=1)
+        atom.residue = residue
+        residue.add(atom)
+        mol = mdt.Molecule([atom])
+        _STANDARD_ATTRIBUTES = {'molecule': set(vars(mol)),
+                                'atom': set(vars(atom)),
+                                'residue': set(vars(residue)),
+                                'chain': set(vars(chain))}
+    return _STANDARD_ATTRIBUTES
+
+
+def read_molecule(filename):
+    """ Load a compact molecule file as a moldesign Molecule
+    """
+    with MoleculeFile(filename) as molfile:
+        return molfile.to_molecule()
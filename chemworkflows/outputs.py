@@ -0,0 +1,262 @@
+""" Write a finished workflow's (or task's) outputs to disk.
+
+Each value is written by the first writer in ``WRITERS`` that accepts it:
+
+    =============  ==========  ==========================================================
+    format         extension   values
+    =============  ==========  ==========================================================
+    text           (none)      strings
+    cwmol          .cwmol      moldesign Molecules (see ``molformat``)
+    ctraj          .ctraj      moldesign Trajectories (see ``trajformat``)
+    quantity       .json       quantities with units, as ``{"value": ..., "units": ...}``
+    npz            .npz        numpy arrays, and dicts of them (compressed)
+    file           (none)      file references (anything with a ``put`` method)
+    stream         (none)      file-like objects
+    json           .json       anything else JSON can represent
+    dill           .dill       everything else
+    =============  ==========  ==========================================================
+
+Other formats can be added with ``register_writer``. Values are streamed to their files in
+chunks rather than built up in memory first, and ``.tar.gz`` outputs are unpacked
+in-process into the output directory. Independent outputs are written concurrently, and
+``MANIFEST`` lists each output's file, format and size.
+"""
+from __future__ import print_function
+
+import json
+import os
+import sys
+import tarfile
+import time
+from multiprocessing.pool import ThreadPool
+
+import dill
+
+from .utils import human_bytes, pflush
+
+CHUNKSIZE = 1024**2
+DEFAULT_WRITERS = 4
+MANIFEST = 'output_manifest.json'
+
+WRITERS = []  # (format, test, write), in the order they're tried
+
+
+class UnsupportedValue(Exception):
+    """ Raised by a writer that turns out not to be able to write a value after all
+    """
+
+
+def register_writer(format, test, first=True):
+    """ Decorator registering a function that writes a type of output value
+
+    The function is called as ``write(value, filebase)``, and returns the path of the file
+    it wrote (usually ``filebase`` plus an extension). It may raise ``UnsupportedValue`` to
+    let the next writer try.
+
+    Args:
+        format (str): name of the format, recorded in the manifest
+        test (callable): ``test(value)`` is True for values this writer handles
+        first (bool): try this writer before the ones already registered (otherwise after)
+    """
+    def decorator(write):
+        entry = (format, test, write)
+        if first:
+            WRITERS.insert(0, entry)
+        else:
+            WRITERS.append(entry)
+        return write
+    return decorator
+
+
+def write_outputs(runner, outdir, nthreads=DEFAULT_WRITERS):
+    """ Write each of ``runner.outputfields`` to a file in ``outdir``, plus the manifest
+
+    Returns:
+        List[dict]: description of each output that was written - its name, filename,
+            format, size in bytes and time taken
+    """
+    def write_one(name):
+        return write_output(name, runner.getoutput(name), outdir)
+
+    fields = list(runner.outputfields)
+    if nthreads <= 1 or len(fields) <= 1:
+        written = map(write_one, fields)
+    else:
+        pool = ThreadPool(min(nthreads, len(fields)))
+        try:
+            written = pool.map(write_one, fields)
+        finally:
+            pool.close()
+
+    with open(os.path.join(outdir, MANIFEST), 'w') as manifestfile:
+        json.dump({'outputs': written}, manifestfile, indent=2)
+    return written
+
+
+def write_output(name, value, outdir):
+    """ Write a single output value, then unpack it if it's a gzipped tarball
+    """
+    start = time.time()
+    filebase = os.path.join(outdir, name)
+    for format, test, write in WRITERS:
+        if not test(value):
+            continue
+        try:
+            fname = write(value, filebase)
+        except UnsupportedValue:
+            continue
+        break
+    else:
+        raise TypeError('No writer for output "%s" (%s)' % (name, type(value).__name__))
+
+    nbytes = os.path.getsize(fname)
+    if fname.endswith('.tar.gz'):
+        extract_tarball(fname, outdir)
+
+    elapsed = time.time() - start
+    pflush('Wrote %s as %s (%s in %.2f s, %s/s)'
+           % (os.path.basename(fname), format, human_bytes(nbytes), elapsed,
+              human_bytes(nbytes / max(elapsed, 1e-6))))
+    return {'name': name,
+            'filename': os.path.basename(fname),
+            'format': format,
+            'bytes': nbytes,
+            'seconds': elapsed}
+
+
+def extract_tarball(fname, destdir):
+    """ Unpack a gzipped tarball into ``destdir``, refusing paths that would escape it
+    """
+    destdir = os.path.abspath(destdir)
+    with tarfile.open(fname, 'r:gz') as tar:
+        for member in tar:
+            target = os.path.abspath(os.path.join(destdir, member.name))
+            if not target.startswith(destdir + os.sep):
+                raise ValueError('Refusing to extract "%s" outside of %s'
+                                 % (member.name, destdir))
+            tar.extract(member, destdir)
+
+
+def _is_moldesign(value, classname):
+    cls = type(value)
+    return (cls.__module__.startswith('moldesign') and
+            any(base.__name__ == classname for base in cls.__mro__))
+
+
+def _is_array(value):
+    numpy = sys.modules.get('numpy')  # if it isn't imported, this can't be an array
+    return numpy is not None and isinstance(value, numpy.ndarray)
+
+
+def _is_arrays(value):
+    """ True for an array, or a non-empty dict of arrays keyed by name
+    """
+    if isinstance(value, dict):
+        return bool(value) and all(isinstance(key, basestring) and _is_array(array)
+                                   for key, array in value.iteritems())
+    return _is_array(value)
+
+
+def _is_quantity(value):
+    return hasattr(value, 'magnitude') and hasattr(value, 'units')
+
+
+def _always(value):
+    return True
+
+
+# each writer is tried before the ones registered before it: text first, dill last
+
+
+@register_writer('dill', _always)
+def _write_dill(value, filebase):
+    fname = filebase + '.dill'
+    with open(fname, 'wb') as outfile:
+        dill.dump(value, outfile)
+    return fname
+
+
+@register_writer('json', _always)
+def _write_json(value, filebase):
+    fname = filebase + '.json'
+    try:
+        with open(fname, 'w') as outfile:
+            json.dump(value, outfile)
+            outfile.write('\n')
+    except (TypeError, ValueError):
+        os.remove(fname)
+        raise UnsupportedValue()
+    return fname
+
+
+@register_writer('stream', lambda value: hasattr(value, 'read'))
+def _write_stream(value, filebase):
+    with open(filebase, 'wb') as outfile:
+        _copy_stream(value, outfile)
+    return filebase
+
+
+@register_writer('file', lambda value: hasattr(value, 'put'))
+def _write_file(value, filebase):
+    value.put(filebase)
+    return filebase
+
+
+@register_writer('npz', _is_arrays)
+def _write_npz(value, filebase):
+    import numpy as np
+
+    fname = filebase + '.npz'
+    arrays = value if isinstance(value, dict) else {'value': value}
+    np.savez_compressed(fname, **arrays)
+    return fname
+
+
+@register_writer('quantity', _is_quantity)
+def _write_quantity(value, filebase):
+    magnitude = value.magnitude
+    if hasattr(magnitude, 'tolist'):
+        magnitude = magnitude.tolist()
+    fname = filebase + '.json'
+    with open(fname, 'w') as outfile:
+        json.dump({'value': magnitude, 'units': str(value.units)}, outfile)
+        outfile.write('\n')
+    return fname
+
+
+@register_writer('ctraj', lambda value: _is_moldesign(value, 'Trajectory'))
+def _write_ctraj(value, filebase):
+    from .trajformat import write_trajectory
+
+    fname = filebase + '.ctraj'
+    write_trajectory(value, fname)
+    return fname
+
+
+@register_writer('cwmol', lambda value: _is_moldesign(value, 'Molecule'))
+def _write_cwmol(value, filebase):
+    from .molformat import write_molecule
+
+    fname = filebase + '.cwmol'
+    write_molecule(value, fname)
+    return fname
+
+
+@register_writer('text', lambda value: isinstance(value, basestring))
+def _write_text(value, filebase):
+    with open(filebase, 'w') as outfile:
+        outfile.write(value)
+        outfile.write('\n')
+    return filebase
+
+
+def _copy_stream(source, outfile):
+    try:
+        chunk = source.read(CHUNKSIZE)
+    except TypeError:  # read() doesn't take a size (e.g., pyccc file references)
+        outfile.write(source.read())
+        return
+
+    while chunk:
+        outfile.write(chunk)
+        chunk = source.read(CHUNKSIZE)
@@ -0,0 +1,261 @@
+""" Per-task timing and data-volume profiles (``chemworkflow --profile``).
+
+For every task, the runner records when it was submitted (its inputs were ready), started
+(it got a slot) and finished (its results were back), plus the serialized size of its
+inputs and outputs. Tasks that run as engine jobs are split further: ``launch`` (sending
+the inputs and creating the job - including any image pull on a local docker engine),
+``startup`` (from then until the task's function was called: starting the container, or
+waiting and pulling on a CCC server, and loading the inputs), ``compute`` (the function
+itself, timed inside the job), ``download`` (fetching the results) and ``store`` (caching
+and recording them). Each output is measured once, when its task finishes (from the
+checkpoint's record of it, if there is one); an input's size is that of the upstream output
+it comes from. ``Profiler.write`` saves these as:
+
+    profile.json         every task's timestamps, durations and sizes, the time spent
+                         writing each workflow output, the checkpoint's artifact
+                         deduplication statistics, peak memory use and output
+                         spilling statistics, and the critical path
+    profile.trace.json   the same tasks in Chrome's trace event format (open it at
+                         chrome://tracing or https://ui.perfetto.dev)
+"""
+from __future__ import print_function
+
+import collections
+import json
+import os
+import threading
+import time
+
+from .artifacts import is_file_reference
+from .runners import task_image, upstream_tasknames
+from .spill import memory_summary
+from .utils import pflush
+
+PROFILE = 'profile.json'
+TRACE = 'profile.trace.json'
+
+# the phases of each task, as (name, start event, end event); all but ``queued`` and
+# ``run`` are only recorded for engine jobs
+PHASES = (('queued', 'submit', 'start'),
+          ('run', 'start', 'finish'),
+          ('launch', 'start', 'launched'),
+          ('startup', 'launched', 'compute_start'),
+          ('compute', 'compute_start', 'compute_end'),
+          ('finishing', 'compute_end', 'job_done'),
+          ('download', 'job_done', 'fetched'),
+          ('store', 'fetched', 'finish'))
+DETAIL_PHASES = ('launch', 'startup', 'compute', 'download')  # for the critical path
+
+
+class Profiler(object):
+    """ Collects timestamps and data sizes for the tasks of one runner
+    """
+    def __init__(self):
+        self.created = time.time()
+        self.tasks = collections.OrderedDict()
+        self.outputs = []
+        self.artifacts = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _record(self, taskname):
+        with self._lock:
+            return self.tasks.setdefault(taskname, {'events': {}})
+
+    def event(self, taskname, eventname):
+        """ Record that something just happened to a task (e.g., ``'submit'``)
+        """
+        self._record(taskname)['events'][eventname] = time.time()
+
+    def chain_timings(self, tasknames, timings):
+        """ Record when each task of an engine job computed, from the ``timings`` that
+        ``fusion.run_task_chain`` wrote. They're taken by the job's clock: if they don't fit
+        between the job's launch and its end by this machine's clock (e.g., the job ran on a
+        server whose clock is off), they're shifted so that the chain ends when the job was
+        seen to finish.
+        """
+        events = self._record(tasknames[0])['events']
+        launched, done = events.get('launched'), events.get('job_done')
+        if launched is None or done is None:
+            return
+        offset = 0.0
+        if not launched <= timings['start'] <= timings['end'] <= done:
+            offset = done - timings['end']
+        for name, (start, end) in timings['tasks'].iteritems():
+            events = self._record(name)['events']
+            events['compute_start'] = start + offset
+            events['compute_end'] = end + offset
+
+    def update(self, taskname, **values):
+        self._record(taskname).update(values)
+
+    def record_task(self, runner, task):
+        """ Record the sizes of a finished task's outputs: from the checkpoint, if it has
+        recorded the task already, and otherwise by serializing each output once
+        """
+        name = task.spec.name
+        checkpoint = getattr(runner, 'checkpoint', None)
+        if checkpoint is not None and name in checkpoint:
+            sizes = {field: artifact['bytes']
+                     for field, artifact in checkpoint.task_record(name)['fields'].iteritems()}
+        else:
+            sizes = {field: serialized_size(task.getoutput(field))
+                     for field in task.outputfields}
+        self.update(name, output_bytes=sizes)
+
+    def input_sizes(self, runner, task):
+        """ Sizes of a task's inputs: those of the upstream outputs they come from, or, for
+        the workflow's inputs and constants, their serialized sizes
+        """
+        sizes = {}
+        for field, source in task.spec.inputfields.iteritems():
+            upstream = getattr(source, 'task', None)
+            if upstream is not None:
+                outputs = self.tasks.get(upstream.name, {}).get('output_bytes', {})
+                sizes[field] = outputs.get(source.field)
+            else:
+                try:
+                    sizes[field] = serialized_size(runner.input_value(task, field))
+                except Exception:
+                    sizes[field] = None
+        return sizes
+
+    def task_summary(self, runner):
+        """ Timing and size summary for every profiled task, in workflow order
+        """
+        summary = collections.OrderedDict()
+        for name in runner.tasks:
+            if name not in self.tasks:
+                continue
+            record = self.tasks[name]
+            events = record['events']
+            entry = {'image': task_image(runner.workflow, runner.tasks[name]),
+                     'source': record.get('source', 'run'),
+                     'upstream': sorted(upstream_tasknames(runner.tasks[name])),
+                     'events': {k: v - self.created for k, v in events.iteritems()},
+                     'seconds': {}}
+            for phase, begin, end in PHASES:
+                if begin in events and end in events:
+                    entry['seconds'][phase] = events[end] - events[begin]
+            if 'output_bytes' in record:
+                record['input_bytes'] = self.input_sizes(runner, runner.tasks[name])
+            for sizes in ('input_bytes', 'output_bytes'):
+                if sizes in record:
+                    entry[sizes] = record[sizes]
+                    entry['total_' + sizes] = sum(v for v in record[sizes].itervalues()
+                                                  if v is not None)
+            summary[name] = entry
+        return summary
+
+    def critical_path(self, runner):
+        """ The chain of tasks that determined when the workflow finished.
+
+        Starting from the task that finished last, repeatedly step to the upstream task
+        that finished last - i.e., the one that this task was waiting for.
+        """
+        def finished(name):
+            events = self.tasks.get(name, {}).get('events', {})
+            return events.get('finish')
+
+        remaining = [name for name in self.tasks if finished(name) is not None]
+        path = []
+        while remaining:
+            name = max(remaining, key=finished)
+            path.append(name)
+            remaining = [n for n in upstream_tasknames(runner.tasks[name])
+                         if finished(n) is not None]
+        path.reverse()
+        return path
+
+    def write(self, runner, outdir):
+        """ Write ``profile.json`` and ``profile.trace.json`` and print the critical path
+        """
+        tasks = self.task_summary(runner)
+        path = self.critical_path(runner)
+        profile = {'workflow': runner.workflow.name,
+                   'start_time': self.created,
+                   'wall_seconds': time.time() - self.created,
+                   'tasks': tasks,
+                   'outputs': self.outputs,
+                   'artifacts': self.artifacts,
+                   'memory': memory_summary(runner),
+                   'critical_path': path}
+        with open(os.path.join(outdir, PROFILE), 'w') as outfile:
+            json.dump(profile, outfile, indent=2)
+        with open(os.path.join(outdir, TRACE), 'w') as outfile:
+            json.dump(self.trace_events(tasks), outfile)
+
+        print_critical_path(tasks, path)
+        pflush('Profile written to %s (timeline: %s)' % (os.path.join(outdir, PROFILE),
+                                                         os.path.join(outdir, TRACE)))
+
+    def trace_events(self, tasks):
+        """ Chrome trace events: one row per concurrently running task, one slice per phase
+        """
+        lanes = []  # end time of the last task placed in each row
+        events = []
+        for name, entry in sorted(tasks.iteritems(),
+                                  key=lambda item: min(item[1]['events'].values())):
+            times = entry['events']
+            begin, end = min(times.values()), max(times.values())
+            for lane, lane_end in enumerate(lanes):
+                if lane_end <= begin:
+                    break
+            else:
+                lane = len(lanes)
+                lanes.append(None)
+            lanes[lane] = end
+
+            for phase, first, last in PHASES:
+                if first in times and last in times:
+                    events.append({'name': '%s (%s)' % (name, phase) if phase != 'run' else name,
+                                   'cat': phase,
+                                   'ph': 'X',
+                                   'pid': 1,
+                                   'tid': lane,
+                                   'ts': int(times[first] * 1e6),
+                                   'dur': int((times[last] - times[first]) * 1e6),
+                                   'args': {'image': entry['image'],
+                                            'source': entry['source'],
+                                            'input_bytes': entry.get('total_input_bytes'),
+                                            'output_bytes': entry.get('total_output_bytes')}})
+        return events
+
+
+def print_critical_path(tasks, path):
+    if not path:
+        return
+    pflush('\nCritical path (%d tasks):' % len(path))
+    for name in path:
+        seconds = tasks[name]['seconds']
+        details = ', '.join('%s %.2f s' % (phase, seconds[phase])
+                            for phase in DETAIL_PHASES if phase in seconds)
+        pflush('    %-30s  queued %7.2f s   run %8.2f s%s'
+               % (name, seconds.get('queued', 0.0), seconds.get('run', 0.0),
+                  '  (%s)' % details if details else ''))
+    first, last = tasks[path[0]]['events'], tasks[path[-1]]['events']
+    pflush('    total: %.2f s' % (max(last.values()) - min(first.values())))
+
+
+def serialized_size(value):
+    """ Size of a value, in bytes, as it would be shipped between tasks (None if unknown)
+    """
+    import dill
+
+    if is_file_reference(value):  # only local files have a known size
+        path = getattr(value, 'localpath', None)
+        if path and os.path.exists(path):
+            return os.path.getsize(path)
+        return None
+    try:
+        return len(dill.dumps(value))
+    except Exception:
+        return None
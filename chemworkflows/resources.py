@@ -0,0 +1,225 @@
+""" Per-task CPU and memory requirements, and packing concurrent tasks onto one machine.
+
+Tasks declare what they need with ``requires``, next to their ``__image__``::
+
+    @vde.task(__image__=NWCHEMIMAGE, mol=read_molecule['mol'])
+    @requires(cores=8, memory='4g')
+    def minimize_doublet(mol):
+        ...
+
+Tasks marked ``fusion.lightweight`` need almost nothing (``LIGHTWEIGHT``); all others get
+``DEFAULT_CORES`` and ``DEFAULT_MEMORY``.
+
+A ``ResourcePool`` holds the cores and memory of the machine the tasks run on. Runners
+that share one (e.g., every runner in a batch) only start a task once its cores and memory
+are free, so concurrent tasks from any number of workflows never oversubscribe the machine;
+a task that asks for more than the whole machine gets all of it. While a task runs, its
+allocation is available to the engine in the same thread (``current_allocation``), and
+``LocalDocker`` passes it into the task's container as ``thread_environment`` variables
+(which only fully apply in fresh containers; see ``thread_environment``).
+"""
+from __future__ import print_function
+
+import atexit
+import contextlib
+import multiprocessing
+import os
+import posixpath
+import re
+import shutil
+import tempfile
+import threading
+
+import pyccc
+from pyccc import docker_utils
+
+DEFAULT_CORES = 1
+DEFAULT_MEMORY = 1024**3
+ARTIFACT_MOUNT = '/chemworkflows/artifacts'  # where ``LocalDocker`` mounts its artifact store
+LIGHTWEIGHT = {'cores': 0, 'memory': 256 * 1024**2}
+
+_MEMORY_UNITS = {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3, 't': 1024**4}
+_local = threading.local()
+
+
+def requires(cores=DEFAULT_CORES, memory=DEFAULT_MEMORY):
+    """ Decorator declaring the cores and memory a task needs
+
+    Args:
+        cores (int): number of cores the task can keep busy
+        memory (int or str): bytes of memory, or a size like ``'512m'`` or ``'4g'``
+    """
+    def decorator(func):
+        func.__resources__ = {'cores': cores, 'memory': parse_memory(memory)}
+        return func
+    return decorator
+
+
+def parse_memory(size):
+    """ Number of bytes in a size like ``'512m'``, ``'4g'`` or ``'4GB'`` (or a number)
+    """
+    if isinstance(size, (int, long, float)):
+        return int(size)
+    match = re.match(r'^\s*([\d.]+)\s*([kmgt]?)b?\s*$', size.lower())
+    if match is None:
+        raise ValueError('Invalid memory size "%s"' % size)
+    return int(float(match.group(1)) * _MEMORY_UNITS[match.group(2)])
+
+
+def task_resources(task):
+    """ The cores and memory a workflow task needs
+
+    Returns:
+        dict: ``cores`` and ``memory`` (in bytes)
+    """
+    func = task.spec.func
+    if hasattr(func, '__resources__'):
+        return dict(func.__resources__)
+    elif getattr(func, '__lightweight__', False):
+        return dict(LIGHTWEIGHT)
+    else:
+        return {'cores': DEFAULT_CORES, 'memory': DEFAULT_MEMORY}
+
+
+def combined_resources(requests):
+    """ What a job running several tasks one after another needs
+    """
+    return {'cores': max(request['cores'] for request in requests),
+            'memory': max(request['memory'] for request in requests)}
+
+
+def thread_environment(allocation):
+    """ Environment variables telling a task's numerical libraries and MPI launchers how
+    many cores (and how much memory) it has
+
+    Most libraries (OpenMP, MKL, OpenBLAS, OpenMM) read these once, when they're first
+    loaded, so they only take full effect in a fresh container. In a pooled worker
+    (``containerpool``) or a local process of a hybrid run, libraries that an earlier task
+    already loaded keep the thread counts they started with; only the
+    ``CHEMWORKFLOWS_*`` variables and programs the task launches itself see the new values.
+    """
+    cores = str(max(allocation['cores'], 1))
+    return {'OMP_NUM_THREADS': cores,
+            'MKL_NUM_THREADS': cores,
+            'OPENBLAS_NUM_THREADS': cores,
+            'OPENMM_CPU_THREADS': cores,
+            'CHEMWORKFLOWS_CORES': cores,  # e.g., for ``mpirun -np $CHEMWORKFLOWS_CORES``
+            'CHEMWORKFLOWS_MEMORY_MB': str(allocation['memory'] // 1024**2)}
+
+
+def current_allocation():
+    """ The allocation of the task running in this thread (or None)
+    """
+    return getattr(_local, 'allocation', None)
+
+
+@contextlib.contextmanager
+def allocated(request, pool=None):
+    """ Run a task with the resources it requested: wait for them to be free in ``pool``
+    (if there is one), and make them this thread's ``current_allocation``
+    """
+    allocation = pool.acquire(request) if pool is not None else dict(request)
+    previous = current_allocation()
+    _local.allocation = allocation
+    try:
+        yield allocation
+    finally:
+        _local.allocation = previous
+        if pool is not None:
+            pool.release(allocation)
+
+
+def physical_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+class ResourcePool(object):
+    """ The cores and memory available to tasks, shared by every runner that uses it
+
+    Args:
+        cores (int): number of cores (default: all of this machine's)
+        memory (int or str): memory (default: all of this machine's physical memory)
+    """
+    def __init__(self, cores=None, memory=None):
+        self.cores = cores or multiprocessing.cpu_count()
+        self.memory = parse_memory(memory) if memory else physical_memory()
+        self.free_cores = self.cores
+        self.free_memory = self.memory
+        self._lock = threading.Condition()
+
+    def acquire(self, request):
+        """ Wait until a request fits in the free resources, and take them
+
+        Returns:
+            dict: the allocation (the request, reduced to the pool's total size if it's
+                larger) - pass it to ``release`` once the task is done
+        """
+        allocation = {'cores': min(request['cores'], self.cores),
+                      'memory': min(request['memory'], self.memory)}
+        with self._lock:
+            while (allocation['cores'] > self.free_cores or
+                   allocation['memory'] > self.free_memory):
+                self._lock.wait()
+            self.free_cores -= allocation['cores']
+            self.free_memory -= allocation['memory']
+        return allocation
+
+    def release(self, allocation):
+        with self._lock:
+            self.free_cores += allocation['cores']
+            self.free_memory += allocation['memory']
+            self._lock.notify_all()
+
+    def __repr__(self):
+        return '<ResourcePool: %d/%d cores, %d/%d MB free>' % (
+            self.free_cores, self.cores, self.free_memory // 1024**2, self.memory // 1024**2)
+
+
+class LocalDocker(pyccc.Docker):
+    """ Docker engine that passes each task's allocation (see ``allocated``) into its
+    container as ``thread_environment`` variables
+
+    Its containers also mount an artifact store directory read-only at ``ARTIFACT_MOUNT``,
+    so that runners can pass large task inputs by reference (see
+    ``runners.ParallelCCCRunner.input_reference``): each is written to the store once,
+    and every task that reads it loads it from there instead of getting its own copy.
+
+    Args:
+        client (docker.Client): passed to ``pyccc.Docker``
+        artifact_dir (str): the artifact store to mount (default: a temporary directory,
+            removed at exit)
+    """
+    def __init__(self, client=None, artifact_dir=None, **kwargs):
+        super(LocalDocker, self).__init__(client, **kwargs)
+        if artifact_dir is None:
+            artifact_dir = tempfile.mkdtemp(prefix='chemworkflows-artifacts.')
+            atexit.register(shutil.rmtree, artifact_dir, True)
+        self.artifact_dir = os.path.abspath(os.path.expanduser(artifact_dir))
+        if not os.path.isdir(self.artifact_dir):
+            os.makedirs(self.artifact_dir)
+
+    def artifact_path(self, relpath):
+        """ Path in a container of a file in the artifact store
+        """
+        return posixpath.join(ARTIFACT_MOUNT, *relpath.split(os.sep))
+
+    def submit(self, job):
+        return self._submit_container(job, current_allocation())
+
+    def _submit_container(self, job, allocation):
+        self._check_job(job)
+        if not hasattr(job, 'workingdir'):
+            job.workingdir = self.default_wdir
+        job.imageid = docker_utils.create_provisioned_image(self.client, job.image,
+                                                            job.workingdir, job.inputs)
+        binds = {self.artifact_dir: {'bind': ARTIFACT_MOUNT, 'mode': 'ro'}}
+        job.container = self.client.create_container(
+                job.imageid,
+                command="sh -c '%s'" % job.command,
+                working_dir=job.workingdir,
+                environment=thread_environment(allocation) if allocation else None,
+                volumes=[ARTIFACT_MOUNT],
+                host_config=self.client.create_host_config(binds=binds))
+        self.client.start(job.container)
+        job.containerid = job.container['Id']
+        job.jobid = job.containerid
@@ -7,13 +7,18 @@ dill.extend(False)  # needing to do this is bullshit
 
 import yaml
 import pyccc
-from pyccc.workflow.runner import SerialCCCRunner, SerialRuntimeRunner
 
-from .apps import vde, MMminimize, simsetup
+from . import (checkpoint, containerpool, jobs, ligandlib, profiling, resources,
+               speculation, spill, structures)
+from .cache import ResultCache
+from .outputs import write_outputs
+from .apps import default_inputs, get_app
+from .runners import (DEFAULT_MAX_PARALLEL, ParallelCCCRunner, ParallelHybridRunner,
+                      ParallelRuntimeRunner, is_user_interaction, preprocessor_taskname,
+                      task_image)
+from .utils import human_bytes
 
-APPNAMES = {'minimize': MMminimize.minimization,
-            'vde': vde.vde,
-            'setuplammps': simsetup.simsetup}
+STATEDIR = 'workflow_state'
 
 
 def main(args):
@@ -24,12 +29,24 @@ def main(args):
         sys.exit(0)
 
     engine, RunnerClass = get_execution_env(args)
-    inputjson = process_input_file(args.inputfile)
-    app = APPNAMES[args.appname]
+    inputjson = localize_input(process_input_file(args.inputfile), args)
+    app = get_app(args.appname)
 
     runner = RunnerClass(app,
                          engine=engine,
-                         molecule_json=inputjson)
+                         max_parallel=args.max_parallel,
+                         fuse_tasks=not args.no_fusion,
+                         resources=get_resource_pool(args),
+                         spiller=get_spiller(args),
+                         cache=get_cache(args),
+                         ligand_library=get_ligand_library(args),
+                         **workflow_inputs(args, inputjson))
+    attach_checkpoint(runner, args.appname, outdir, args.artifact_store)
+    attach_profiler(runner, args)
+    attach_speculator(runner, args)
+    attach_job_tracker(runner, get_job_tracker(engine))
+    configure_local_tasks(runner, args)
+    prewarm_containers(runner, args.preprocess)
 
     if args.setoutput:
         set_ui_outputs(runner, args)
@@ -44,31 +61,159 @@ def main(args):
 
 
 def run_workflow(runner, outdir):
-    runner.run()
+    """ Run the whole workflow and write its outputs. The spiller (if any) stops
+    tracking the runner afterwards, whether or not the run succeeded.
+    """
+    try:
+        runner.run()
+
+        print '\nWorkflow complete. Output directory:'
+        print "    ", os.path.abspath(outdir)
+
+        if getattr(runner, 'checkpoint', None) is not None:
+            runner.checkpoint.record_all(runner)
+            print 'Checkpoint: %s' % runner.checkpoint.artifacts.summary()
+        if getattr(runner, 'reference_store', None) is not None:
+            print 'Task inputs passed by reference: %s' % runner.reference_store.summary()
+
+        written = write_outputs(runner, outdir)
+
+        memory = spill.memory_summary(runner)
+        print 'Peak memory: %s in this process, %s in its largest finished child process' % (
+            human_bytes(memory['peak_rss_bytes']), human_bytes(memory['peak_child_rss_bytes']))
+        if getattr(runner, 'spiller', None) is not None:
+            print 'Spilled outputs: %s' % runner.spiller.summary()
+
+        if getattr(runner, 'profiler', None) is not None:
+            runner.profiler.outputs = written
+            if getattr(runner, 'checkpoint', None) is not None:
+                runner.profiler.artifacts = runner.checkpoint.artifacts.stats
+            runner.profiler.write(runner, outdir)
+    finally:
+        if getattr(runner, 'spiller', None) is not None:
+            runner.spiller.release(runner)
+
+
+def workflow_inputs(args, inputjson):
+    """ The workflow's inputs: the input molecule, anything passed with
+    ``--workflow-input``, and the app's defaults for the rest
+    """
+    inputs = default_inputs(args.appname)
+    for item in args.workflow_input or []:
+        name, filename = item.split('=', 1)  # the path may contain '='
+        with open(filename, 'r') as infile:
+            inputs[name] = json.load(infile)
+    inputs['molecule_json'] = inputjson
+    return inputs
 
-    print '\nWorkflow complete. Output directory:'
-    print "    ", os.path.abspath(outdir)
 
-    try:
-        with open(os.path.join(outdir, 'workflow_state.dill'), 'w') as outfile:
-            dill.dump(runner, outfile)
-    except Exception as e:
-        print 'ERROR IGNORED: failed to save workflow state'
-        print e
-        print 'IGNORING ...'
+def attach_checkpoint(runner, appname, outdir, artifact_dir=None):
+    """ Record the runner's progress in ``outdir``, starting with any tasks that are
+    already finished
+    """
+    runner.checkpoint = checkpoint.Checkpoint(os.path.join(outdir, STATEDIR), appname, runner,
+                                              artifact_dir=artifact_dir)
+    runner.checkpoint.record_all(runner)
 
-    write_outputs(runner, outdir)
 
+def attach_profiler(runner, args):
+    """ Start recording task timings and data sizes, if ``--profile`` was passed
+    """
+    runner.profiler = profiling.Profiler() if args.profile else None
+
+
+def attach_speculator(runner, args):
+    """ With ``--speculate``, run ligand tasks for each candidate ligand while waiting for
+    the user to choose one
+    """
+    if args.speculate > 0:
+        runner.speculator = speculation.Speculator(runner, args.speculate)
+    else:
+        runner.speculator = None
+
+
+def get_job_tracker(engine):
+    """ A tracker for jobs on a CCC server, so that task threads don't each poll the server
+    for their own jobs (docker engines wait for containers without polling)
+    """
+    if isinstance(engine, pyccc.engines.CloudComputeCannon):
+        return jobs.JobTracker()
+
+
+def attach_job_tracker(runner, tracker):
+    if isinstance(runner, ParallelCCCRunner):
+        runner.job_tracker = tracker
+
+
+def configure_local_tasks(runner, args):
+    """ Apply ``--local-image`` and ``--local-processes`` to a hybrid runner
+    """
+    if isinstance(runner, ParallelHybridRunner):
+        runner.local_images.update(args.local_image or [])
+        runner.local_processes = args.local_processes
 
-def restart_workflow(args, outdir):
-    with open(args.inputfile, 'r') as infile:
-        runner = dill.load(infile)
 
-    if isinstance(runner.engine, pyccc.Docker) and runner.engine.client is None:
-        runner.engine.client = runner.engine.connect_to_docker()
+def prewarm_containers(runner, preprocess=False):
+    """ Start pooled worker containers for the images of the tasks about to run (with
+    ``preprocess``, only the preprocessor and the tasks it depends on) while the workflow
+    gets going
+    """
+    if not isinstance(getattr(runner, 'engine', None), containerpool.PooledDocker):
+        return
+    if preprocess:
+        target = preprocessor_taskname(runner.workflow)
+        tasknames = runner.ancestors(target) | {target}
+    else:
+        tasknames = runner.tasks.keys()
+    runner.engine.prewarm(set(task_image(runner.workflow, runner.tasks[name])
+                              for name in tasknames
+                              if not runner.tasks[name].finished and
+                              not is_user_interaction(runner.tasks[name]) and
+                              not (isinstance(runner, ParallelHybridRunner) and
+                                   runner.runs_locally(name))))
 
+
+def restart_workflow(args, outdir):
+    """ Restart from a checkpoint directory, or from a ``workflow_state.dill`` file written
+    by older versions
+    """
     engine, RunnerClass = get_execution_env(args)
-    assert RunnerClass is runner.__class__
+
+    if os.path.isdir(args.inputfile):
+        appname = checkpoint.read_manifest(args.inputfile)['appname']
+        runner = checkpoint.restore(args.inputfile, get_app(appname), RunnerClass,
+                                    engine=engine,
+                                    max_parallel=args.max_parallel,
+                                    fuse_tasks=not args.no_fusion,
+                                    resources=get_resource_pool(args),
+                                    spiller=get_spiller(args),
+                                    cache=get_cache(args),
+                                    ligand_library=get_ligand_library(args),
+                                    **default_inputs(appname))
+    else:
+        appname = args.appname
+        with open(args.inputfile, 'r') as infile:
+            runner = dill.load(infile)
+
+        if isinstance(runner.engine, pyccc.Docker) and runner.engine.client is None:
+            runner.engine.client = runner.engine.connect_to_docker()
+
+        # state files written before the parallel runners were added hold a serial runner
+        assert issubclass(RunnerClass, runner.__class__)
+        if hasattr(runner, 'max_parallel'):
+            runner.max_parallel = args.max_parallel or DEFAULT_MAX_PARALLEL
+            runner.fuse_tasks = not args.no_fusion
+            runner.resources = get_resource_pool(args)
+            runner.spiller = get_spiller(args)
+            runner.cache = get_cache(args)
+            runner.ligand_library = get_ligand_library(args)
+
+    attach_checkpoint(runner, appname, outdir, args.artifact_store)
+    attach_profiler(runner, args)
+    attach_speculator(runner, args)
+    attach_job_tracker(runner, get_job_tracker(engine))
+    configure_local_tasks(runner, args)
+    prewarm_containers(runner)
 
     if args.setoutput:
         set_ui_outputs(runner, args)
@@ -96,37 +241,6 @@ def dump_all_tasks(runner, outdir):
                 print exc
 
 
-def write_outputs(runner, outdir):
-    """ Write a finished workflow's outputs to disk
-    """
-    for name in runner.outputfields:
-        value = runner.getoutput(name)
-        filebase = os.path.join(outdir, name)
-        fname = filebase
-        if isinstance(value, basestring):
-            with open(filebase, 'w') as outfile:
-                print >> outfile, value
-        elif hasattr(value, 'put'):
-            value.put(filebase)
-        elif hasattr(value, 'read'):
-            with open(filebase, 'w') as outfile:
-                print >> outfile, value.read
-        else:  # try to serialize
-            try:
-                jsonstr = json.dumps(value)
-            except TypeError:
-                fname = filebase+'.dill'
-                with open(fname, 'w') as outfile:
-                    dill.dump(value, outfile)
-            else:
-                fname = filebase+'.json'
-                with open(fname, 'w') as outfile:
-                    print >> outfile, jsonstr
-
-        if fname.split('.')[-2:] == ['tar', 'gz']:
-            os.system('tar xvzf %s' % fname)
-
-
 def set_ui_outputs(runner, args):
     """ Set the outputs of frontend tasks
 
@@ -160,8 +274,26 @@ def run_preprocessing(runner, outdir):
 
     with open(os.path.join(outdir, 'prep.json'), 'w') as outfile:
         json.dump(resultjson, outfile)
-    with open(os.path.join(outdir, 'workflow_state.dill'), 'w') as outfile:
-        dill.dump(runner, outfile)
+    if getattr(runner, 'checkpoint', None) is not None:
+        runner.checkpoint.record_all(runner)
+    if getattr(runner, 'profiler', None) is not None:
+        runner.profiler.write(runner, outdir)
+
+    if getattr(runner, 'speculator', None) is not None:
+        speculate_after_preprocessing(runner)
+
+
+def speculate_after_preprocessing(runner):
+    """ Run the speculative ligand tasks now, so that their results are waiting in the
+    cache or ligand library when the run is restarted with the user's choice
+    """
+    if runner.cache is None and runner.ligand_library is None:
+        print 'Not speculating: results can only be kept with a cache or ligand library'
+        return
+    for interaction in runner.speculator.targets:
+        if all(runner.tasks[name].finished for name in runner.ancestors(interaction)):
+            runner.speculator.start(interaction)
+    runner.speculator.wait()
 
 
 def make_output_dir(args):
@@ -189,18 +321,73 @@ def make_output_dir(args):
 def get_execution_env(args):
     """ Figure out where the workflow will run and how we'll run it
     """
-    runner = SerialCCCRunner
+    runner = ParallelHybridRunner if args.hybrid else ParallelCCCRunner
     if args.localdocker:
         assert not args.here
-        engine = pyccc.Docker()
+        if args.no_container_pool:
+            engine = resources.LocalDocker(artifact_dir=args.artifact_store)
+        else:
+            engine = containerpool.PooledDocker(
+                    max_size=args.pool_size or containerpool.DEFAULT_MAX_SIZE,
+                    idle_timeout=args.pool_idle_timeout or containerpool.DEFAULT_IDLE_TIMEOUT,
+                    artifact_dir=args.artifact_store)
     elif args.here:
-        runner = SerialRuntimeRunner
+        assert not args.hybrid
+        runner = ParallelRuntimeRunner
         engine = None
     else:
         engine = get_engine()
     return engine, runner
 
 
+def get_resource_pool(args):
+    """ The cores and memory to pack tasks into: this machine's (or ``--cores`` and
+    ``--memory``) when tasks run here, or only what was passed when they run on a CCC server
+    """
+    if args.no_resource_packing:
+        return None
+    elif args.localdocker or args.here or args.hybrid or args.cores or args.memory:
+        return resources.ResourcePool(args.cores, args.memory)
+    else:
+        return None
+
+
+def get_spiller(args):
+    """ Move task outputs that nothing needs anymore (and, with ``--output-memory``,
+    whatever exceeds that budget) out of memory, unless ``--no-spill`` was passed
+    """
+    if args.no_spill:
+        return None
+    else:
+        return spill.OutputSpiller(memory_budget=args.output_memory)
+
+
+def localize_input(inputjson, args):
+    """ If a structure store was requested, read PDB IDs from it instead of the network,
+    then resolve any other bare identifier here (through the resolved structure cache)
+    """
+    if args.structure_store is not None:
+        store = structures.StructureStore(args.structure_store)
+        inputjson = structures.localize_input(inputjson, store)
+    return structures.resolve_input(inputjson)
+
+
+def get_cache(args):
+    """ Open the task result cache, unless it's been disabled
+    """
+    if args.no_cache:
+        return None
+    else:
+        return ResultCache(args.cache_dir, max_bytes=int(args.cache_size * 1024**3))
+
+
+def get_ligand_library(args):
+    if args.ligand_library is None:
+        return None
+    else:
+        return ligandlib.LigandLibrary(args.ligand_library)
+
+
 def get_engine():
     server = os.environ.get('CCC', None)
     if not server:
@@ -0,0 +1,778 @@
+""" Workflow runners that run independent tasks concurrently.
+
+The serial runners in ``pyccc.workflow.runner`` walk the workflow one task at a time.
+The runners here keep the same interface (``run()``, ``preprocess()``, ``tasks``,
+``outputfields``, ``getoutput()``) but start every task as soon as all of its upstream
+tasks have finished. Each task still runs through the base class's ``run_task``, so the
+engine and serialization behavior is unchanged; only the order and overlap differ.
+
+Interactive tasks (``interactive.UserInteraction`` instances) always run in the main
+thread so that prompts aren't interleaved.
+
+If the runner has a ``cache.ResultCache``, each task is looked up by a key derived from
+its function source, its docker image and the keys of everything upstream of it; hits are
+replaced by finished tasks holding the cached outputs and skip execution entirely.
+
+If the runner has a ``ligandlib.LigandLibrary``, tasks marked with
+``ligandlib.keyed_by_ligand`` are looked up there first, by the ligand key in their inputs.
+
+If the runner has a ``checkpoint.Checkpoint``, each task is recorded there as soon as it
+finishes. If it has a ``profiling.Profiler``, each task's timings and data sizes are
+recorded there.
+
+Unless ``fuse_tasks`` is off, connected tasks marked with ``fusion.lightweight`` that share
+an image run together as one job (see ``fusion``), and are then checkpointed, profiled and
+cached one by one like any other task.
+
+If the runner has a ``speculation.Speculator``, it starts the ligand tasks for every
+candidate of an interaction while the interaction waits for the user, and the real tasks
+reuse the result for the chosen candidate.
+
+If the runner has a ``spill.OutputSpiller``, each task's outputs are moved out of memory
+once every task that reads them has finished (or when they exceed its memory budget), and
+loaded back from disk if they're needed again.
+
+If the runner has a ``resources.ResourcePool`` (which may be shared with other runners),
+each task waits until the cores and memory it declares (see ``resources.requires``) are
+free, and runs with them as its thread's allocation.
+
+If the engine mounts an artifact store in its containers (``resources.LocalDocker``),
+``ParallelCCCRunner`` passes outputs of upstream tasks to tasks by reference, so that each
+is serialized and copied only once however many tasks read it.
+
+If ``ParallelCCCRunner`` has a ``jobs.JobTracker`` (which may be shared with other
+runners), the tracker waits for its engine jobs, and tasks are finished from the tracker's
+callbacks, so that jobs in flight don't each hold a thread.
+
+``ParallelHybridRunner`` runs tasks that don't need a special image in local processes
+and sends only the rest to the engine.
+"""
+from __future__ import print_function
+
+import contextlib
+import cPickle as pickle
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import Queue
+
+from pyccc.workflow import MockUITask
+from pyccc.workflow.runner import SerialCCCRunner, SerialRuntimeRunner
+
+from . import fusion, interactive, resources
+from .artifacts import ArtifactStore, is_file_reference
+from .cache import digest, function_digest
+from .utils import pflush
+
+DEFAULT_MAX_PARALLEL = 4
+
+_local_pool = None
+_local_pool_lock = threading.Lock()
+
+
+def upstream_tasknames(task):
+    """ Names of the tasks whose outputs are inputs to this task
+    """
+    names = set()
+    for source in task.spec.inputfields.itervalues():
+        upstream = getattr(source, 'task', None)
+        if upstream is not None:
+            names.add(upstream.name)
+    return names
+
+
+def workflow_input_name(source):
+    """ If this task input is an input to the whole workflow, return its name
+    """
+    if getattr(source, 'task', None) is None:
+        return getattr(source, 'name', None)
+
+
+def task_image(workflow, task):
+    return getattr(task.spec, 'image', None) or workflow.default_docker_image
+
+
+def preprocessor_taskname(workflow):
+    return workflow.preprocessor_task.name
+
+
+def is_user_interaction(task):
+    return isinstance(task.spec.func, interactive.UserInteraction)
+
+
+class WorkflowFailed(Exception):
+    pass
+
+
+class ParallelRunnerMixin(object):
+    """ Runs ready tasks concurrently in a pool of at most ``max_parallel`` threads.
+
+    Args:
+        max_parallel (int): maximum number of tasks from this runner to run at once
+        slots (threading.Semaphore): optional semaphore shared between several runners,
+            to limit the total number of running tasks across all of them
+        cache (cache.ResultCache): optional store of results from previous runs
+        checkpoint (checkpoint.Checkpoint): optional place to record each finished task
+        ligand_library (ligandlib.LigandLibrary): optional store of ligand parameters
+        profiler (profiling.Profiler): optional recorder of task timings and data sizes
+        fuse_tasks (bool): run groups of cheap tasks that share an image as single jobs
+        resources (resources.ResourcePool): optional pool of cores and memory, possibly
+            shared between several runners, to pack running tasks into
+        spiller (spill.OutputSpiller): optional tracker that moves outputs nothing needs
+            anymore out of memory, possibly shared between several runners
+    """
+    def __init__(self, workflow, max_parallel=None, slots=None, cache=None, checkpoint=None,
+                 ligand_library=None, profiler=None, fuse_tasks=True, resources=None,
+                 spiller=None, **kwargs):
+        super(ParallelRunnerMixin, self).__init__(workflow, **kwargs)
+        self.max_parallel = max_parallel or DEFAULT_MAX_PARALLEL
+        self.fuse_tasks = fuse_tasks
+        self.cache = cache
+        self.checkpoint = checkpoint
+        self.ligand_library = ligand_library
+        self.profiler = profiler
+        self.resources = resources
+        self.spiller = spiller
+        self.inputvalues = {k: v for k, v in kwargs.iteritems() if k != 'engine'}
+        self._slots = slots
+        self._parallel = threading.BoundedSemaphore(self.max_parallel)
+        self._cachekeys = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_slots'] = state['_parallel'] = None  # locks can't be pickled
+        state['resources'] = None
+        state['speculator'] = None
+        state['job_tracker'] = None
+        state['spiller'] = None
+        return state
+
+    def run(self):
+        self._run_tasks(self.tasks.keys())
+
+    def preprocess(self):
+        target = preprocessor_taskname(self.workflow)
+        self._run_tasks(self.ancestors(target) | {target})
+        return self.tasks[target]
+
+    def ancestors(self, taskname):
+        """ All tasks that must finish before ``taskname`` can run
+        """
+        found = set()
+        tocheck = [taskname]
+        while tocheck:
+            for name in upstream_tasknames(self.tasks[tocheck.pop()]):
+                if name not in found:
+                    found.add(name)
+                    tocheck.append(name)
+        return found
+
+    def _ready(self, taskname, group=None):
+        """ True if everything upstream of a task (or of its whole group) has finished
+        """
+        return all(self.tasks[name].finished or name in (group or ())
+                   for member in (group or [taskname])
+                   for name in upstream_tasknames(self.tasks[member]))
+
+    def _run_tasks(self, tasknames):
+        """ Run the named tasks (and no others), respecting dependencies between them
+        """
+        order = {name: i for i, name in enumerate(self.tasks)}
+        pending = sorted((name for name in tasknames if not self.tasks[name].finished),
+                         key=order.get)
+        groups = fusion.fusion_groups(self, pending) if getattr(self, 'fuse_tasks', True) else {}
+        running = set()
+        completed = Queue.Queue()
+        errors = []
+
+        while pending or running:
+            for name in [n for n in pending if self._ready(n, groups.get(n))]:
+                if errors or len(running) >= self.max_parallel:
+                    break
+                elif name not in pending:  # already started with its group
+                    continue
+                task = self.tasks[name]
+
+                if is_user_interaction(task):
+                    pending.remove(name)
+                    self._profile_event(name, 'submit')
+                    speculator = getattr(self, 'speculator', None)
+                    if speculator is not None:
+                        speculator.start(name)
+                    self._execute(task)
+                    if speculator is not None:
+                        speculator.resolve(name)
+                    continue
+
+                members = groups.get(name, (name,))
+                for member in members:
+                    pending.remove(member)
+                    self._profile_event(member, 'submit')
+                running.add(name)
+                thread = threading.Thread(target=self._task_thread,
+                                          args=(name, members, completed),
+                                          name='task:%s' % '+'.join(members))
+                thread.daemon = True
+                thread.start()
+
+            if not running:
+                if errors:
+                    break
+                elif any(self._ready(n, groups.get(n)) for n in pending):
+                    continue  # an interaction just finished and made more tasks ready
+                elif pending:
+                    raise WorkflowFailed('Cannot run tasks %s: their inputs are unavailable'
+                                         % ', '.join(pending))
+                else:
+                    continue
+
+            name, exc_info = completed.get()
+            running.discard(name)
+            if exc_info is not None:
+                pflush('Task "%s" failed; waiting for %d running task(s) to finish'
+                       % (name, len(running)))
+                errors.append(exc_info)
+
+        if errors:
+            exc_type, exc_value, tb = errors[0]
+            raise exc_type, exc_value, tb
+
+    def _task_thread(self, name, members, completed):
+        """ Run a task (or group) and report it on the ``completed`` queue. A task that
+        ``_tracks`` is handed over to its job tracker once its job is launched, and is
+        finished (and reported) from the tracker's callback, so no thread waits for it.
+        """
+        exc_info = None
+        handed_over = False
+        try:
+            allocation, release = self._hold(members)
+            try:
+                with resources.allocated(allocation):
+                    if len(members) > 1:
+                        self._execute_group(members)
+                    elif self._tracks(self.tasks[name]):
+                        handed_over = self._execute_tracked(self.tasks[name], release,
+                                                            completed)
+                    else:
+                        self._execute(self.tasks[name])
+            finally:
+                if not handed_over:
+                    release()
+        except Exception:
+            exc_info = sys.exc_info()
+        finally:
+            if not handed_over:
+                completed.put((name, exc_info))
+
+    @contextlib.contextmanager
+    def running(self, tasknames):
+        """ Context for running tasks (as one job) from a task thread or a speculative
+        branch: holds what they need (see ``_hold``), with their allocation as this
+        thread's ``resources.current_allocation``
+        """
+        allocation, release = self._hold(tasknames)
+        try:
+            with resources.allocated(allocation):
+                yield
+        finally:
+            release()
+
+    def _hold(self, tasknames):
+        """ Wait for the cores and memory tasks need (if the runner has a resource pool),
+        then for one of this runner's ``max_parallel`` slots and one of the shared
+        ``slots`` (if any). Resources come first, so that tasks waiting for cores don't
+        hold slots other tasks could use.
+
+        Returns:
+            Tuple[dict, callable]: the allocation, and a function that gives everything
+                back (from any thread)
+        """
+        pool = getattr(self, 'resources', None)
+        request = resources.combined_resources([resources.task_resources(self.tasks[name])
+                                                for name in tasknames])
+        allocation = pool.acquire(request) if pool is not None else dict(request)
+        semaphores = [semaphore for semaphore in (getattr(self, '_parallel', None),
+                                                  self._slots)
+                      if semaphore is not None]
+        for semaphore in semaphores:
+            semaphore.acquire()
+
+        def release():
+            for semaphore in reversed(semaphores):
+                semaphore.release()
+            if pool is not None:
+                pool.release(allocation)
+
+        return allocation, release
+
+    def _tracks(self, task):
+        """ True if this task's job is waited for by a job tracker (see
+        ``ParallelCCCRunner``)
+        """
+        return False
+
+    def _execute(self, task):
+        """ Run a single task, then checkpoint and profile it
+        """
+        name = task.spec.name
+        self._profile_event(name, 'start')
+        self._finished(name, self._run_cached(task))
+
+    def _execute_group(self, tasknames):
+        """ Run a group of tasks as one job (skipping any whose results are stored), then
+        checkpoint and profile each of them
+        """
+        torun, sources = [], {}
+        for name in tasknames:
+            self._profile_event(name, 'start')
+            stores = self._stores(self.tasks[name])
+            sources[name] = self._load_stored(self.tasks[name], stores)
+            if sources[name] is None:
+                torun.append((name, stores))
+
+        if len(torun) == 1:
+            name, stores = torun[0]
+            sources[name] = self._run_and_store(self.tasks[name], stores)
+        elif torun:
+            names = [name for name, stores in torun]
+            pflush('Running tasks %s as one job' % ', '.join(names))
+            outputs = self.run_task_chain(names)
+            for name, stores in torun:
+                self._profile_event(name, 'finish')
+                self.tasks[name] = MockUITask(self.tasks[name].spec, outputs[name])
+                self._store_outputs(name, outputs[name], stores)
+                sources[name] = 'fused'
+
+        for name in tasknames:
+            self._finished(name, sources[name])
+
+    def run_task_chain(self, tasknames, values=None, jobs=None):
+        """ Run several tasks as one job, in this process
+
+        Args:
+            tasknames (List[str]): the tasks, in workflow order
+            values (Mapping[str, dict]): outputs to use for upstream tasks, in place of
+                their actual outputs (see ``input_value``)
+            jobs (list): engine jobs that are launched are appended here
+
+        Returns:
+            Mapping[str, dict]: each task's outputs, by task name
+        """
+        return fusion.run_task_chain(fusion.task_chain_steps(self, tasknames,
+                                                             ship_source=False,
+                                                             values=values))
+
+    def _finished(self, name, source):
+        """ Checkpoint and profile a task that just finished (the profiler takes output
+        sizes from the checkpoint), then let the spiller move outputs out of memory
+        """
+        if getattr(self, 'checkpoint', None) is not None:
+            try:
+                self.checkpoint.record(name, self.tasks[name], self._cachekeys.get(name))
+            except Exception as exc:
+                pflush('WARNING: failed to checkpoint task "%s": %s' % (name, exc))
+
+        if getattr(self, 'profiler', None) is not None:
+            try:
+                self.profiler.update(name, source=source)
+                self.profiler.record_task(self, self.tasks[name])
+            except Exception as exc:
+                pflush('WARNING: failed to profile task "%s": %s' % (name, exc))
+
+        if getattr(self, 'spiller', None) is not None:
+            try:
+                self.spiller.finished(self, name)
+            except Exception as exc:
+                pflush('WARNING: failed to spill outputs after task "%s": %s' % (name, exc))
+
+    def _profiling(self):
+        return getattr(self, 'profiler', None) is not None
+
+    def _profile_event(self, taskname, eventname):
+        if self._profiling():
+            self.profiler.event(taskname, eventname)
+
+    def _run_cached(self, task):
+        """ Run a single task, unless its results are already in the ligand library or
+        the cache
+
+        Returns:
+            str: where the results came from - ``'run'`` or the name of the store
+        """
+        name = task.spec.name
+        if is_user_interaction(task):
+            self.run_task(task)
+            self._profile_event(name, 'finish')
+            return 'run'
+
+        stores = self._stores(task)
+        return self._load_stored(task, stores) or self._run_and_store(task, stores)
+
+    def _stores(self, task, values=None, keys=None):
+        """ The stores (name, store, key) that may hold this task's results, in the order
+        to look them up. ``values`` and ``keys`` are passed on to ``input_value`` and
+        ``cache_key``; with ``values``, speculative results aren't included.
+        """
+        stores = []
+        library = getattr(self, 'ligand_library', None)
+        if library is not None and hasattr(task.spec.func, '__ligandkey__'):
+            stores.append(('ligand library', library,
+                           self.input_value(task, task.spec.func.__ligandkey__, values)))
+        if getattr(self, 'cache', None) is not None:
+            stores.append(('cache', self.cache, self.cache_key(task.spec.name, keys)))
+        speculator = getattr(self, 'speculator', None)
+        if values is None and speculator is not None and speculator.covers(task.spec.name):
+            stores.append(('speculative results', speculator, self.cache_key(task.spec.name)))
+        return stores
+
+    def _load_stored(self, task, stores):
+        """ Finish a task with stored results, if there are any
+
+        Returns:
+            str: the name of the store the results came from (or None if there weren't any)
+        """
+        name = task.spec.name
+        for i, (storename, store, key) in enumerate(stores):
+            outputs = store.load(key)
+            if outputs is not None:
+                self._profile_event(name, 'finish')
+                pflush('Using results for task "%s" from the %s' % (name, storename))
+                self.tasks[name] = MockUITask(task.spec, outputs)
+                self._store_outputs(name, outputs, stores[:i])
+                return storename
+
+    def _run_and_store(self, task, stores):
+        name = task.spec.name
+        self.run_task(task)
+        self._profile_event(name, 'finish')
+        task = self.tasks[name]  # may have been replaced by a finished task
+        self._store_outputs(name, {field: task.getoutput(field) for field in task.outputfields},
+                            stores)
+        return 'run'
+
+    def _store_outputs(self, taskname, outputs, stores):
+        for storename, store, key in stores:
+            try:
+                store.store(key, outputs)
+            except Exception as exc:
+                pflush('WARNING: failed to store results of task "%s" in the %s: %s'
+                       % (taskname, storename, exc))
+
+    def input_value(self, task, field, values=None):
+        """ The value of one of a task's inputs (its upstream task must have finished,
+        unless its outputs are given in ``values``, a dict of task name -> outputs)
+        """
+        source = task.spec.inputfields[field]
+        upstream = getattr(source, 'task', None)
+        inputname = workflow_input_name(source)
+        if upstream is not None and upstream.name in (values or {}):
+            return values[upstream.name][source.field]
+        elif upstream is not None:
+            return self.tasks[upstream.name].getoutput(source.field)
+        elif inputname is not None:
+            return self.inputvalues[inputname]
+        else:
+            return source
+
+    def cache_key(self, taskname, keys=None):
+        """ Content hash identifying a task's results.
+
+        This depends on the task's source code and image, and recursively on the keys of
+        the tasks upstream of it, so that upstream outputs never need to be serialized
+        just to compute it. Outputs of interactive tasks are hashed directly.
+
+        Keys are memoized in ``keys`` (by default, the runner's own); pass a dict with
+        some keys already filled in to compute keys for hypothetical upstream outputs.
+        """
+        if keys is None:
+            keys = self.__dict__.setdefault('_cachekeys', {})
+        if taskname in keys:
+            return keys[taskname]
+
+        task = self.tasks[taskname]
+        if isinstance(task, MockUITask) or is_user_interaction(task):
+            key = digest({field: task.getoutput(field) for field in task.outputfields})
+        else:
+            sha = hashlib.sha256(function_digest(task.spec.func))
+            sha.update(task_image(self.workflow, task))
+            for field, source in sorted(task.spec.inputfields.iteritems()):
+                upstream = getattr(source, 'task', None)
+                inputname = workflow_input_name(source)
+                if upstream is not None:
+                    part = '%s[%s]' % (self.cache_key(upstream.name, keys), source.field)
+                elif inputname is not None:
+                    part = digest(self.inputvalues[inputname])
+                else:
+                    part = digest(source)
+                sha.update('%s=%s;' % (field, part))
+            key = sha.hexdigest()
+
+        keys[taskname] = key
+        return key
+
+
+class ParallelCCCRunner(ParallelRunnerMixin, SerialCCCRunner):
+    """ Runs tasks on a pyccc engine.
+
+    Each task runs as a chain of one (see ``fusion.run_task_chain``), so that the
+    profiler can tell launching a job, starting its container, computing and fetching the
+    results apart.
+
+    If the engine mounts an artifact store in its containers (like
+    ``resources.LocalDocker``), outputs of upstream tasks are passed to tasks by
+    reference: each one is stored once, when the first task that reads it is launched, and
+    every task that reads it loads it from the store. ``reference_store`` counts what was
+    stored and what was reused.
+
+    If the runner has a ``job_tracker`` (a ``jobs.JobTracker``, possibly shared between
+    several runners), the tracker polls the status of its jobs instead of each task thread
+    calling ``job.wait()``. A single task's thread ends once its job is launched; the
+    tracker finishes the task when the job is done (see ``_execute_tracked``).
+    """
+    def __init__(self, workflow, **kwargs):
+        super(ParallelCCCRunner, self).__init__(workflow, **kwargs)
+        directory = getattr(self.engine, 'artifact_dir', None)
+        self.reference_store = ArtifactStore(directory) if directory is not None else None
+        self._references = {}  # (task name, field) -> (artifact, path in the container)
+
+    def run_task(self, task):
+        if is_user_interaction(task):
+            return super(ParallelCCCRunner, self).run_task(task)
+
+        name = task.spec.name
+        outputs = self.run_task_chain([name])
+        self.tasks[name] = MockUITask(task.spec, outputs[name])
+
+    def input_reference(self, task, field, values=None):
+        """ One of a task's inputs, as passed to ``fusion.run_task_chain``: outputs of
+        upstream tasks are stored in ``reference_store`` and passed as their path in the
+        container; file references and everything else are passed by value
+        """
+        source = task.spec.inputfields[field]
+        upstream = getattr(source, 'task', None)
+        key = (upstream.name, source.field) if upstream is not None else None
+        memoize = upstream is not None and upstream.name not in (values or {})
+        if memoize and key in self._references:
+            artifact, path = self._references[key]
+            self.reference_store.reference(artifact)
+            return 'artifact', path
+
+        value = self.input_value(task, field, values)
+        if upstream is None or is_file_reference(value):
+            return 'value', value
+        store = self.reference_store
+        artifact = store.put(value, pickled=True)
+        path = self.engine.artifact_path(os.path.relpath(store.path(artifact), store.directory))
+        if memoize:
+            self._references[key] = artifact, path
+        return 'artifact', path
+
+    def _tracks(self, task):
+        return getattr(self, 'job_tracker', None) is not None and not is_user_interaction(task)
+
+    def _execute_tracked(self, task, release, completed):
+        """ Like ``_execute``, but instead of waiting for the task's job, leave it to the
+        job tracker to call ``_finish_tracked`` when the job is done
+
+        Returns:
+            bool: True if the task was handed over; False if it finished with stored
+                results
+        """
+        name = task.spec.name
+        self._profile_event(name, 'start')
+        stores = self._stores(task)
+        source = self._load_stored(task, stores)
+        if source is not None:
+            self._finished(name, source)
+            return False
+
+        job = self._launch_chain([name])
+        self.job_tracker.track(job).add_done_callback(
+                lambda handle: self._finish_tracked(name, handle, stores, release, completed))
+        return True
+
+    def _finish_tracked(self, name, handle, stores, release, completed):
+        """ Fetch, store, checkpoint and profile the results of a task whose job is done,
+        then give back what it held and report it on the ``completed`` queue
+        """
+        exc_info = None
+        try:
+            handle.result()
+            outputs = self._chain_result(handle.job, [name])
+            self._profile_event(name, 'finish')
+            self.tasks[name] = MockUITask(self.tasks[name].spec, outputs[name])
+            self._store_outputs(name, outputs[name], stores)
+            self._finished(name, 'run')
+        except Exception:
+            exc_info = sys.exc_info()
+        finally:
+            release()
+            completed.put((name, exc_info))
+
+    def run_task_chain(self, tasknames, values=None, jobs=None):
+        """ Run several tasks as one job on the engine
+        """
+        job = self._launch_chain(tasknames, values)
+        if jobs is not None:
+            jobs.append(job)
+        if getattr(self, 'job_tracker', None) is not None:
+            self.job_tracker.track(job).result()
+        else:
+            job.wait()
+        return self._chain_result(job, tasknames)
+
+    def _launch_chain(self, tasknames, values=None):
+        import pyccc
+
+        image = task_image(self.workflow, self.tasks[tasknames[0]])
+        steps = fusion.task_chain_steps(
+                self, tasknames, values=values,
+                references=getattr(self, 'reference_store', None) is not None)
+        call = pyccc.PythonCall(fusion.run_task_chain, steps,
+                                timings=fusion.CHAIN_TIMINGS if self._profiling() else None)
+        job = self.engine.launch(image, call, name='+'.join(tasknames))
+        for name in tasknames:
+            self._profile_event(name, 'launched')
+        return job
+
+    def _chain_result(self, job, tasknames):
+        """ Fetch the results of a finished chain's job, then let the engine clean up after
+        it, if it can (with a ``cleanup(job)`` method)
+        """
+        for name in tasknames:
+            self._profile_event(name, 'job_done')
+        result = job.result
+        for name in tasknames:
+            self._profile_event(name, 'fetched')
+        if self._profiling():
+            try:
+                timings = json.loads(job.get_output(fusion.CHAIN_TIMINGS).read())
+            except Exception as exc:
+                pflush('WARNING: no task timings from job %s: %s'
+                       % (getattr(job, 'jobid', None), exc))
+            else:
+                self.profiler.chain_timings(tasknames, timings)
+        cleanup = getattr(self.engine, 'cleanup', None)
+        if cleanup is not None:  # e.g., containerpool.PooledDocker deletes its output files
+            cleanup(job)
+        return result
+
+
+class ParallelRuntimeRunner(ParallelRunnerMixin, SerialRuntimeRunner):
+    pass
+
+
+def local_process_pool(processes=None):
+    """ The process pool that ``ParallelHybridRunner`` instances run local tasks in, shared
+    by every runner in this process. It's created with ``processes`` workers (by default,
+    one per CPU, up to ``DEFAULT_MAX_PARALLEL``) the first time it's needed.
+    """
+    global _local_pool
+    with _local_pool_lock:
+        if _local_pool is None:
+            _local_pool = multiprocessing.Pool(
+                    processes or min(DEFAULT_MAX_PARALLEL, multiprocessing.cpu_count()))
+        return _local_pool
+
+
+def run_chain_in_tempdir(steps, environment=None):
+    """ Run a task chain (in a local pool worker) in a working directory of its own, so
+    that tasks running at the same time don't overwrite each other's files, with
+    ``environment`` variables set (e.g., ``resources.thread_environment``). Only those
+    variables are changed, and they're put back afterwards, so that one chain's thread
+    settings aren't left to the next chain the worker runs.
+
+    Returns:
+        str: the pickled outputs. They're pickled before the directory is removed, because
+            a ``pyccc.LocalFile`` pickles as the file's contents.
+    """
+    environment = environment or {}
+    previous = {name: os.environ.get(name) for name in environment}
+    os.environ.update(environment)
+    workdir = tempfile.mkdtemp(prefix='chemworkflows-task.')
+    try:
+        return pickle.dumps(fusion.run_task_chain(steps, workdir), pickle.HIGHEST_PROTOCOL)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        for name, value in previous.iteritems():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+class ParallelHybridRunner(ParallelCCCRunner):
+    """ Runs tasks that don't need a special image in local processes, and the rest on the
+    engine.
+
+    A task runs locally if it's marked with ``fusion.lightweight`` or its image is in
+    ``local_images`` (by default, the workflow's default image - the same moldesign
+    environment that's running the workflow). Tasks that need other images (e.g., for
+    NWChem, AmberTools or LAMMPS) go to the engine. If a task fails locally with an
+    ``ImportError`` - something its image has that this environment doesn't - it's rerun on
+    the engine, and always sent there from then on. Each local task (or chain) runs in a
+    temporary working directory of its own, as it would in a fresh container.
+
+    Args:
+        local_images (List[str]): images whose tasks can run locally
+        local_processes (int): size of the local process pool (see ``local_process_pool``)
+    """
+    def __init__(self, workflow, local_images=None, local_processes=None, **kwargs):
+        super(ParallelHybridRunner, self).__init__(workflow, **kwargs)
+        if local_images is None:
+            local_images = [workflow.default_docker_image]
+        self.local_images = set(local_images)
+        self.local_processes = local_processes
+        self._not_local = set()
+
+    def runs_locally(self, taskname):
+        task = self.tasks[taskname]
+        if taskname in self._not_local or is_user_interaction(task):
+            return False
+        return (getattr(task.spec.func, '__lightweight__', False) or
+                task_image(self.workflow, task) in self.local_images)
+
+    def _tracks(self, task):
+        return (not self.runs_locally(task.spec.name) and
+                super(ParallelHybridRunner, self)._tracks(task))
+
+    def run_task(self, task):
+        name = task.spec.name
+        if not self.runs_locally(name):
+            return super(ParallelHybridRunner, self).run_task(task)
+
+        outputs = self._run_locally([name])
+        if outputs is None:
+            return super(ParallelHybridRunner, self).run_task(task)
+        self.tasks[name] = MockUITask(task.spec, outputs[name])
+
+    def run_task_chain(self, tasknames, values=None, jobs=None):
+        if all(self.runs_locally(name) for name in tasknames):
+            outputs = self._run_locally(tasknames, values)
+            if outputs is not None:
+                return outputs
+        return super(ParallelHybridRunner, self).run_task_chain(tasknames, values, jobs)
+
+    def _run_locally(self, tasknames, values=None):
+        """ Run tasks in the local process pool
+
+        Returns:
+            Mapping[str, dict]: each task's outputs, by task name, or None if they need
+                something that isn't installed here
+        """
+        steps = fusion.task_chain_steps(self, tasknames, values=values)
+        allocation = resources.current_allocation()
+        environment = resources.thread_environment(allocation) if allocation else None
+        pool = local_process_pool(self.local_processes)
+        try:
+            return pickle.loads(pool.apply_async(run_chain_in_tempdir,
+                                                 (steps, environment)).get())
+        except ImportError as exc:
+            pflush('Running %s on the engine instead of locally: %s'
+                   % (', '.join(tasknames), exc))
+            self._not_local.update(tasknames)
@@ -0,0 +1,198 @@
+""" Start expensive ligand tasks before the user has chosen a ligand.
+
+In ``minimization`` and ``simsetup``, ``prep_ligand`` can't start until the user picks a
+ligand in ``user_atom_selection``, but ``get_ligands`` already knows every candidate. A
+``Speculator`` runs the tasks between the selection and each ligand-keyed task (e.g.,
+``protonate_ligand`` then ``prep_ligand``) for every candidate, in the background, while
+the user is choosing.
+
+Each speculative branch computes the cache keys its tasks would have if the user chose its
+candidate. When the real tasks run, the runner looks their keys up in the speculator (after
+the ligand library and the cache); a match waits for that branch's result instead of
+starting a new job, if the branch has started that task. Branches take the same slots as
+the runner's own tasks (``max_parallel``, and a batch's shared limit), so speculation never
+runs more tasks at once than a normal run would. Branches for the other candidates are cancelled as soon as the choice
+is made. Results of finished branches are also saved in the runner's cache and ligand
+library, so speculation started after ``--preprocess`` pays off in a later
+``--setoutput`` run.
+
+Interactions opt in by implementing ``UserInteraction.candidates``.
+"""
+from __future__ import print_function
+
+import threading
+
+from .cache import digest
+from .utils import pflush
+
+DEFAULT_MAX_CANDIDATES = 4
+
+
+def speculation_targets(runner):
+    """ The tasks to run speculatively for each interaction
+
+    Returns:
+        Mapping[str, List[str]]: interaction task name -> names of the tasks downstream of
+            it, up to and including tasks marked with ``ligandlib.keyed_by_ligand``, in
+            workflow order
+    """
+    from .runners import is_user_interaction
+
+    order = {name: i for i, name in enumerate(runner.tasks)}
+    targets = {}
+    for name, task in runner.tasks.iteritems():
+        if not hasattr(task.spec.func, '__ligandkey__'):
+            continue
+        ancestors = runner.ancestors(name)
+        for interaction in ancestors:
+            if not is_user_interaction(runner.tasks[interaction]):
+                continue
+            chain = targets.setdefault(interaction, set())
+            chain.add(name)
+            chain.update(other for other in ancestors
+                         if interaction in runner.ancestors(other))
+    return {name: sorted(chain, key=order.get) for name, chain in targets.iteritems()}
+
+
+class Speculator(object):
+    """ Runs ligand tasks for every candidate of an interaction while it's waiting for input
+
+    Args:
+        runner (runners.ParallelRunnerMixin): the runner
+        max_candidates (int): don't speculate on interactions with more candidates than this
+            (each candidate runs its own jobs)
+    """
+    def __init__(self, runner, max_candidates=DEFAULT_MAX_CANDIDATES):
+        self.runner = runner
+        self.max_candidates = max_candidates
+        self.targets = speculation_targets(runner)
+        self.branches = []
+        self._started = set()
+        self._lock = threading.Lock()
+
+    def covers(self, taskname):
+        return any(taskname in chain for chain in self.targets.itervalues())
+
+    def start(self, interaction):
+        """ Start speculative branches for each candidate of an interaction whose inputs
+        are ready
+        """
+        runner = self.runner
+        if interaction not in self.targets or interaction in self._started:
+            return
+        task = runner.tasks[interaction]
+        inputs = {field: runner.input_value(task, field) for field in task.spec.inputfields}
+        candidates = task.spec.func.candidates(**inputs)
+        if not candidates or len(candidates) < 2:
+            return
+        elif len(candidates) > self.max_candidates:
+            pflush('Not speculating on "%s": %d candidates (the limit is %d)'
+                   % (interaction, len(candidates), self.max_candidates))
+            return
+
+        self._started.add(interaction)
+        chain = self.targets[interaction]
+        pflush('Speculatively running %s for %d candidates of "%s"'
+               % (', '.join(chain), len(candidates), interaction))
+        for outputs in candidates:
+            branch = Branch(runner, interaction, outputs, chain)
+            with self._lock:
+                self.branches.append(branch)
+            branch.start()
+
+    def resolve(self, interaction):
+        """ Cancel the branches that don't match an interaction's actual outputs
+        """
+        key = self.runner.cache_key(interaction)
+        for branch in self.branches:
+            if branch.interaction == interaction and branch.keys[interaction] != key:
+                branch.cancel()
+
+    def load(self, key):
+        """ Wait for the speculative result with this cache key, if there is one
+        """
+        with self._lock:
+            branches = list(self.branches)
+        for branch in branches:
+            for taskname, branchkey in branch.keys.iteritems():
+                if branchkey == key and taskname in branch.started:
+                    branch.done[taskname].wait()
+                    return branch.outputs.get(taskname)
+
+    def store(self, key, outputs):
+        pass  # results are only produced by the branches
+
+    def wait(self):
+        for branch in self.branches:
+            branch.thread.join()
+
+    def cancel(self):
+        for branch in self.branches:
+            branch.cancel()
+
+
+class Branch(object):
+    """ Runs one candidate's tasks in a background thread
+    """
+    def __init__(self, runner, interaction, outputs, chain):
+        self.runner = runner
+        self.interaction = interaction
+        self.chain = chain
+        self.values = {interaction: outputs}
+        self.outputs = {}
+        self.jobs = []
+        self.cancelled = False
+        self.started = set()  # tasks that are running (holding a slot) or done
+        self.done = {name: threading.Event() for name in chain}
+
+        # the cache keys these tasks will have if this candidate is chosen
+        self.keys = {name: key for name, key in runner.__dict__.get('_cachekeys', {}).iteritems()
+                     if name not in chain and name != interaction}
+        self.keys[interaction] = digest(outputs)
+        for name in chain:
+            runner.cache_key(name, self.keys)
+
+        self.thread = threading.Thread(target=self._run,
+                                       name='speculate:%s' % digest(outputs)[:8])
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled = True
+        for job in self.jobs:
+            try:
+                job.kill()
+            except Exception:  # e.g., it already finished
+                pass
+
+    def _run(self):
+        runner = self.runner
+        try:
+            for name in self.chain:
+                if self.cancelled:
+                    break
+                task = runner.tasks[name]
+                stores = runner._stores(task, self.values, self.keys)
+                for storename, store, key in stores:
+                    outputs = store.load(key)
+                    if outputs is not None:
+                        self.started.add(name)
+                        break
+                else:
+                    with runner.running([name]):
+                        if self.cancelled:
+                            break
+                        self.started.add(name)
+                        outputs = runner.run_task_chain([name], self.values, self.jobs)[name]
+                    runner._store_outputs(name, outputs, stores)
+                self.values[name] = self.outputs[name] = outputs
+                self.done[name].set()
+        except Exception as exc:
+            if not self.cancelled:
+                pflush('WARNING: speculative run of %s failed: %s'
+                       % (', '.join(self.chain), exc))
+        finally:
+            for event in self.done.itervalues():
+                event.set()
@@ -0,0 +1,221 @@
+""" Moving finished tasks' outputs out of memory once nothing needs them.
+
+Without this, every finished task keeps its outputs in memory until the workflow is done -
+the minimization trajectories and intermediate molecules of a large complex, for every
+workflow in the process. An ``OutputSpiller`` counts, for each finished task, the
+downstream tasks that have yet to read its outputs. As soon as the last of them finishes,
+the task is replaced by a ``checkpoint.CheckpointedTask`` that loads its outputs from disk
+only when something asks for them. Outputs of the workflow itself count as a consumer
+until the run is over (``release``).
+
+With a memory budget, tasks are also spilled - those with the fewest remaining consumers
+first, then the largest - whenever the outputs in memory add up to more than the budget.
+A consumer that needs spilled outputs loads them back lazily.
+
+Outputs are spilled to the runner's checkpoint, which already holds them, or otherwise to
+an ``artifacts.ArtifactStore`` of the spiller's own. Their sizes are their serialized
+sizes. One spiller can be shared by several runners (e.g., every run in a batch), so that
+its budget holds for all of them together.
+"""
+from __future__ import print_function
+
+import atexit
+import collections
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+
+from pyccc.workflow import MockUITask
+
+from .artifacts import ArtifactStore
+from .checkpoint import CheckpointedTask
+from .resources import parse_memory
+from .runners import is_user_interaction, upstream_tasknames
+from .utils import human_bytes, pflush
+
+WORKFLOW_OUTPUT = '<workflow output>'  # the consumer standing for the workflow's outputs
+
+
+class OutputSpiller(object):
+    """ Tracks who still needs each finished task's outputs, and spills outputs to disk
+
+    Args:
+        memory_budget (int or str): also spill outputs whenever more than this many bytes
+            (or a size like ``'2g'``) of them are in memory (default: only spill outputs
+            that nothing needs)
+        directory (str): where to spill outputs of runners without a checkpoint (default:
+            a temporary directory, removed at exit)
+    """
+    def __init__(self, memory_budget=None, directory=None):
+        self.memory_budget = parse_memory(memory_budget) if memory_budget else None
+        self.directory = directory
+        self.stats = {'tasks_spilled': 0, 'bytes_spilled': 0,
+                      'resident_bytes': 0, 'peak_resident_bytes': 0}
+        self._store = None
+        self._runners = {}  # id(runner) -> runner
+        self._consumers = {}  # id(runner) -> task name -> names of consumers yet to finish
+        self._entries = {}  # (id(runner), task name) -> where the task's outputs are stored
+        self._resident = collections.OrderedDict()  # (id(runner), task name) -> bytes
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def finished(self, runner, name):
+        """ Account for a task that just finished: spill its upstream tasks' outputs if it
+        was their last consumer (and its own, if nothing needs them), then spill as much as
+        it takes to get within the budget
+        """
+        with self._lock:
+            consumers = self._track(runner)
+            key = (id(runner), name)
+            task = runner.tasks[name]
+            try:
+                self._entries[key] = self._stored(runner, name, task)
+            except Exception as exc:  # it'll just stay in memory
+                pflush('WARNING: failed to store outputs of task "%s" for spilling: %s'
+                       % (name, exc))
+            else:
+                if not isinstance(task, CheckpointedTask):  # restored tasks aren't loaded
+                    self._add_resident(key, self._entries[key]['bytes'])
+
+            upstream = upstream_tasknames(task)
+            for parent in upstream:
+                consumers[parent].discard(name)
+            for done in [name] + sorted(upstream):
+                if not consumers[done]:
+                    self.spill(runner, done)
+            self._enforce_budget()
+
+    def spill(self, runner, name):
+        """ Replace a finished task with one that loads its outputs from disk on demand
+
+        This also drops outputs that were loaded back in since it was last spilled.
+        """
+        with self._lock:
+            entry = self._entries.get((id(runner), name))
+            task = runner.tasks[name]
+            if entry is None and isinstance(task, CheckpointedTask):  # restored
+                entry = self._stored(runner, name, task)
+            if entry is None:
+                return
+
+            if isinstance(task, MockUITask) or is_user_interaction(task):
+                runner.cache_key(name)  # computed from the outputs, so memoize it now
+            runner.tasks[name] = CheckpointedTask(task.spec, entry['path'], entry['record'],
+                                                  entry['artifacts'])
+            nbytes = self._resident.pop((id(runner), name), None)
+            if nbytes is not None:
+                self.stats['resident_bytes'] -= nbytes
+                self.stats['tasks_spilled'] += 1
+                self.stats['bytes_spilled'] += nbytes
+
+    def release(self, runner):
+        """ Stop tracking a runner whose run is over (its outputs have been written)
+        """
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == id(runner)]:
+                del self._entries[key]
+                nbytes = self._resident.pop(key, None)
+                if nbytes is not None:
+                    self.stats['resident_bytes'] -= nbytes
+            self._consumers.pop(id(runner), None)
+            self._runners.pop(id(runner), None)
+
+    def summary(self):
+        return ('%d task(s) spilled to disk (%s); at most %s of outputs in memory'
+                % (self.stats['tasks_spilled'], human_bytes(self.stats['bytes_spilled']),
+                   human_bytes(self.stats['peak_resident_bytes'])))
+
+    def _track(self, runner):
+        """ The consumers of each of a runner's tasks, counted the first time it's seen
+        """
+        if id(runner) not in self._consumers:
+            consumers = {name: set() for name in runner.tasks}
+            for name, task in runner.tasks.iteritems():
+                if not task.finished:
+                    for parent in upstream_tasknames(task):
+                        consumers[parent].add(name)
+            for source in runner.workflow.outputs.itervalues():
+                upstream = getattr(source, 'task', None)
+                if upstream is not None:
+                    consumers[upstream.name].add(WORKFLOW_OUTPUT)
+            self._runners[id(runner)] = runner
+            self._consumers[id(runner)] = consumers
+        return self._consumers[id(runner)]
+
+    def _stored(self, runner, name, task):
+        """ Where a finished task's outputs are on disk, storing them first if necessary
+        """
+        if isinstance(task, CheckpointedTask):
+            return {'path': task.path, 'record': task.record,
+                    'artifacts': task.artifacts, 'bytes': 0}
+
+        checkpoint = getattr(runner, 'checkpoint', None)
+        if checkpoint is not None and name in checkpoint:
+            path = os.path.join(checkpoint.taskdir, name)
+            record = checkpoint.task_record(name)
+            store = checkpoint.artifacts
+        else:
+            store = self._spill_store()
+            path = store.directory
+            record = {'fields': {field: store.put(task.getoutput(field))
+                                 for field in task.outputfields}}
+        return {'path': path, 'record': record, 'artifacts': store,
+                'bytes': sum(artifact['bytes'] for artifact in record['fields'].itervalues())}
+
+    def _spill_store(self):
+        if self._store is None:
+            if self.directory is None:
+                directory = tempfile.mkdtemp(prefix='chemworkflows-spill.')
+                atexit.register(shutil.rmtree, directory, True)
+            else:
+                directory = self.directory
+            self._store = ArtifactStore(directory)
+        return self._store
+
+    def _add_resident(self, key, nbytes):
+        self._resident[key] = nbytes
+        self.stats['resident_bytes'] += nbytes
+        self.stats['peak_resident_bytes'] = max(self.stats['peak_resident_bytes'],
+                                                self.stats['resident_bytes'])
+
+    def _enforce_budget(self):
+        def priority(key):
+            runnerid, name = key
+            return len(self._consumers[runnerid][name]), -self._resident[key]
+
+        while (self.memory_budget is not None and self._resident and
+               self.stats['resident_bytes'] > self.memory_budget):
+            runnerid, name = min(self._resident, key=priority)
+            self.spill(self._runners[runnerid], name)
+
+
+def peak_rss(children=False):
+    """ Peak resident set size, in bytes, of this process - or, with ``children``, of the
+    largest of its child processes that have exited
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)  # kB on Linux
+
+
+def memory_summary(runner):
+    """ Peak memory use so far, and what the runner's spiller (if any) has done
+
+    Returns:
+        dict: ``peak_rss_bytes`` and ``peak_child_rss_bytes`` (see ``peak_rss``) and the
+            spiller's ``stats`` as ``spill`` (or None)
+    """
+    spiller = getattr(runner, 'spiller', None)
+    return {'peak_rss_bytes': peak_rss(),
+            'peak_child_rss_bytes': peak_rss(children=True),
+            'spill': dict(spiller.stats) if spiller is not None else None}
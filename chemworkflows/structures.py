@@ -0,0 +1,234 @@
+""" A local, indexed store of PDB entries, so that workflows can run without network access.
+
+Entries are stored as gzipped PDB-format files - or mmCIF, for entries the RCSB has no
+PDB-format file for - sharded by the middle two characters of their ID (as the PDB's own
+archive is)::
+
+    store/
+        index.json         {"3AID": {"path": "ai/3aid.pdb.gz", "format": "pdb",
+                                     "sha256": ...}, ...}
+        ai/3aid.pdb.gz
+
+This is the same file, in the same format, that ``moldesign.from_pdb`` would download.
+When a store is in use, inputs that name a PDB ID are rewritten on the client into file
+inputs holding the stored structure (``localize_input``), and ``read_molecule`` reads them
+the way ``from_pdb`` does - so a run builds the same molecule whether it's offline or not.
+
+Other bare identifiers (SMILES, names, InChI strings) are resolved on the client too
+(``resolve_input``), and the resulting molecules are cached in ``RESOLVED_CACHE``, so that
+the same identifier isn't resolved again in every run's throwaway container.
+"""
+from __future__ import print_function
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+from .utils import pflush
+
+INDEX = 'index.json'
+DOWNLOAD_URL = 'https://files.rcsb.org/download/%s.%s.gz'  # PDB ID, format
+FORMATS = ('pdb', 'cif')  # in order of preference, as in ``moldesign.from_pdb``
+DEFAULT_DOWNLOADS = 8
+RESOLVED_CACHE = '~/.chemworkflows/resolved'  # overridden by $CHEMWORKFLOWS_RESOLVED_CACHE
+
+
+class StructureNotFound(KeyError):
+    pass
+
+
+class StructureStore(object):
+    """ Directory of compressed structure files with an index keyed by PDB ID
+
+    Args:
+        directory (str): location of the store (created if necessary)
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._lock = threading.Lock()
+        self.index = self._read_index()
+
+    def __contains__(self, pdbid):
+        return pdbid.upper() in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, pdbid):
+        """ Returns the stored structure for a PDB ID
+
+        Returns:
+            Tuple[str, str]: format ('cif' or 'pdb') and uncompressed file contents
+        """
+        try:
+            entry = self.index[pdbid.upper()]
+        except KeyError:
+            raise StructureNotFound('PDB ID "%s" is not in the structure store at %s'
+                                    % (pdbid, self.directory))
+        with gzip.open(os.path.join(self.directory, entry['path']), 'rb') as infile:
+            return entry['format'], infile.read()
+
+    def add_file(self, pdbid, path, format='pdb'):
+        """ Add a gzipped structure file to the store (the file is moved into the store)
+        """
+        pdbid = pdbid.upper()
+        relpath = os.path.join(pdbid[1:3].lower(), '%s.%s.gz' % (pdbid.lower(), format))
+        dest = os.path.join(self.directory, relpath)
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        shutil.move(path, dest)
+
+        with open(dest, 'rb') as infile:
+            sha = hashlib.sha256(infile.read()).hexdigest()
+        with self._lock:
+            self.index[pdbid] = {'path': relpath, 'format': format, 'sha256': sha}
+
+    def preload(self, pdbids, nthreads=DEFAULT_DOWNLOADS, refresh=False):
+        """ Download structures for a list of PDB IDs (skipping those already stored)
+
+        Returns:
+            dict: mapping of PDB IDs that couldn't be downloaded to the error message
+        """
+        todo = sorted(set(p.upper() for p in pdbids if refresh or p not in self))
+        failures = {}
+
+        def fetch(pdbid):
+            try:
+                self.add_file(pdbid, *download(pdbid))
+            except Exception as exc:
+                failures[pdbid] = str(exc)
+                pflush('Failed to download %s: %s' % (pdbid, exc))
+            else:
+                pflush('Downloaded %s' % pdbid)
+
+        pflush('Downloading %d structures into %s' % (len(todo), self.directory))
+        pool = ThreadPool(nthreads)
+        try:
+            pool.map(fetch, todo)
+        finally:
+            pool.close()
+            self.write_index()
+        return failures
+
+    def write_index(self):
+        with self._lock:
+            fd, tmppath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump(self.index, outfile, indent=1, sort_keys=True)
+            os.rename(tmppath, os.path.join(self.directory, INDEX))
+
+    def _read_index(self):
+        path = os.path.join(self.directory, INDEX)
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as infile:
+            return json.load(infile)
+
+
+def download(pdbid):
+    """ Download a gzipped structure file from the RCSB to a temporary file: the PDB-format
+    file, or the mmCIF file if there's no PDB-format file for this entry
+
+    Returns:
+        Tuple[str, str]: the file's path and format
+    """
+    import urllib2
+
+    for format in FORMATS:
+        try:
+            response = urllib2.urlopen(DOWNLOAD_URL % (pdbid.upper(), format), timeout=60)
+        except urllib2.HTTPError as exc:
+            if exc.code != 404 or format == FORMATS[-1]:
+                raise
+            pflush('No %s file for %s; trying the next format' % (format, pdbid.upper()))
+        else:
+            break
+
+    fd, tmppath = tempfile.mkstemp(suffix='.%s.gz' % format)
+    with os.fdopen(fd, 'wb') as outfile:
+        shutil.copyfileobj(response, outfile)
+
+    with gzip.open(tmppath, 'rb') as check:  # make sure we got a complete gzip file
+        while check.read(1024**2):
+            pass
+    return tmppath, format
+
+
+def localize_input(description, store):
+    """ Rewrite an input description that names a PDB ID into one that holds the stored
+    structure, so that it can be read without network access.
+
+    The new description also names the PDB ID, so that ``read_molecule`` names the
+    molecule and records its source like ``moldesign.from_pdb`` does.
+
+    Raises:
+        StructureNotFound: if the input is a PDB ID that isn't in the store
+    """
+    from .common import classify_input
+
+    if 'pdb' in description:
+        pdbid = description['pdb']
+    elif 'input' in description and classify_input(description['input']) == 'pdb':
+        pdbid = description['input']
+    else:
+        return description
+
+    format, content = store.get(pdbid)
+    print('Using %s from the local structure store' % pdbid.upper())
+    return {'filename': '%s.%s' % (pdbid.upper(), format),
+            'content': content,
+            'pdbid': pdbid.upper()}
+
+
+def resolve_input(description, cachedir=None):
+    """ Resolve a bare identifier input (``{"input": ...}``) here, on the client, into a
+    file input holding the pickled molecule, and cache the molecule by identifier.
+
+    Args:
+        description (dict): the input description (anything else is returned unchanged)
+        cachedir (str): where to cache resolved molecules (default:
+            ``$CHEMWORKFLOWS_RESOLVED_CACHE``, or ``RESOLVED_CACHE``); an empty string
+            disables caching and resolving, leaving it to ``read_molecule``
+    """
+    from .common import read_molecule
+
+    if cachedir is None:
+        cachedir = os.environ.get('CHEMWORKFLOWS_RESOLVED_CACHE', RESOLVED_CACHE)
+    if not cachedir or set(description) != {'input'}:
+        return description
+
+    identifier = description['input']
+    encoded = identifier.encode('utf-8')  # identifiers from JSON inputs may be non-ASCII
+    cachedir = os.path.expanduser(cachedir)
+    key = hashlib.sha1(encoded).hexdigest()
+    path = os.path.join(cachedir, key + '.pkl')
+    if os.path.exists(path):
+        print('Reading molecule "%s" from the resolved structure cache' % encoded)
+    else:
+        mol = read_molecule(description)['mol']
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        fd, tmppath = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+        os.close(fd)
+        mol.write(tmppath, format='pkl')
+        os.rename(tmppath, path)
+
+    with open(path, 'rb') as infile:
+        content = infile.read()
+    return {'filename': key + '.pkl',
+            'content': content,
+            'input': identifier}
+
+
+def read_id_list(path):
+    """ Read PDB IDs from a file, separated by whitespace or commas
+    """
+    with open(path, 'r') as infile:
+        return [pdbid for pdbid in infile.read().replace(',', ' ').split()]
@@ -0,0 +1,189 @@
+""" Compact binary trajectory files.
+
+Layout (all integers little-endian)::
+
+    MAGIC                      8 bytes
+    topology                   zlib-compressed PDB string of the first frame
+    frame 0 ... frame N-1      each a zlib-compressed float32 array, shape (natoms, 3),
+                               in angstroms
+    index                      JSON: natoms, offsets and lengths of the topology and each
+                               frame, per-frame potential energies (kcal/mol, if known)
+    index offset               uint64
+    MAGIC                      8 bytes
+
+Frames are compressed independently and the index is written last, so the file is written
+in a single pass and any one frame can be read from a memory map without touching the rest.
+"""
+import json
+import mmap
+import struct
+import zlib
+
+MAGIC = 'CWTRAJ01'
+_FOOTER = struct.Struct('<Q')
+
+
+def write_trajectory(traj, filename):
+    """ Write a moldesign trajectory in the compact format.
+
+    This is called inside task containers, which ship functions by source, so it's kept
+    self-contained.
+    """
+    import json
+    import struct
+    import zlib
+    import numpy as np
+    from moldesign import units as u
+
+    magic = 'CWTRAJ01'  # == MAGIC
+    index = {'natoms': traj.mol.num_atoms,
+             'dtype': 'float32',
+             'units': 'angstrom',
+             'frames': [],
+             'energies': []}
+
+    with open(filename, 'wb') as outfile:
+        outfile.write(magic)
+
+        topology = zlib.compress(traj.frames[0].write(format='pdb'))
+        index['topology'] = [outfile.tell(), len(topology)]
+        outfile.write(topology)
+
+        for frame in traj.frames:
+            coords = np.ascontiguousarray(frame.positions.value_in(u.angstrom),
+                                          dtype='float32')
+            block = zlib.compress(coords.tobytes())
+            index['frames'].append([outfile.tell(), len(block)])
+            outfile.write(block)
+
+            energy = getattr(frame, 'potential_energy', None)
+            index['energies'].append(None if energy is None
+                                     else float(energy.value_in(u.kcalpermol)))
+
+        indexstart = outfile.tell()
+        outfile.write(json.dumps(index))
+        outfile.write(struct.pack('<Q', indexstart))
+        outfile.write(magic)
+
+
+def start_trajectory(filename, mol):
+    """ Start writing a compact trajectory one frame at a time, with the molecule's current
+    structure as its topology. Frames are added with ``append_frame`` as they're produced,
+    so they never need to be kept in memory, and the file is completed by
+    ``finish_trajectory``.
+
+    Like ``write_trajectory``, this is kept self-contained.
+
+    Returns:
+        dict: the trajectory's writing state
+    """
+    import zlib
+
+    index = {'natoms': mol.num_atoms,
+             'dtype': 'float32',
+             'units': 'angstrom',
+             'frames': [],
+             'energies': []}
+    outfile = open(filename, 'wb')
+    outfile.write('CWTRAJ01')  # == MAGIC
+
+    topology = zlib.compress(mol.write(format='pdb'))
+    index['topology'] = [outfile.tell(), len(topology)]
+    outfile.write(topology)
+    return {'file': outfile, 'index': index}
+
+
+def append_frame(trajectory, mol, energy=None):
+    """ Write the molecule's current positions as the next frame of a trajectory from
+    ``start_trajectory``
+
+    Args:
+        trajectory (dict): from ``start_trajectory``
+        mol (moldesign.Molecule): the molecule
+        energy (Scalar[energy]): the frame's potential energy, if known
+    """
+    import zlib
+    import numpy as np
+    from moldesign import units as u
+
+    outfile, index = trajectory['file'], trajectory['index']
+    coords = np.ascontiguousarray(mol.positions.value_in(u.angstrom), dtype='float32')
+    block = zlib.compress(coords.tobytes())
+    index['frames'].append([outfile.tell(), len(block)])
+    outfile.write(block)
+    index['energies'].append(None if energy is None else float(energy.value_in(u.kcalpermol)))
+
+
+def finish_trajectory(trajectory):
+    """ Write the index of a trajectory from ``start_trajectory`` and close it
+    """
+    import json
+    import struct
+
+    outfile = trajectory['file']
+    indexstart = outfile.tell()
+    outfile.write(json.dumps(trajectory['index']))
+    outfile.write(struct.pack('<Q', indexstart))
+    outfile.write('CWTRAJ01')  # == MAGIC
+    outfile.close()
+
+
+class TrajectoryFile(object):
+    """ Random-access reader for compact trajectory files
+
+    Examples:
+        >>> with TrajectoryFile('minsteps.ctraj') as traj:
+        ...     last = traj[-1]  # numpy array of shape (natoms, 3), in angstroms
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        footerstart = len(self._map) - _FOOTER.size - len(MAGIC)
+        if (self._map[:len(MAGIC)] != MAGIC or
+                self._map[footerstart + _FOOTER.size:] != MAGIC):
+            raise IOError('%s is not a compact trajectory file' % filename)
+        indexstart, = _FOOTER.unpack(self._map[footerstart:footerstart + _FOOTER.size])
+        self.index = json.loads(self._map[indexstart:footerstart])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        return len(self.index['frames'])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        import numpy as np
+
+        offset, length = self.index['frames'][i]
+        data = zlib.decompress(self._map[offset:offset + length])
+        return np.frombuffer(data, dtype=self.index['dtype']).reshape(self.natoms, 3)
+
+    @property
+    def natoms(self):
+        return self.index['natoms']
+
+    @property
+    def energies(self):
+        """ List[float]: potential energy of each frame in kcal/mol (None where unknown)
+        """
+        return self.index['energies']
+
+    @property
+    def topology(self):
+        """ str: PDB-format structure of the first frame
+        """
+        offset, length = self.index['topology']
+        return zlib.decompress(self._map[offset:offset + length])
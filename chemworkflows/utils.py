@@ -1,12 +1,14 @@
 from __future__ import print_function
+import os
 import sys
-import pyccc
 import pickle
 
 
 def run_mdt(fn, *args, **kwargs):
     """ Runs a python command in an MDT container
     """
+    import pyccc
+
     pflush('Running python:%s ...' % fn.__name__, end='')
     wait = kwargs.pop('wait', True)
     inputs = kwargs.pop('inputs', {})
@@ -45,10 +47,27 @@ def finish_job(job, wait):
 
 
 def get_asset(filename):
-    import os
-    thispath = os.path.dirname(os.path.abspath(__file__))
-    filepath = os.path.join(thispath, 'assets', filename)
-    return open(filepath)
+    """ Returns a handle to a file in the assets directory. The file isn't opened until
+    it's read.
+    """
+    return Asset(filename)
+
+
+class Asset(object):
+    def __init__(self, filename):
+        self.name = filename
+        self.path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'assets', filename)
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def read(self):
+        with self.open() as assetfile:
+            return assetfile.read()
+
+    def __repr__(self):
+        return '<Asset %s>' % self.name
 
 
 def submit_job(job, image=None, wait=True):
@@ -93,3 +112,12 @@ def pflush(s, **kwargs):
     sys.stdout.flush()
 
 
+def human_bytes(nbytes):
+    if nbytes < 1024:
+        return '%d B' % nbytes
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if nbytes < 1024.0 or unit == 'GB':
+            return '%.1f %s' % (nbytes, unit)
+        nbytes /= 1024.0
+
+
@@ -16,6 +16,11 @@ setup(
         entry_points={
             'console_scripts': [
                 'chemworkflow = chemworkflows.__main__:main'
+            ],
+            'chemworkflows.apps': [
+                'minimize = chemworkflows.apps.MMminimize:minimization',
+                'vde = chemworkflows.apps.vde:vde',
+                'setuplammps = chemworkflows.apps.simsetup:simsetup'
             ]
         }
 )
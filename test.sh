@@ -43,7 +43,7 @@ function runsteps(){
 	fi
 
 	mkdir $testdir/finish
-	torun="$cmd --restart $testdir/preprocess/workflow_state.dill --outputdir $testdir/finish $finalizing"
+	torun="$cmd --restart $testdir/preprocess/workflow_state --outputdir $testdir/finish $finalizing"
 	echo "> $torun"
 	$torun 1>$testdir/finish/out 2>$testdir/finish/err
 
@@ -91,7 +91,7 @@ function runsteps_docker(){
 	fi
 
 	mkdir $testdir/finish
-	torun="$dockercmd -v $absdir/finish:/outputs -v $absdir/preprocess:/inputs $cmd --restart /inputs/workflow_state.dill --outputdir /outputs $finalizing"
+	torun="$dockercmd -v $absdir/finish:/outputs -v $absdir/preprocess:/inputs $cmd --restart /inputs/workflow_state --outputdir /outputs $finalizing"
 	echo "> $torun"
 	$torun 1>$testdir/finish/out 2>$testdir/finish/err
 